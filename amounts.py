@@ -0,0 +1,164 @@
+from decimal import Decimal
+
+import numpy as np
+
+from pool_store import split_big_ints
+
+# Raw amounts are split into 16 bit digits for the long division by 5**decimals,
+# the running remainder (< 5**18 < 2**42) shifted by one digit still fits in 64 bits
+DIGIT_BITS = 16
+DIGIT_MASK = np.uint64((1 << DIGIT_BITS) - 1)
+MAX_DECIMALS = 18
+
+
+def scale_to_decimals(scale):
+    decimals = len(str(scale)) - 1
+    if scale != 10 ** decimals or decimals > MAX_DECIMALS:
+        raise ValueError(f"Scale must be a power of ten up to 10**{MAX_DECIMALS}, got {scale}")
+    return decimals
+
+
+def negate_128(hi, lo):
+    """Two's complement negation of 128-bit values stored as (int64 hi, uint64 lo)."""
+    neg_lo = ~lo + np.uint64(1)
+    neg_hi = ~hi + (lo == 0).astype(np.int64)
+    return neg_hi, neg_lo
+
+
+def divmod_pow10(hi, lo, decimals):
+    """Exact divmod of non-negative 128-bit values by 10**decimals, vectorized.
+
+    10**d == 2**d * 5**d, so the value is first shifted right by d bits and the result
+    is then long-divided by 5**d one 16 bit digit at a time.
+    """
+    hi = hi.astype(np.uint64)
+    lo = lo.astype(np.uint64)
+    shift = np.uint64(decimals)
+
+    low_bits = lo & np.uint64((1 << decimals) - 1)
+    if decimals:
+        lo = (lo >> shift) | (hi << np.uint64(64 - decimals))
+        hi = hi >> shift
+
+    divisor = np.uint64(5 ** decimals)
+    remainder = np.zeros_like(lo)
+    quotient_hi = np.zeros_like(hi)
+    quotient_lo = np.zeros_like(lo)
+    for position in range(128 // DIGIT_BITS - 1, -1, -1):
+        word, offset = (hi, position - 4) if position >= 4 else (lo, position)
+        digit = (word >> np.uint64(offset * DIGIT_BITS)) & DIGIT_MASK
+        current = (remainder << np.uint64(DIGIT_BITS)) | digit
+        quotient_digit = current // divisor
+        remainder = current % divisor
+        if position >= 4:
+            quotient_hi |= quotient_digit << np.uint64((position - 4) * DIGIT_BITS)
+        else:
+            quotient_lo |= quotient_digit << np.uint64(position * DIGIT_BITS)
+
+    if quotient_hi.any() or (quotient_lo >> np.uint64(63)).any():
+        raise OverflowError(f"Amount too large for 10**{decimals} scaling into int64 whole units")
+    frac = remainder * np.uint64(1 << decimals) + low_bits
+    return quotient_lo.astype(np.int64), frac.astype(np.int64)
+
+
+def exact_sum(values):
+    # Sum 31 bit halves separately so the int64 accumulators can't overflow
+    values = np.asarray(values, dtype=np.int64)
+    high = (values >> 31).sum()
+    low = (values & ((1 << 31) - 1)).sum()
+    return int(high) * (1 << 31) + int(low)
+
+
+class TokenAmounts:
+    """Exact token amounts as a scaled decimal column.
+
+    Every value is stored as two int64 arrays with value == whole + frac / scale and
+    0 <= frac < scale, so scaling, abs, sums and comparisons run on plain NumPy arrays
+    instead of Python ints in object columns. scale is the token's 10**decimals.
+    """
+
+    def __init__(self, whole, frac, scale):
+        self.whole = np.asarray(whole, dtype=np.int64)
+        self.frac = np.asarray(frac, dtype=np.int64)
+        self.scale = scale
+        self.decimals = scale_to_decimals(scale)
+
+    @classmethod
+    def from_hi_lo(cls, hi, lo, scale):
+        """Build from raw amounts stored as hi * 2**64 + lo, as in the columnar pool files."""
+        hi = np.asarray(hi, dtype=np.int64)
+        lo = np.asarray(lo, dtype=np.uint64)
+        negative = hi < 0
+        neg_hi, neg_lo = negate_128(hi, lo)
+        whole, frac = divmod_pow10(np.where(negative, neg_hi, hi), np.where(negative, neg_lo, lo),
+                                   scale_to_decimals(scale))
+
+        # Turn -(whole + frac / scale) into floor form with a non-negative fraction
+        borrow = negative & (frac != 0)
+        whole = np.where(negative, -whole - borrow, whole)
+        frac = np.where(borrow, scale - frac, frac)
+        return cls(whole, frac, scale)
+
+    @classmethod
+    def from_ints(cls, values, scale):
+        return cls.from_hi_lo(*split_big_ints(values), scale)
+
+    def __len__(self):
+        return len(self.whole)
+
+    def __getitem__(self, index):
+        return TokenAmounts(self.whole[index], self.frac[index], self.scale)
+
+    def __neg__(self):
+        borrow = self.frac != 0
+        return TokenAmounts(-self.whole - borrow, np.where(borrow, self.scale - self.frac, 0), self.scale)
+
+    def abs(self):
+        negative = self.whole < 0
+        flipped = -self
+        return TokenAmounts(np.where(negative, flipped.whole, self.whole),
+                            np.where(negative, flipped.frac, self.frac), self.scale)
+
+    def sign(self):
+        return np.where(self.whole < 0, -1, np.where((self.whole > 0) | (self.frac > 0), 1, 0)).astype(np.int8)
+
+    def compare(self, other):
+        """-1, 0 or 1 per element against other amounts with the same scale, or against 0."""
+        if isinstance(other, (int, np.integer)) and other == 0:
+            return self.sign()
+        if not isinstance(other, TokenAmounts) or other.scale != self.scale:
+            raise TypeError("Can only compare with 0 or TokenAmounts of the same scale")
+        whole_order = (self.whole > other.whole).astype(np.int8) - (self.whole < other.whole)
+        frac_order = (self.frac > other.frac).astype(np.int8) - (self.frac < other.frac)
+        return np.where(whole_order != 0, whole_order, frac_order).astype(np.int8)
+
+    def __eq__(self, other):
+        return self.compare(other) == 0
+
+    def __ne__(self, other):
+        return self.compare(other) != 0
+
+    def __lt__(self, other):
+        return self.compare(other) < 0
+
+    def __le__(self, other):
+        return self.compare(other) <= 0
+
+    def __gt__(self, other):
+        return self.compare(other) > 0
+
+    def __ge__(self, other):
+        return self.compare(other) >= 0
+
+    def to_float(self):
+        # Convert the magnitude, floor form of small negatives would cancel catastrophically
+        magnitude = self.abs()
+        return np.where(self.whole < 0, -1.0, 1.0) * (magnitude.whole + magnitude.frac / self.scale)
+
+    def raw_total(self):
+        """Exact sum of the raw integer amounts."""
+        return exact_sum(self.whole) * self.scale + exact_sum(self.frac)
+
+    def total(self):
+        """Exact sum in token units."""
+        return Decimal(self.raw_total()).scaleb(-self.decimals)
@@ -1,85 +1,56 @@
-import json
-import pandas as pd
-from glob import glob
-
-# Define decimals map for tokens
-DECIMALS_MAP = {
-    "WETH": 10 ** 18,
-    "DAI": 10 ** 18,
-    "USDC": 10 ** 6,
-    "USDT": 10 ** 6,
-    "WBTC": 10 ** 8,
-    "LINK": 10 ** 18,
-    "UNI": 10 ** 18,
-    "MKR": 10 ** 18,
-    "MATIC": 10 ** 18,
-    "SHIB": 10 ** 18,
-    "LDO": 10 ** 18,
-    "PEPE": 10 ** 18,
-    "SKL": 10 ** 18
-}
+import argparse
+import numpy as np
+from pool_catalog import find_pools
+from price_bars import load_swap_prices
+from swap_table import available_pools, load_compact_table, load_swap_table, load_usdt_prices
+from pnl_engine import compute_user_pnl, incremental_user_pnl, select_top_performers
+from out_of_core import DEFAULT_MEMORY_LIMIT, out_of_core_user_pnl
+from profiling import TRACE_PATH, enable, stage
+from user_features import TOKEN_VOLUMES_PATH, token_volumes
 
 # Define the specific pools you want to load
 TARGET_POOLS = ["WETH_USDT", "USDC_WETH", "MATIC_WETH", "UNI_WETH", "DAI_WETH"]
 
-def load_pool_data():
-    # Load and filter data from only the specified pool files
-    pool_files = glob("pools/data_*.json")  # Adjust path if needed
-    pool_files = [file for file in pool_files if any(pool in file for pool in TARGET_POOLS)]
-    
-    all_records = []
+def target_pool_names(target_pools=TARGET_POOLS):
+    # Pool files of the target pools, e.g. data_WETH_USDT.json and data_WETH_USDT_0.json for WETH_USDT
+    return find_pools(target_pools)
 
-    for file in pool_files:
-        token0, token1 = file.split("_")[1:]
-        token1 = token1.split(".")[0]
-        
-        with open(file) as f:
-            data = json.load(f)
-        
-        # Convert JSON data into a DataFrame
-        records = []
-        for user_address, transactions in data.items():
-            for tx in transactions:
-                records.append(tx)
-        
-        df = pd.DataFrame(records)
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df[f'amount0_{token0}'] = df['amount0'] / DECIMALS_MAP[token0]
-        df[f'amount1_{token1}'] = df['amount1'] / DECIMALS_MAP[token1]
-        df = df[(df[f'amount0_{token0}'] != 0) & (df[f'amount1_{token1}'] != 0)]
-        all_records.append(df)
-
-    # Combine all pools data into a single DataFrame
-    all_df = pd.concat(all_records, ignore_index=True)
+def load_pool_data(target_pools=TARGET_POOLS, start=None, end=None):
+    # Load and filter data from only the specified pool files
+    pools = target_pool_names(target_pools)
+
+    # Canonical swaps of all pools with amounts in token units, cached on disk by swap_table.
+    # With a time range the catalog skips the pools and users outside it
+    with stage("load_swap_table") as loaded:
+        all_df = load_swap_table(pools, start=start, end=end)
+        loaded.rows_out = len(all_df)
+
+    # calculate_user_perfomance reads each row's amounts from amount0_<TOKEN> / amount1_<TOKEN> columns
+    with stage("amount_columns", rows_in=len(all_df)) as columns:
+        for leg in ["0", "1"]:
+            for token in all_df[f'token{leg}'].unique():
+                all_df[f'amount{leg}_{token}'] = all_df[f'amount{leg}'].where(all_df[f'token{leg}'] == token)
+        all_df = all_df[(all_df['amount0'] != 0) & (all_df['amount1'] != 0)].reset_index(drop=True)
+        columns.rows_out = len(all_df)
     return all_df
 
-def load_usdt_prices():
-    # Load historical USDT prices for each token
-    usdt_prices = pd.read_csv('Combined_Historical_Price_Data.csv')  # Assumes 'Date', 'Token', 'Price_USDT'
-    usdt_prices['Date'] = pd.to_datetime(usdt_prices['Date'], dayfirst=True)
-    usdt_prices = usdt_prices.set_index(['Date', 'token'])
-    usdt_prices['Price'] = usdt_prices['Price'].str.replace(',', '').astype(float)
-    
-    return usdt_prices
-
-def get_usdt_price(token, date, usdt_prices):
-    """Retrieve USDT price for a specific token on a given date."""
-    if token in {"USDT", "USDC", "DAI", "FRAX", "LDO"}:
-        return 1  # Price is 1 if token is a stablecoin
-    token_adj = "ETH" if token == "WETH" else "BTC" if token == "WBTC" else token
-    try:
-        return usdt_prices.loc[(pd.to_datetime(date), token_adj), 'Price']
-    except KeyError:
-        return None  # Return None if price is missing
+def add_usdt_prices(df, usdt_prices):
+    # Price every swap in one vectorized lookup instead of once per row
+    df['price0_usdt'] = usdt_prices.lookup(df['token0'], df['timestamp'])
+    df['price1_usdt'] = usdt_prices.lookup(df['token1'], df['timestamp'])
+    return df
 
 
-def calculate_user_perfomance(user_data, usdt_prices):
+def calculate_user_perfomance(user_data, usdt_prices, min_buys=25, min_sells=25):
     my_total_balance_usdt = 0  # Final balance in USDT
     intermediate_balances = {}  # Track intermediate balances for each token
     token_volumes = {}
     txs = {"buy": 0, "sell": 0}
     tokens_bought = {}
     
+    if 'price0_usdt' not in user_data:
+        user_data = add_usdt_prices(user_data.copy(), usdt_prices)
+    
     for _, row in user_data.iterrows():
         date = row['timestamp'].date().strftime('%Y-%m-%d')
         token0, token1 = row['token0'], row['token1']
@@ -89,18 +60,11 @@ def calculate_user_perfomance(user_data, usdt_prices):
         amount0 = row[f'amount0_{token0}']
         amount1 = row[f'amount1_{token1}']
         
-        # Retrieve USDT prices for token0 and token1 on this date
-        if t0_usd:
-            price_token0_usdt = 1
-        else:
-            price_token0_usdt = get_usdt_price(token0, date, usdt_prices)
-        
-        if t1_usd:
-            price_token1_usdt = 1
-        else:
-            price_token1_usdt = get_usdt_price(token1, date, usdt_prices)
+        # USDT prices for token0 and token1 on this date, joined by add_usdt_prices
+        price_token0_usdt = row['price0_usdt']
+        price_token1_usdt = row['price1_usdt']
         
-        if price_token0_usdt is None or price_token1_usdt is None:
+        if usdt_prices.skip_missing and (np.isnan(price_token0_usdt) or np.isnan(price_token1_usdt)):
             continue  # Skip this transaction if either price is missing
         
         # Initialize intermediate balance if it doesn’t exist
@@ -135,7 +99,7 @@ def calculate_user_perfomance(user_data, usdt_prices):
     my_total_balance_usdt = finalize_balances(intermediate_balances, usdt_prices, tokens_bought, my_total_balance_usdt)
     
     # Choose only active users
-    if (txs["buy"] > 25 and txs["sell"] > 25):
+    if (txs["buy"] > min_buys and txs["sell"] > min_sells):
         # Store the user's performance in terms of USDT
         return my_total_balance_usdt, token_volumes
     return None, None
@@ -194,44 +158,89 @@ def finalize_balances(intermediate_balances, usdt_prices, tokens_bought, my_tota
     # Finalize remaining intermediate balances at the last known prices
     for token, balance in intermediate_balances.items():
         if balance > 0:
-            token_updated = "ETH" if token == "WETH" else "BTC" if token == "WBTC" else "USD" if \
-                token in {"USDT", "USDC", "DAI", "FRAX", "LDO"} else token
-            
-            last_price_usdt = usdt_prices.loc[(tokens_bought[token], token_updated), 'Price']
+            last_price_usdt = usdt_prices.get(token, tokens_bought[token])
             my_total_balance_usdt += balance * last_price_usdt  # Add remaining balance value
     return my_total_balance_usdt
 
 def main():
-    all_df = load_pool_data()
-    usdt_prices = load_usdt_prices()
-    
-    # Group by user and analyze performance across pools
-    user_performance = []
-    user_performance_expanded = []
-    for user, user_data in all_df.groupby('user_address'):
-        user_total_balance_usdt, token_volumes = calculate_user_perfomance(user_data, usdt_prices)
-        
-        if user_total_balance_usdt:
-            user_performance.append({'user_address': user, 'profit_in_usdt': user_total_balance_usdt})
-            user_performance_expanded.append({
-                'user_address': user, 
-                'profit_in_usdt': user_total_balance_usdt,
-                'volume_traded': token_volumes
-                })
-    
-    # Convert to DataFrame for sorting and selecting top performers
-    performance_df = pd.DataFrame(user_performance)
-    performance_df_sorted = performance_df.sort_values(by='profit_in_usdt', ascending=False)
-    top_performers = performance_df_sorted.head(100)
-    print(top_performers)
-
-    top_performers['user_address'].to_csv("top_performers_weth_usdt.txt", index=False, header=False)
+    parser = argparse.ArgumentParser(description="Find the most active and profitable users of the target pools")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="at most this many worker processes for the per-user analysis, users are sharded "
+                             "by address; inputs under 250k swaps and single-core machines run serially")
+    parser.add_argument("--pools", nargs="+", default=TARGET_POOLS,
+                        help="pools such as WETH_USDT, the target pools by default, "
+                             "all for every pool with known decimals")
+    parser.add_argument("--top-k", type=int, default=100, help="number of top performers to keep")
+    parser.add_argument("--min-buys", type=int, default=25, help="only users with more buys than this are analysed")
+    parser.add_argument("--min-sells", type=int, default=25, help="only users with more sells than this are analysed")
+    parser.add_argument("--prices", choices=["csv", "swaps"], default="csv",
+                        help="daily USD prices from the price CSV or derived from the swaps")
+    parser.add_argument("--state", help="keep every user's running balances in this file and only process "
+                                        "swaps added since the last run (single process)")
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="stream the pools through sorted runs on disk instead of loading every swap")
+    parser.add_argument("--memory-limit", default=DEFAULT_MEMORY_LIMIT,
+                        help="memory for buffered swaps with --out-of-core, e.g. 1G")
+    parser.add_argument("--start", help="only swaps at or after this time, e.g. 2024-08-01")
+    parser.add_argument("--end", help="only swaps before this time")
+    parser.add_argument("--profile", nargs="?", const=TRACE_PATH,
+                        help=f"time every stage and write the trace to this file ({TRACE_PATH} if no path is given)")
+    args = parser.parse_args()
+    if args.out_of_core and (args.start or args.end):
+        parser.error("--start and --end are not supported with --out-of-core")
+    if args.profile:
+        enable(args.profile)
+    pools = available_pools() if args.pools == ["all"] else target_pool_names(args.pools)
+    if not pools:
+        parser.error(f"none of {', '.join(args.pools)} is in pools/, fetch them or pass --pools all")
+
+    with stage("load_prices"):
+        usdt_prices = load_swap_prices() if args.prices == "swaps" else load_usdt_prices()
+    if not args.out_of_core:
+        with stage("load_pool_data") as loaded:
+            all_df = load_pool_data(pools, start=args.start, end=args.end)
+            loaded.rows_out = len(all_df)
+        with stage("add_usdt_prices", rows_in=len(all_df)) as priced:
+            all_df = add_usdt_prices(all_df, usdt_prices)
+            priced.rows_out = len(all_df)
     
+    # Choose only active users before pricing anything, then analyze every remaining user's
+    # swaps in chronological order in one pass over the sorted swap table
+    with stage("user_pnl", rows_in=None if args.out_of_core else len(all_df)) as analysed:
+        if args.out_of_core:
+            # The same table from user-partitioned, time-sorted runs spilled to disk
+            results = out_of_core_user_pnl(pools, usdt_prices, args.memory_limit,
+                                           min_buys=args.min_buys, min_sells=args.min_sells)
+        elif args.state:
+            # Resume every user that traded again from the balances saved by the previous run
+            results = incremental_user_pnl(all_df, usdt_prices, args.state, min_buys=args.min_buys,
+                                           min_sells=args.min_sells)
+        else:
+            results = compute_user_pnl(all_df, usdt_prices, args.workers, min_buys=args.min_buys,
+                                       min_sells=args.min_sells)
+        analysed.rows_out = len(results)
     
-    performance_df = pd.DataFrame(user_performance_expanded)
-    performance_df_sorted = performance_df.sort_values(by='profit_in_usdt', ascending=False)
-    top_performers = performance_df_sorted.head(100)
-    top_performers.to_csv("top_performers_with_profits_and_volumes.csv", index=False)
+    # Keep the best performers with a non-zero result without sorting everyone
+    with stage("top_performers", rows_in=len(results)) as selected:
+        top_performers = select_top_performers(results, args.top_k).reset_index(drop=True)
+        selected.rows_out = len(top_performers)
+    print(top_performers[['user_address', 'profit_in_usdt']])
+
+    with stage("write_results"):
+        top_performers['user_address'].to_csv("top_performers_weth_usdt.txt", index=False, header=False)
+
+        top_performers[['user_address', 'profit_in_usdt']].to_csv(
+            "top_performers_with_profits.csv", index=False)
+
+    # Per-token volumes of the top performers from their own swaps, valued on each swap's day
+    with stage("token_volumes") as volumes_stage:
+        addresses = top_performers['user_address'].tolist()
+        swaps = load_compact_table(pools, start=args.start, end=args.end, users=addresses)
+        volumes = token_volumes(swaps, usdt_prices)
+        volumes = volumes.sort_values('user_address', key=lambda column: column.map(
+            {address: rank for rank, address in enumerate(addresses)}), kind='stable')
+        volumes.to_csv(TOKEN_VOLUMES_PATH, index=False)
+        volumes_stage.rows_in, volumes_stage.rows_out = len(swaps), len(volumes)
 
 
 if __name__ == "__main__":
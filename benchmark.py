@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from analyse_users import TARGET_POOLS, add_usdt_prices, load_pool_data
+from correlation_sweep import daily_metrics, correlation_sweep, eth_volatility
+from pnl_engine import compute_user_pnl, select_top_performers
+from pool_catalog import find_pools, has_decimals
+from profiling import current_rss_mb, peak_rss_mb, reset_peak_rss
+from swap_table import available_pools, load_compact_table, load_usdt_prices, normalize_swaps, pool_cache_path
+from synthetic_pools import load_manifest
+
+RESULTS_PATH = "benchmark_results.json"
+BASELINE_PATH = "benchmark_baseline.json"
+
+SYNTHETIC_POOLS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "synthetic_pools.py")
+
+# A stage regresses when it takes this much longer or more memory than in the baseline,
+# and by more than the noise floor, so millisecond stages don't flap
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+MIN_RSS_MB = 20
+
+
+def measure(stages, name, function, rows):
+    """Run one stage and record its wall time, rows per second and its own memory.
+
+    peak_rss_mb is the peak RSS during the stage and rss_delta_mb how far that peak rose
+    above the RSS the stage started with, i.e. the memory the stage itself needed. Where
+    the peak can't be reset both fall back to the process high-water mark and its growth.
+    """
+    reset = reset_peak_rss()
+    start_rss = current_rss_mb() if reset else peak_rss_mb()
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    peak = peak_rss_mb()
+    count = rows(value)
+    stages[name] = {
+        "seconds": round(seconds, 4),
+        "rows": count,
+        "rows_per_second": round(count / seconds) if seconds else None,
+        "peak_rss_mb": round(peak, 1),
+        "rss_delta_mb": round(max(peak - start_rss, 0), 1),
+    }
+    return value
+
+
+def dataset_pools():
+    # The pools analyse_users reads if the dataset has them, else every pool with known decimals
+    pools = [pool for pool in find_pools(TARGET_POOLS) if has_decimals(pool)]
+    return pools or available_pools()
+
+
+def run_benchmark(data_dir, top_k=100, min_buys=25, min_sells=25, workers=1):
+    """Time every stage of the analysis on the dataset in data_dir, from a cold swap table cache.
+
+    Stages run in the order of the scripts: load the swaps, join their USD prices, compute
+    the PnL of every active user, pick the top performers and correlate their daily
+    volume with ETH volatility over the whole sweep grid.
+    """
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        pools = dataset_pools()
+        for pool in pools:
+            if os.path.exists(pool_cache_path(pool)):
+                os.remove(pool_cache_path(pool))
+
+        stages = {}
+        usdt_prices = load_usdt_prices()
+        measure(stages, "load", lambda: load_pool_data(pools), len)
+        all_df = measure(stages, "load_cached", lambda: load_pool_data(pools), len)
+        all_df = measure(stages, "price_join", lambda: add_usdt_prices(all_df, usdt_prices), len)
+        results = measure(stages, "pnl", lambda: compute_user_pnl(all_df, usdt_prices, workers, min_buys=min_buys,
+                                                                  min_sells=min_sells), lambda _: len(all_df))
+        top = measure(stages, "top_k", lambda: select_top_performers(results, top_k), lambda _: len(results))
+
+        def correlation():
+            swaps = normalize_swaps(load_compact_table(pools), usdt_prices)
+            daily = daily_metrics(swaps, top['user_address'].tolist())
+            correlation_sweep(daily, eth_volatility())
+            return swaps
+
+        measure(stages, "correlation", correlation, len)
+
+        dataset = load_manifest(".") or {}
+        dataset.update({"pools": {pool: int((all_df['pool'] == pool).sum()) for pool in pools},
+                        "swaps": len(all_df), "users": int(all_df['user_address'].nunique()),
+                        "active_users": len(results)})
+    finally:
+        os.chdir(cwd)
+
+    return {
+        "created": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "data_dir": data_dir,
+        "dataset": dataset,
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                    "workers": workers},
+        "stages": stages,
+    }
+
+
+def find_regressions(results, baseline, tolerance=TOLERANCE):
+    """Stages that got slower or bigger than in the baseline by more than tolerance and the noise floor."""
+    regressions = []
+    for name, stage in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        # Memory is compared by what each stage added, the peak also holds the data of earlier stages
+        for metric, floor in [("seconds", MIN_SECONDS), ("rss_delta_mb", MIN_RSS_MB)]:
+            if metric not in base:
+                continue
+            if stage[metric] > base[metric] * (1 + tolerance) and stage[metric] - base[metric] > floor:
+                ratio = round(stage[metric] / base[metric], 2) if base[metric] else None
+                regressions.append({"stage": name, "metric": metric, "baseline": base[metric],
+                                    "current": stage[metric], "ratio": ratio})
+    return regressions
+
+
+def report(results, baseline=None):
+    table = pd.DataFrame(results["stages"]).T
+    if baseline is not None:
+        base = pd.DataFrame(baseline["stages"]).T.reindex(table.index)
+        table["vs_baseline"] = (table["seconds"] / base["seconds"]).round(2)
+    dataset = results["dataset"]
+    print(f"{dataset['swaps']} swaps, {dataset['users']} users ({dataset['active_users']} active) "
+          f"in {len(dataset['pools'])} pools from {results['data_dir']}")
+    print(table.to_string())
+
+
+def save_json(data, path):
+    with open(path + ".tmp", "w") as file:
+        json.dump(data, file, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the analysis and compare with a baseline")
+    parser.add_argument("--data-dir", default="synthetic", help="directory with a pools/ dataset and the price CSVs")
+    parser.add_argument("--swaps", type=int, help="generate a synthetic dataset of this many swaps into --data-dir")
+    parser.add_argument("--users", type=int, default=100000, help="users of the generated dataset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--top-k", type=int, default=100)
+    parser.add_argument("--min-buys", type=int, default=25)
+    parser.add_argument("--min-sells", type=int, default=25)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="results to compare with, if the file exists")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    if args.swaps is not None:
+        manifest = load_manifest(args.data_dir)
+        wanted = {"seed": args.seed, "swaps": args.swaps, "user_pool": args.users}
+        # Regenerate only when the dataset on disk was made with other settings
+        # in a process of its own: memory the generator leaves to the allocator would be reused
+        # by the first stage and make it look smaller than in a run on an existing dataset
+        if manifest is None or any(manifest.get(key) != value for key, value in wanted.items()):
+            subprocess.run([sys.executable, SYNTHETIC_POOLS_SCRIPT, "--out", args.data_dir, "--swaps", str(args.swaps),
+                            "--users", str(args.users), "--seed", str(args.seed)], check=True)
+
+    results = run_benchmark(args.data_dir, args.top_k, args.min_buys, args.min_sells, args.workers)
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline["dataset"].get("swaps") != results["dataset"]["swaps"]:
+            print(f"Warning: the baseline was measured on {baseline['dataset'].get('swaps')} swaps")
+    results["regressions"] = find_regressions(results, baseline, args.tolerance) if baseline else []
+
+    report(results, baseline)
+    save_json(results, args.output)
+    if args.save_baseline:
+        save_json(results, args.baseline)
+        print(f"Saved the baseline to {args.baseline}")
+    for regression in results["regressions"]:
+        ratio = f" ({regression['ratio']}x)" if regression['ratio'] is not None else ""
+        print(f"REGRESSION {regression['stage']} {regression['metric']}: {regression['baseline']} -> "
+              f"{regression['current']}{ratio}")
+    raise SystemExit(1 if results["regressions"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import sqlite3
+import json
+import threading
+
+# Number of keys looked up per SELECT, kept below SQLite's bound parameter limit
+LOOKUP_CHUNK = 500
+
+
+class ChainCache:
+    """Persistent cache for chain data that cannot change once a block is final.
+
+    Everything lives in a single SQLite file. Entries are grouped by namespace
+    (e.g. "senders" keyed by tx hash, "pools" keyed by contract address) and values
+    are stored JSON encoded. Every put_many is committed right away, so an interrupted
+    run keeps everything resolved so far. One cache can be shared by several threads,
+    they take turns on the connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self.conn.commit()
+        self.stats = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _count(self, namespace, hits, misses):
+        counts = self.stats.setdefault(namespace, {"hits": 0, "misses": 0})
+        counts["hits"] += hits
+        counts["misses"] += misses
+
+    def get_many(self, namespace, keys):
+        """Return a dict with the cached values of the given keys, missing keys are left out."""
+        keys = list(dict.fromkeys(key.lower() for key in keys))
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[start:start + LOOKUP_CHUNK]
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM cache WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [namespace, *chunk]
+                )
+                found.update((key, json.loads(value)) for key, value in rows)
+            self._count(namespace, len(found), len(keys) - len(found))
+        return found
+
+    def put_many(self, namespace, items):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, key.lower(), json.dumps(value)) for key, value in items.items()]
+            )
+            self.conn.commit()
+
+    def get(self, namespace, key):
+        return self.get_many(namespace, [key]).get(key.lower())
+
+    def put(self, namespace, key, value):
+        self.put_many(namespace, {key: value})
+
+    def report(self):
+        lines = []
+        for namespace, counts in sorted(self.stats.items()):
+            total = counts["hits"] + counts["misses"]
+            hit_rate = counts["hits"] / total * 100 if total else 0
+            lines.append(f"{namespace}: {counts['hits']} hits, {counts['misses']} misses ({hit_rate:.1f}% hit rate)")
+        return "\n".join(lines)
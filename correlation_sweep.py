@@ -0,0 +1,170 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from price_bars import load_swap_prices, load_intraday_volatility
+from significance import N_RESAMPLES, correlation_significance
+from swap_table import available_pools, load_compact_table, load_eth_data, load_usdt_prices, normalize_swaps, user_ids
+
+# Pools to combine, every swap is valued by its non-WETH leg in USDT
+POOLS = ["USDC_WETH", "WETH_USDT", "MATIC_WETH", "UNI_WETH", "DAI_WETH"]
+
+# volume is the raw USDT volume of total_volume_correlation.py, custom_volume the volume
+# characteristic of visualise_correlation.py (every swap divided by its user's average swap)
+METRICS = ["volume", "custom_volume"]
+QUANTILES = [0.0, 0.5, 0.75, 0.8, 0.85, 0.9, 0.95]
+WINDOWS = [1, 3, 7, 14, 30]
+MAX_LAG = 7
+
+SWEEP_PATH = "correlation_sweep.csv"
+SWEEP_INDEX = ["metric", "window", "quantile", "lag"]
+
+
+def daily_metrics(df, positive_addresses):
+    """Daily raw volume, volume characteristic and swap count of the given users' swaps."""
+    df = df[df['user'].isin(user_ids(positive_addresses))]
+    volume = df['amount0_usdt'].abs()
+    average_volume = volume.groupby(df['user']).transform('mean')
+    return pd.DataFrame({
+        'volume': volume,
+        'custom_volume': volume / average_volume,
+        'tx_count': 1,
+    }).groupby(pd.to_datetime(df['timestamp'], unit='s').dt.normalize().rename('date')).sum()
+
+
+def eth_volatility(pool=None):
+    # Daily ETH volatility from the price CSV, or the intraday realized volatility of a pool's swaps
+    eth_price_data = load_intraday_volatility(pool) if pool else load_eth_data()
+    return pd.Series(eth_price_data['Volatility'].to_numpy(), index=pd.to_datetime(eth_price_data['Date']))
+
+
+def correlation_sweep(daily, volatility, metrics=METRICS, quantiles=QUANTILES, lags=None, windows=WINDOWS):
+    """Pearson correlation of daily metrics with ETH volatility over a whole grid at once.
+
+    For a window w every day's metric is summed over the trailing w calendar days. Days
+    whose metric is above its q quantile are kept, q=0 keeps every day, and paired with the
+    volatility lag days later. All pairings are reduced to masked sums with a few matrix
+    products, so the grid costs about as much as a single correlation.
+
+    Returns a table indexed by (metric, window, quantile, lag) with the number of paired
+    days and the correlation, NaN where fewer than two days pair up.
+    """
+    lags = np.arange(-MAX_LAG, MAX_LAG + 1) if lags is None else np.asarray(lags)
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    days = daily.index.values.astype('datetime64[D]')
+
+    # Volatility lag days after every active day, one row per lag
+    lagged = (days[None, :] + lags[:, None]).ravel()
+    y = volatility.reindex(pd.DatetimeIndex(lagged)).to_numpy().reshape(len(lags), len(days))
+    paired = ~np.isnan(y)
+    # Centering changes no correlation but keeps the one-pass sums well conditioned
+    y = np.where(paired, y - np.nanmean(y) if paired.any() else 0, 0.0)
+
+    # (metric, window, day) metric values and (metric, window, quantile, day) masks of kept days
+    x = np.array([[daily[metric].rolling(f"{window}D").sum().to_numpy() for window in windows]
+                  for metric in metrics])
+    thresholds = np.moveaxis(np.quantile(x, quantiles, axis=-1), 0, -1)
+    thresholds[..., quantiles == 0] = -np.inf
+    kept = (x[:, :, None, :] > thresholds[..., None]).astype(np.float64)
+    x = x - x.mean(axis=-1, keepdims=True)
+    kept_x = kept * x[:, :, None, :]
+
+    paired = paired.astype(np.float64).T
+    n = kept @ paired
+    sum_x, sum_xx = kept_x @ paired, (kept_x * x[:, :, None, :]) @ paired
+    sum_y, sum_yy, sum_xy = kept @ y.T, kept @ (y * y).T, kept_x @ y.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = (n * sum_xy - sum_x * sum_y) / np.sqrt((n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2))
+    correlation[n < 2] = np.nan
+
+    index = pd.MultiIndex.from_product([metrics, windows, quantiles, lags], names=SWEEP_INDEX)
+    return pd.DataFrame({'n_days': n.ravel().astype(np.int64), 'correlation': correlation.ravel()}, index=index)
+
+
+def setting_pairs(daily, volatility, metric, window, quantile, lag):
+    # Metric and lagged volatility of the days one setting keeps, the way the plotting scripts pick them
+    series = daily[metric].rolling(f"{window}D").sum()
+    if quantile:
+        series = series[series > series.quantile(quantile)]
+    return series.to_numpy(), volatility.reindex(series.index + pd.Timedelta(days=lag)).to_numpy()
+
+
+def single_correlation(daily, volatility, metric, window, quantile, lag):
+    x, y = setting_pairs(daily, volatility, metric, window, quantile, lag)
+    return pd.Series(x).corr(pd.Series(y))
+
+
+def add_significance(sweep, daily, volatility, n_resamples=N_RESAMPLES):
+    """Bootstrap confidence interval and permutation p-value of every setting of a sweep."""
+    results = [correlation_significance(*setting_pairs(daily, volatility, *key), n_resamples=n_resamples)
+               for key in sweep.index]
+    sweep = sweep.copy()
+    for column in ['ci_low', 'ci_high', 'p_value']:
+        sweep[column] = [result[column] for result in results]
+    return sweep
+
+
+def check_sweep(daily, volatility, sweep):
+    """Recompute every grid point one by one and compare with the sweep."""
+    start = time.perf_counter()
+    expected = [single_correlation(daily, volatility, *key) for key in sweep.index]
+    elapsed = time.perf_counter() - start
+    difference = np.abs(np.array(expected) - sweep['correlation'].to_numpy())
+    mismatched_nan = np.isnan(expected) != np.isnan(sweep['correlation'].to_numpy())
+    print(f"one by one {elapsed:.2f}s, largest difference {np.nanmax(difference):.2e}, "
+          f"NaN mismatches {mismatched_nan.sum()}")
+    return np.nanmax(difference) < 1e-9 and not mismatched_nan.any()
+
+
+def load_sweep(path=SWEEP_PATH):
+    return pd.read_csv(path, index_col=SWEEP_INDEX).sort_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Correlate daily volume of top performers with ETH volatility "
+                                                 "over a grid of quantiles, lags and rolling windows")
+    parser.add_argument("--pools", nargs="+", default=POOLS,
+                        help="pools to combine such as WETH_USDT, or 'all' for every pool in pools/")
+    parser.add_argument("--prices", choices=["csv", "swaps"], default="csv",
+                        help="daily USD prices from the price CSV or derived from the swaps")
+    parser.add_argument("--volatility-pool",
+                        help="intraday realized volatility of a pool's swaps, e.g. WETH_USDT, instead of the ETH CSV")
+    parser.add_argument("--quantiles", nargs="+", type=float, default=QUANTILES)
+    parser.add_argument("--windows", nargs="+", type=int, default=WINDOWS, help="rolling windows in days")
+    parser.add_argument("--max-lag", type=int, default=MAX_LAG, help="lags from -max-lag to +max-lag days")
+    parser.add_argument("--output", default=SWEEP_PATH)
+    parser.add_argument("--significance", type=int, metavar="RESAMPLES",
+                        help="add bootstrap CIs and permutation p-values with this many resamples per setting")
+    parser.add_argument("--check", action="store_true", help="compare every grid point with a one by one computation")
+    args = parser.parse_args()
+
+    usdt_prices = load_swap_prices() if args.prices == "swaps" else load_usdt_prices()
+    df = normalize_swaps(load_compact_table(available_pools() if args.pools == ["all"] else args.pools), usdt_prices)
+    with open("top_performers_weth_usdt.txt", "r") as file:
+        positive_addresses = file.read().splitlines()
+
+    daily = daily_metrics(df, positive_addresses)
+    volatility = eth_volatility(args.volatility_pool)
+
+    start = time.perf_counter()
+    sweep = correlation_sweep(daily, volatility, quantiles=args.quantiles, windows=args.windows,
+                              lags=np.arange(-args.max_lag, args.max_lag + 1))
+    print(f"{len(sweep)} settings over {len(daily)} days in {time.perf_counter() - start:.3f}s")
+    if args.significance:
+        start = time.perf_counter()
+        sweep = add_significance(sweep, daily, volatility, args.significance)
+        print(f"significance of {len(sweep)} settings in {time.perf_counter() - start:.2f}s")
+    sweep.to_csv(args.output)
+
+    # Same-day correlation of every metric and quantile without smoothing
+    if 1 in args.windows:
+        print(sweep.xs((1, 0), level=['window', 'lag'])['correlation'].unstack('metric').round(3).to_string())
+
+    if args.check:
+        raise SystemExit(0 if check_sweep(daily, volatility, sweep) else 1)
+
+
+if __name__ == "__main__":
+    main()
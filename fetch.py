@@ -1,6 +1,19 @@
 from sqlalchemy import create_engine
 from sqlalchemy import text
+from eth_abi import decode, encode
+from eth_abi.exceptions import DecodingError
+from web3 import Web3
+from chain_cache import ChainCache
+from pool_catalog import build_entry, pool_name, token_entry, update_catalog
+from token_registry import TokenRegistry
+import argparse
+import queue
+import random
+import requests
+import json
 import os
+import threading
+import time
 
 
 credentials = {
@@ -13,107 +26,638 @@ credentials = {
 
 connection_string = f'postgresql://{credentials["username"]}:{credentials["password"]}@{credentials["public ip"]}:{credentials["port"]}/{credentials["db"]}'
 
-engine = create_engine(connection_string)
-conn = engine.connect()
+RPC_URL = 'https://rpc.ankr.com/eth/fb48370f4a2ef755e5926aff6a70d50399bfa8046830041bb4ffe84678ca1cb8'
+
+# Senders and pool metadata are final once fetched, keep them across runs
+CACHE_PATH = "chain_cache.sqlite"
+
+# Number of JSON-RPC calls packed into a single HTTP request while resolving senders
+RPC_BATCH_SIZE = 100
+
+# HTTP requests per second sent to the node by all workers together
+RPC_RATE_LIMIT = 20
+
+# Failed requests are retried this many times, waiting RPC_BACKOFF seconds before the first retry
+# and twice as long before every next one
+RPC_RETRIES = 5
+RPC_BACKOFF = 1.0
+
+# Multicall3, deployed at the same address on mainnet and most other chains. Calls to it
+# aggregate MULTICALL_SIZE contract calls into one eth_call
+MULTICALL_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL_SIZE = 500
 
-sql_query = conn.execute(text('''
-    SELECT 
-        contract, 
-        ARRAY_AGG(block) AS blocks, 
-        ARRAY_AGG(event_data) AS event_data, 
-        ARRAY_AGG(block_timestamp) AS block_timestamps, 
-        ARRAY_AGG(transaction_hash) AS transaction_hashes
+# Calls that resolve a pool's tokens, and each token's metadata
+POOL_CALLS = ["token0", "token1"]
+TOKEN_CALLS = ["symbol", "name", "decimals"]
+
+# Threads resolving metadata and senders, and windows of contracts waiting between two pipeline stages
+RPC_WORKERS = 4
+QUEUE_SIZE = 4
+
+# Contracts read one after another are enriched together until they hold this many swaps,
+# so a block with swaps of several of them is fetched once for all of them
+WINDOW_SWAPS = 20000
+
+# Swaps row by row, ordered so that every contract arrives as one contiguous run. They are
+# grouped per contract on the client, so the query runs on any database SQLAlchemy speaks to
+SWAPS_QUERY = '''
+    SELECT contract, block, event_data, block_timestamp, transaction_hash
     FROM hackathon_ethereum_events
-    WHERE event_name = 'Swap'
-    GROUP BY contract
-'''))
+    WHERE event_name = 'Swap' {checkpoint_filter}
+    ORDER BY contract, block
+'''
 
-fetched_data = sql_query.fetchall()
+# Contracts whose swaps the other queries return, to resolve their metadata up front
+CONTRACTS_QUERY = '''
+    SELECT DISTINCT contract
+    FROM hackathon_ethereum_events
+    WHERE event_name = 'Swap' {checkpoint_filter}
+'''
 
-sql_query.close()
+# Rows fetched per round-trip from the server-side cursor in --stream mode
+STREAM_BATCH_SIZE = 10000
 
-from web3 import Web3
+POOLS_DIR = "pools"
+
+# Last processed block and output file of every contract, used by --incremental
+CHECKPOINTS_PATH = os.path.join(POOLS_DIR, "checkpoints.json")
+
+# Pool metadata resolved by several RPC workers goes into one token registry file
+metadata_lock = threading.Lock()
+
+
+class RpcError(RuntimeError):
+    """An error answer of the node to a JSON-RPC call."""
+
+
+class RateLimiter:
+    """Spaces the requests of all threads at least 1 / rate seconds apart and counts them."""
+
+    def __init__(self, rate=RPC_RATE_LIMIT):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+            self.requests += 1
+        time.sleep(slot - now)
+
+
+def with_retries(function, limiter=None, retries=RPC_RETRIES, backoff=RPC_BACKOFF):
+    """Call function, waiting for the rate limiter before every attempt.
+
+    Connection errors, HTTP errors such as 429 and error answers of the node are retried
+    with exponential backoff and jitter, anything else (e.g. a reverted call) is raised.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return function()
+        except (requests.RequestException, RpcError) as error:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Retrying in {delay:.1f}s after {type(error).__name__}: {error}")
+            time.sleep(delay)
+
+def load_checkpoints(path=CHECKPOINTS_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def save_checkpoints(checkpoints, path=CHECKPOINTS_PATH):
+    # Write to a temporary file first so a crash never leaves a truncated checkpoint file
+    with open(path + ".tmp", "w") as file:
+        json.dump(checkpoints, file, indent=4)
+    os.replace(path + ".tmp", path)
+
+def checkpoint_query(query, checkpoints=None):
+    """Fill in the query so that only blocks after each contract's checkpoint are selected."""
+    if not checkpoints:
+        return text(query.format(checkpoint_filter=""))
+
+    cases = []
+    params = {}
+    for i, (contract, checkpoint) in enumerate(checkpoints.items()):
+        cases.append(f"WHEN :contract_{i} THEN block > :block_{i}")
+        params[f"contract_{i}"] = contract
+        params[f"block_{i}"] = checkpoint["block"]
+    # Contracts without a checkpoint are new and get their full history
+    checkpoint_filter = f"AND CASE contract {' '.join(cases)} ELSE TRUE END"
+    return text(query.format(checkpoint_filter=checkpoint_filter)).bindparams(**params)
 
-w3 = Web3(Web3.HTTPProvider('https://rpc.ankr.com/eth/fb48370f4a2ef755e5926aff6a70d50399bfa8046830041bb4ffe84678ca1cb8'))
+def group_contracts(rows):
+    """Yield (contract, contract_data) from rows of SWAPS_QUERY, one contract at a time.
 
-def get_pool_data(address):
-    pool_abi = [
-        {"constant": True, "inputs": [], "name": "token0", "outputs": [{"name": "", "type": "address"}], "type": "function"},
-        {"constant": True, "inputs": [], "name": "token1", "outputs": [{"name": "", "type": "address"}], "type": "function"}
+    contract_data holds the contract's (blocks, event_data, block_timestamps, transaction_hashes).
+    """
+    contract, contract_data = None, None
+    for row in rows:
+        if row[0] != contract:
+            if contract_data is not None:
+                yield contract, contract_data
+            contract, contract_data = row[0], ([], [], [], [])
+        for column, value in zip(contract_data, row[1:]):
+            column.append(value)
+
+    if contract_data is not None:
+        yield contract, contract_data
+
+def fetch_swaps(conn, checkpoints=None):
+    """Every (contract, contract_data) at once, see group_contracts."""
+    sql_query = conn.execute(checkpoint_query(SWAPS_QUERY, checkpoints))
+    fetched_data = sql_query.fetchall()
+    sql_query.close()
+    return list(group_contracts(fetched_data))
+
+def stream_swaps(conn, batch_size=STREAM_BATCH_SIZE, checkpoints=None):
+    """Yield (contract, contract_data) one contract at a time from a server-side cursor.
+
+    Rows are pulled batch_size at a time, so client memory holds one batch plus the swaps
+    of the contract currently being collected.
+    """
+    result = conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(checkpoint_query(SWAPS_QUERY, checkpoints))
+    yield from group_contracts(row for batch in iter(lambda: result.fetchmany(batch_size), []) for row in batch)
+    result.close()
+
+def fetch_contracts(conn, checkpoints=None):
+    return [row[0] for row in conn.execute(checkpoint_query(CONTRACTS_QUERY, checkpoints))]
+
+def selector(signature):
+    return Web3.keccak(text=signature)[:4]
+
+def decode_address(data):
+    return Web3.to_checksum_address(data[12:32]) if data and len(data) >= 32 else None
+
+def decode_text(data):
+    # Most tokens return a string, early ones such as MKR a NUL padded bytes32
+    if not data:
+        return ""
+    try:
+        return decode(["string"], data)[0]
+    except DecodingError:
+        return data[:32].rstrip(b"\0").decode("utf-8", "replace")
+
+def decode_uint(data):
+    return decode(["uint256"], data)[0] if data and len(data) >= 32 else None
+
+def multicall(url, calls, limiter=None, session=None, size=MULTICALL_SIZE, batch_size=RPC_BATCH_SIZE):
+    """Run calls without arguments, (address, function name) pairs, through Multicall3.
+
+    Calls are aggregated size at a time into one aggregate3 eth_call, and those eth_calls
+    go batch_size at a time into one JSON-RPC batch, so even 10,000 calls take a single
+    HTTP round-trip. Returns the raw return data of every call, None where it reverted.
+    """
+    encoded = [(Web3.to_checksum_address(address), True, selector(f"{function}()")) for address, function in calls]
+    aggregate3 = selector("aggregate3((address,bool,bytes)[])")
+    eth_calls = [
+        ("eth_call", [{"to": MULTICALL_ADDRESS,
+                       "data": "0x" + (aggregate3 + encode(["(address,bool,bytes)[]"], [encoded[start:start + size]])).hex()},
+                      "latest"])
+        for start in range(0, len(encoded), size)
     ]
-    
-    token_abi = [
-        {
-            "constant": True,
-            "inputs": [],
-            "name": "name",
-            "outputs": [{"name": "", "type": "string"}],
-            "type": "function"
-        },
-        {
-            "constant": True,
-            "inputs": [],
-            "name": "symbol",
-            "outputs": [{"name": "", "type": "string"}],
-            "type": "function"
+
+    returned = []
+    for start in range(0, len(eth_calls), batch_size):
+        for result in with_retries(lambda: rpc_batch(url, eth_calls[start:start + batch_size], session), limiter):
+            (answers,) = decode(["(bool,bytes)[]"], bytes.fromhex(result[2:]))
+            returned.extend(data if success else None for success, data in answers)
+    return returned
+
+def resolve_pool_metadata(url, contracts, cache=None, registry=None, limiter=None):
+    """Tokens of many pools with their symbols, names and decimals, in two rounds of multicalls.
+
+    The first round asks every pool for token0 and token1, the second every new token for
+    symbol, name and decimals, so 1,000 pools take two HTTP round-trips. Pools in the cache
+    and tokens in the registry are not asked again, new ones are added to both. Tokens
+    without a working decimals() get None instead of failing the pool.
+
+    Returns {contract: pool_data} for every contract that has token0 and token1.
+    """
+    registry = TokenRegistry.load() if registry is None else registry
+    found = {}
+    if cache is not None:
+        # Entries cached before token addresses and decimals were recorded are fetched again
+        found = {key: value for key, value in cache.get_many("pools", contracts).items() if "decimals0" in value}
+    wanted = [contract for contract in dict.fromkeys(contract.lower() for contract in contracts)
+              if contract not in found]
+
+    with requests.Session() as session:
+        returned = multicall(url, [(contract, call) for contract in wanted for call in POOL_CALLS], limiter, session)
+        token_addresses = [decode_address(data) for data in returned]
+        new_tokens = registry.missing(address for address in token_addresses if address is not None)
+        returned = multicall(url, [(token, call) for token in new_tokens for call in TOKEN_CALLS], limiter, session)
+    for i, token in enumerate(new_tokens):
+        symbol, name, decimals = returned[len(TOKEN_CALLS) * i:len(TOKEN_CALLS) * (i + 1)]
+        # File names are built from symbols, a token without one is named after its address
+        registry.put(token, decode_text(symbol) or Web3.to_checksum_address(token)[:8], decode_text(name),
+                     decode_uint(decimals))
+    if registry.changed:
+        registry.save()
+
+    resolved = {}
+    for i, contract in enumerate(wanted):
+        token0_address, token1_address = token_addresses[2 * i:2 * i + 2]
+        if token0_address is None or token1_address is None:
+            continue
+        token0, token1 = registry.get(token0_address), registry.get(token1_address)
+        resolved[contract] = {
+            "token0": token0["symbol"],
+            "token1": token1["symbol"],
+            "token0_address": token0_address,
+            "token1_address": token1_address,
+            "decimals0": token0["decimals"],
+            "decimals1": token1["decimals"]
         }
+    if cache is not None and resolved:
+        cache.put_many("pools", resolved)
+    found.update(resolved)
+    return {contract: found[contract.lower()] for contract in contracts if contract.lower() in found}
+
+def get_pool_data(address, cache=None, limiter=None, rpc_url=RPC_URL):
+    """Token symbols, addresses and decimals of one pool, see resolve_pool_metadata."""
+    with metadata_lock:
+        pool_data = resolve_pool_metadata(rpc_url, [address], cache, limiter=limiter).get(address)
+    if pool_data is None:
+        raise ValueError(f"{address} has no token0() and token1(), it is not a Uniswap pool")
+    return pool_data
+
+def rpc_batch(url, calls, session=None):
+    """Send a list of (method, params) pairs as one JSON-RPC batch and return the results in order."""
+    payload = [
+        {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+        for i, (method, params) in enumerate(calls)
     ]
-    
-    pool_contract = w3.eth.contract(address=Web3.to_checksum_address(address), abi=pool_abi)
-    
-    token0_address = pool_contract.functions.token0().call()
-    # For token0
-    token0_contract = w3.eth.contract(address=Web3.to_checksum_address(token0_address), abi=token_abi)
-    token0_name = token0_contract.functions.name().call()
-    token0_symbol = token0_contract.functions.symbol().call()
-    
-    token1_address = pool_contract.functions.token1().call()
-    # For token1
-    token1_contract = w3.eth.contract(address=Web3.to_checksum_address(token1_address), abi=token_abi)
-    token1_name = token1_contract.functions.name().call()
-    token1_symbol = token1_contract.functions.symbol().call()
-    
-    # print(f"Pool: {address} - Token0: {token0_address} - {token0_name} - {token0_symbol}, Token1: {token1_address} - {token1_name} - {token1_symbol}")
-    return {"token0": token0_symbol, "token1": token1_symbol}
+    response = (session or requests).post(url, json=payload, timeout=120)
+    response.raise_for_status()
 
-import json
+    # Servers may answer a batch in any order, match the answers back by id.
+    # A rejected batch, e.g. over a rate limit, gets a single error object instead of a list
+    answers = response.json()
+    if isinstance(answers, dict):
+        raise RpcError(f"RPC error for a batch of {len(calls)} calls: {answers.get('error', answers)}")
+    results = [None] * len(calls)
+    for answer in answers:
+        if "error" in answer:
+            raise RpcError(f"RPC error for {calls[answer['id']]}: {answer['error']}")
+        results[answer["id"]] = answer["result"]
+    return results
+
+def resolve_senders(url, blocks, tx_hashes, batch_size=RPC_BATCH_SIZE, cache=None, limiter=None, verbose=True):
+    """Build a tx_hash -> sender map for all swaps with batched JSON-RPC requests.
+
+    Hashes are grouped by block: blocks holding several swaps are fetched whole with
+    eth_getBlockByNumber, lone swaps with eth_getTransactionByHash. The calls are sent
+    batch_size at a time, so the number of HTTP round-trips is roughly
+    (number of calls) / batch_size instead of one per swap. With a cache only the
+    hashes it doesn't know yet go to the node, and each batch is stored as it arrives.
+    Every batch waits for the limiter and is retried on failure.
+    """
+    senders = {}
+    if cache is not None:
+        senders = cache.get_many("senders", tx_hashes)
+
+    hashes_by_block = {}
+    for block, tx_hash in zip(blocks, tx_hashes):
+        if tx_hash.lower() not in senders:
+            hashes_by_block.setdefault(int(block), set()).add(tx_hash.lower())
+
+    calls = []
+    for block, block_hashes in hashes_by_block.items():
+        if len(block_hashes) > 1:
+            calls.append(("eth_getBlockByNumber", [hex(block), True]))
+        else:
+            calls.extend(("eth_getTransactionByHash", [tx_hash]) for tx_hash in block_hashes)
+
+    wanted = set().union(*hashes_by_block.values())
+    round_trips = 0
+    with requests.Session() as session:
+        for start in range(0, len(calls), batch_size):
+            results = with_retries(lambda: rpc_batch(url, calls[start:start + batch_size], session), limiter)
+            round_trips += 1
+            resolved = {}
+            for result in results:
+                if result is None:
+                    continue
+                # A block result carries its transactions, a transaction result is the transaction itself
+                for tx in result.get("transactions", [result]):
+                    tx_hash = tx["hash"].lower()
+                    if tx_hash in wanted:
+                        resolved[tx_hash] = Web3.to_checksum_address(tx["from"])
+            senders.update(resolved)
+            if cache is not None:
+                cache.put_many("senders", resolved)
 
-for i, contract in enumerate((x[0] for x in fetched_data)):
+    missing = wanted - senders.keys()
+    if missing:
+        raise ValueError(f"Could not resolve the sender of {len(missing)} transactions, e.g. {next(iter(missing))}")
+
+    if verbose:
+        print(f"Resolved {len(wanted)} senders in {round_trips} RPC requests")
+    return senders
+
+def new_pool_filename(pool_data):
+    k = -1
+    filename = f"data_{pool_data['token0']}_{pool_data['token1']}.json"
+    if os.path.exists(os.path.join(POOLS_DIR, filename)):
+        k = 0
+    while os.path.exists(os.path.join(POOLS_DIR, f"data_{pool_data['token0']}_{pool_data['token1']}_{k}.json")):
+        k += 1
+    if (k != -1):
+        filename = f"data_{pool_data['token0']}_{pool_data['token1']}_{k}.json"
+    return filename
+
+def merge_address_data(existing, address_data):
+    # Swaps already in the file are skipped, so re-running after a crash doesn't duplicate them
+    def swap_key(tx):
+        return tx["tx_hash"], str(tx["amount0"]), str(tx["amount1"])
+
+    for user_address, transactions in address_data.items():
+        user_transactions = existing.setdefault(user_address, [])
+        seen = {swap_key(tx) for tx in user_transactions}
+        user_transactions.extend(tx for tx in transactions if swap_key(tx) not in seen)
+    return existing
+
+def write_pool_file(address_data, pool_data, filename=None):
+    """Write the pool's swaps into a new data file, or append them to filename if given."""
+    if filename is None:
+        filename = new_pool_filename(pool_data)
+    path = os.path.join(POOLS_DIR, filename)
+
+    if os.path.exists(path):
+        with open(path) as file:
+            address_data = merge_address_data(json.load(file), address_data)
+
+    with open(path + ".tmp", "w") as file:
+        json.dump(address_data, file, indent=4, default=str)
+    os.replace(path + ".tmp", path)
+    return filename
+
+def build_address_data(contract_data, pool_data, senders):
+    blocks, event_data, block_timestamps, tx_hashes = contract_data
     address_data = {}
-    contract_data = fetched_data[i][1:]
-    
-    pool_data = get_pool_data(contract)
-    
-    for j in range(len(contract_data[0])):
-        tx_hash = contract_data[3][j]
-        user_address = w3.eth.get_transaction_receipt(tx_hash)['from']
-        
+
+    for j in range(len(blocks)):
+        tx_hash = tx_hashes[j]
+        user_address = senders[tx_hash.lower()]
+
+        # Streamed rows from databases without a JSON type carry the event data as text
+        event = event_data[j]
+        if isinstance(event, str):
+            event = json.loads(event)
+
         tx_info = {
             "tx_hash": tx_hash,
             "user_address": user_address,
             "token0": pool_data["token0"],
-            "amount0": contract_data[1][j]["amount0"],
+            "amount0": event["amount0"],
             "token1": pool_data["token1"],
-            "amount1": contract_data[1][j]["amount1"],
-            "timestamp": contract_data[2][j],
-            "pool_liquidity": contract_data[1][j]["liquidity"]
+            "amount1": event["amount1"],
+            "timestamp": block_timestamps[j],
+            "pool_liquidity": event["liquidity"]
         }
-        
+
         if (user_address in address_data):
             address_data[user_address].append(tx_info)
         else:
             address_data[user_address] = [tx_info]
-    
-    k = -1
-    filename = f"data_{pool_data['token0']}_{pool_data['token1']}.json"
-    if os.path.exists(filename):
-        k = 0
-    while os.path.exists(f"data_{pool_data['token0']}_{pool_data['token1']}_{k}.json"):
-        k += 1
-    if (k != -1):
-        filename = f"data_{pool_data['token0']}_{pool_data['token1']}_{k}.json"
-    
-    with open(os.path.join("./pools",filename), "w") as file:
-        json.dump(address_data, file, indent=4, default=str)
-    
-    print(f"Completed {i / (len(fetched_data) - 1) * 100}%/100%")
+    return address_data
+
+def enrich_contracts(contracts, cache, rpc_url=RPC_URL, limiter=None):
+    """Pool metadata and swaps grouped by sender of every (contract, contract_data) in a window.
+
+    The senders of all contracts are resolved in one resolve_senders call, so their swaps
+    share blocks and batches like the swaps of a single contract do.
+    """
+    blocks = [block for _, contract_data in contracts for block in contract_data[0]]
+    tx_hashes = [tx_hash for _, contract_data in contracts for tx_hash in contract_data[3]]
+    senders = resolve_senders(rpc_url, blocks, tx_hashes, cache=cache, limiter=limiter, verbose=False)
+    enriched = []
+    for contract, contract_data in contracts:
+        pool_data = get_pool_data(contract, cache, limiter, rpc_url)
+        enriched.append((pool_data, build_address_data(contract_data, pool_data, senders)))
+    return enriched
+
+def store_contract(contract, blocks, pool_data, address_data, checkpoints, incremental=False):
+    # In incremental mode new swaps extend the contract's existing file instead of starting a new one
+    checkpoint = checkpoints.get(contract) if incremental else None
+    filename = write_pool_file(address_data, pool_data, checkpoint["file"] if checkpoint else None)
+
+    checkpoints[contract] = {"block": max(int(block) for block in blocks), "file": filename}
+    save_checkpoints(checkpoints)
+
+    # Index the written file so the loaders can find its tokens and skip users without parsing them
+    update_catalog({pool_name(filename): build_entry(
+        os.path.join(POOLS_DIR, filename),
+        contract,
+        token_entry(pool_data["token0"], pool_data["token0_address"], pool_data["decimals0"]),
+        token_entry(pool_data["token1"], pool_data["token1_address"], pool_data["decimals1"])
+    )}, POOLS_DIR)
+    return filename
+
+def read_contracts(engine, stream=False, batch_size=STREAM_BATCH_SIZE, checkpoints=None):
+    """Yield (contract, contract_data) from the database, through a server-side cursor with stream."""
+    with engine.connect() as conn:
+        if stream:
+            yield from stream_swaps(conn, batch_size, checkpoints)
+        else:
+            yield from fetch_swaps(conn, checkpoints)
+
+def put_item(items, item, stop):
+    # Wait while the queue is full, but give up as soon as another stage failed
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def get_item(items, stop):
+    # Next item of the queue, or None once another stage failed
+    while not stop.is_set():
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+class Progress:
+    """One line per stored contract: its swaps, the time it spent in every stage and the totals so far.
+
+    rpc is the time of the contract's whole window, shared with the contracts enriched with it.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.start = time.perf_counter()
+        self.contracts = 0
+        self.swaps = 0
+
+    def stored(self, item, filename, waiting):
+        self.contracts += 1
+        self.swaps += len(item["data"][0])
+        elapsed = time.perf_counter() - self.start
+        print(f"[{self.contracts}] {item['contract']}: {len(item['data'][0])} swaps -> {filename} "
+              f"(read {item['read']:.1f}s, rpc {item['rpc']:.1f}s, write {item['write']:.1f}s) | "
+              f"{self.swaps} swaps, {self.limiter.requests} RPC requests ({self.limiter.requests / elapsed:.1f}/s) "
+              f"in {elapsed:.0f}s, waiting {waiting}")
+
+def run_pipeline(contracts, cache, checkpoints, incremental=False, rpc_url=RPC_URL, rpc_workers=RPC_WORKERS,
+                 queue_size=QUEUE_SIZE, rate_limit=RPC_RATE_LIMIT, window_swaps=WINDOW_SWAPS):
+    """Read, enrich and store contracts in concurrent stages joined by bounded queues.
+
+    A reader thread pulls (contract, contract_data) from contracts, e.g. read_contracts,
+    and groups consecutive contracts into windows of about window_swaps swaps. rpc_workers
+    threads resolve pool metadata and the senders of a whole window at a time through one
+    rate limiter shared by all of them, and the calling thread writes pool files,
+    checkpoints and the catalog. So the database, the node and the disk are busy at the
+    same time. Contracts are stored in the order they were read, which keeps file names
+    such as data_WETH_USDT_0.json stable, and at most 2 * queue_size + rpc_workers windows
+    are held at any time. If any stage fails the others stop and the error is raised here.
+    """
+    limiter = RateLimiter(rate_limit)
+    progress = Progress(limiter)
+    to_enrich, to_store = queue.Queue(queue_size), queue.Queue(queue_size)
+    in_flight = threading.Semaphore(2 * queue_size + rpc_workers)
+    stop = threading.Event()
+    errors = []
+
+    def send(window):
+        # The last contract of a window gives its slot back once it is stored
+        window[-1]["window_end"] = True
+        while not in_flight.acquire(timeout=0.1):
+            if stop.is_set():
+                return False
+        return put_item(to_enrich, window, stop)
+
+    def read():
+        try:
+            window, swaps = [], 0
+            start = time.perf_counter()
+            for seq, (contract, contract_data) in enumerate(contracts):
+                window.append({"seq": seq, "contract": contract, "data": contract_data,
+                               "read": time.perf_counter() - start, "window_end": False})
+                swaps += len(contract_data[0])
+                if swaps >= window_swaps:
+                    if not send(window):
+                        return
+                    window, swaps = [], 0
+                start = time.perf_counter()
+            if window and not send(window):
+                return
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+        finally:
+            if hasattr(contracts, "close"):
+                contracts.close()
+            # One end marker per worker
+            for _ in range(rpc_workers):
+                put_item(to_enrich, None, stop)
+
+    def enrich():
+        try:
+            while (window := get_item(to_enrich, stop)) is not None:
+                start = time.perf_counter()
+                enriched = enrich_contracts([(item["contract"], item["data"]) for item in window], cache,
+                                            rpc_url, limiter)
+                elapsed = time.perf_counter() - start
+                for item, (pool_data, address_data) in zip(window, enriched):
+                    item.update(pool_data=pool_data, address_data=address_data, rpc=elapsed)
+                    if not put_item(to_store, item, stop):
+                        return
+            put_item(to_store, None, stop)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+
+    threads = [threading.Thread(target=read, daemon=True)]
+    threads += [threading.Thread(target=enrich, daemon=True) for _ in range(rpc_workers)]
+    for thread in threads:
+        thread.start()
+
+    # Contracts finished out of order wait here until every contract read before them is stored
+    pending, next_seq, finished = {}, 0, 0
+    try:
+        while finished < rpc_workers:
+            item = get_item(to_store, stop)
+            if item is None:
+                if stop.is_set():
+                    break
+                finished += 1
+                continue
+            pending[item["seq"]] = item
+            while next_seq in pending:
+                item = pending.pop(next_seq)
+                start = time.perf_counter()
+                filename = store_contract(item["contract"], item["data"][0], item["pool_data"], item["address_data"],
+                                          checkpoints, incremental)
+                item["write"] = time.perf_counter() - start
+                progress.stored(item, filename, f"{to_enrich.qsize()} to enrich, {to_store.qsize()} to store")
+                next_seq += 1
+                if item["window_end"]:
+                    in_flight.release()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return progress
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch Uniswap swaps and save them per pool into ./pools")
+    parser.add_argument("--stream", action="store_true",
+                        help="read swaps contract by contract through a server-side cursor instead of all at once")
+    parser.add_argument("--batch-size", type=int, default=STREAM_BATCH_SIZE,
+                        help="rows fetched per round-trip in --stream mode")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only fetch blocks after each contract's checkpoint and append them to its file")
+    parser.add_argument("--db-url", help="SQLAlchemy URL of the swaps database instead of the hackathon one, "
+                                         "e.g. sqlite:///events.db")
+    parser.add_argument("--rpc-url", help="JSON-RPC endpoint instead of the default node")
+    parser.add_argument("--rpc-workers", type=int, default=RPC_WORKERS,
+                        help="contracts whose metadata and senders are resolved at the same time")
+    parser.add_argument("--rate-limit", type=float, default=RPC_RATE_LIMIT,
+                        help="HTTP requests per second to the node from all workers, 0 for no limit")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="windows of contracts waiting between two stages of the pipeline")
+    parser.add_argument("--window-swaps", type=int, default=WINDOW_SWAPS,
+                        help="swaps of consecutive contracts whose senders are resolved together")
+    args = parser.parse_args()
+
+    rpc_url = args.rpc_url or RPC_URL
+    engine = create_engine(args.db_url or connection_string)
+    cache = ChainCache(CACHE_PATH)
+    checkpoints = load_checkpoints()
+
+    # Metadata of every contract up front in a few batched round-trips, the workers then find it cached
+    with engine.connect() as conn:
+        contracts = fetch_contracts(conn, checkpoints if args.incremental else None)
+    limiter = RateLimiter(args.rate_limit)
+    metadata = resolve_pool_metadata(rpc_url, contracts, cache, limiter=limiter)
+    print(f"Resolved the tokens of {len(metadata)} of {len(contracts)} contracts in {limiter.requests} RPC requests")
+
+    # In --stream mode only the contracts waiting in the queues are held in memory,
+    # otherwise every swap is read up front and the rest of the pipeline overlaps as usual
+    contracts = read_contracts(engine, args.stream, args.batch_size, checkpoints if args.incremental else None)
+    progress = run_pipeline(contracts, cache, checkpoints, args.incremental, rpc_url, args.rpc_workers,
+                            args.queue_size, args.rate_limit, args.window_swaps)
+    print(f"Stored {progress.contracts} contracts with {progress.swaps} swaps "
+          f"in {time.perf_counter() - progress.start:.0f}s")
+
+    print(cache.report())
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import uuid
+
+import numpy as np
+
+from pool_store import encode_hex
+
+REGISTRY_PATH = "swap_ids.npz"
+
+
+class IdRegistry:
+    """Global int32 ids of user addresses and token symbols, kept on disk across runs.
+
+    Ids are handed out in order of first appearance and never change, so a table built
+    with the registry stays valid as long as the file is kept. Addresses are matched by
+    their raw 20 bytes, whatever the case they were written in, and decode to the string
+    they were first seen as. key changes whenever the file is created anew, caches of
+    id-based tables include it to notice that.
+    """
+
+    def __init__(self, addresses, address_strings, tokens, key=None, path=REGISTRY_PATH):
+        self.addresses = np.asarray(addresses, dtype="S20")
+        self.address_strings = np.asarray(address_strings, dtype="S42")
+        self.tokens = list(tokens)
+        self.key = key or uuid.uuid4().hex
+        self.path = path
+        self.order = np.argsort(self.addresses, kind="stable")
+        self.token_index = {token: i for i, token in enumerate(self.tokens)}
+        self.changed = False
+
+    @classmethod
+    def load(cls, path=REGISTRY_PATH):
+        if not os.path.exists(path):
+            return cls([], [], [], path=path)
+        with np.load(path) as archive:
+            return cls(archive["addresses"], archive["address_strings"], archive["tokens"].tolist(),
+                       str(archive["key"]), path)
+
+    def save(self):
+        # np.savez appends .npz on its own, write to a temporary name and move it in place
+        tmp_path = self.path[:-len(".npz")] + ".tmp.npz"
+        np.savez(tmp_path, addresses=self.addresses, address_strings=self.address_strings,
+                 tokens=np.array(self.tokens, dtype=str), key=np.array(self.key))
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def find_addresses(self, addresses):
+        """Ids of raw S20 addresses, -1 for addresses that were never registered."""
+        addresses = np.asarray(addresses, dtype="S20")
+        if not len(self.addresses):
+            return np.full(len(addresses), -1, dtype=np.int32)
+        positions = np.minimum(np.searchsorted(self.addresses, addresses, sorter=self.order), len(self.order) - 1)
+        ids = self.order[positions]
+        return np.where(self.addresses[ids] == addresses, ids, -1).astype(np.int32)
+
+    def address_ids(self, addresses, strings):
+        """Ids of raw S20 addresses, registering unseen ones with the matching entry of strings."""
+        addresses = np.asarray(addresses, dtype="S20")
+        unique, first, inverse = np.unique(addresses, return_index=True, return_inverse=True)
+        ids = self.find_addresses(unique)
+        new = ids < 0
+        if new.any():
+            ids[new] = np.arange(len(self.addresses), len(self.addresses) + new.sum())
+            self.addresses = np.concatenate([self.addresses, unique[new]])
+            self.address_strings = np.concatenate([self.address_strings,
+                                                   np.asarray(strings, dtype="S42")[first[new]]])
+            self.order = np.argsort(self.addresses, kind="stable")
+            self.changed = True
+        return ids[inverse]
+
+    def user_ids(self, address_strings):
+        """Ids of address strings such as the top performer list, -1 for unknown addresses."""
+        return self.find_addresses(encode_hex(address_strings, 20))
+
+    def token_ids(self, symbols):
+        ids = []
+        for symbol in symbols:
+            if symbol not in self.token_index:
+                self.token_index[symbol] = len(self.tokens)
+                self.tokens.append(symbol)
+                self.changed = True
+            ids.append(self.token_index[symbol])
+        return np.array(ids, dtype=np.int32)
+
+    def decode_addresses(self, ids):
+        return self.address_strings.astype(str).astype(object)[ids]
+
+    def decode_tokens(self, ids):
+        return np.array(self.tokens, dtype=object)[ids]
+
+    def __len__(self):
+        return len(self.addresses)
@@ -0,0 +1,430 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from amounts import TokenAmounts
+from pnl_engine import compute_user_pnl, is_active, pnl_pass
+from pool_store import columnar_path, split_big_ints
+from price_index import STABLECOINS
+from profiling import peak_rss_mb
+from swap_table import (POOLS_DIR, available_pools, load_swap_table, load_usdt_prices, pool_path, pool_tokens,
+                        token_decimals)
+
+# Rows of a spilled run, sorted by (partition, user, timestamp, seq). seq numbers every swap by
+# its pool and row, so ties are broken in the order the in-memory path concatenates them.
+RUN_DTYPES = {
+    'user': 'S42',
+    'timestamp': np.int64,
+    'seq': np.int64,
+    'token0': np.int16,
+    'token1': np.int16,
+    'amount0': np.float64,
+    'amount1': np.float64,
+    'price0': np.float64,
+    'price1': np.float64,
+    'day': np.int64,
+}
+ROW_BYTES = sum(np.dtype(dtype).itemsize for dtype in RUN_DTYPES.values())
+
+# Working copies per buffered row: chunk, concatenation, sort order and the pass's Python lists
+MEMORY_OVERHEAD = 8
+# A parsed JSON swap record is a dict of Python objects, far bigger than its row
+JSON_RECORD_BYTES = 2000
+JSON_BLOCK_SIZE = 1 << 20
+SEQ_BITS = 40
+MIN_BLOCK_ROWS = 256
+
+DEFAULT_MEMORY_LIMIT = "1G"
+PARTITIONS = 16
+
+HEX_VALUES = np.zeros(256, dtype=np.int64)
+for i, char in enumerate("0123456789abcdef"):
+    HEX_VALUES[ord(char)] = HEX_VALUES[ord(char.upper())] = i
+
+
+def parse_size(size):
+    """Bytes in a size such as 1G, 512M or 1048576."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def iter_json_records(json_path, block_size=JSON_BLOCK_SIZE):
+    """Yield the swap records of a pool JSON file one at a time, reading it in blocks.
+
+    The file is a single object mapping user addresses to lists of swaps, as written by fetch.py.
+    Each record is decoded as soon as it is complete, so memory stays at about one block.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path) as file:
+        buffer, position = "", 0
+
+        def next_char():
+            # Next non-blank character, reading further into the file as needed
+            nonlocal buffer, position
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n":
+                    position += 1
+                if position < len(buffer):
+                    return buffer[position]
+                buffer, position = file.read(block_size), 0
+                if not buffer:
+                    return ""
+
+        def next_value():
+            nonlocal buffer, position
+            while True:
+                try:
+                    value, position = decoder.raw_decode(buffer, position)
+                    return value
+                except json.JSONDecodeError:
+                    more = file.read(block_size)
+                    if not more:
+                        raise
+                    buffer, position = buffer[position:] + more, 0
+
+        def expect(char):
+            nonlocal position
+            if next_char() != char:
+                raise ValueError(f"Expected {char!r} in {json_path}")
+            position += 1
+
+        expect("{")
+        while True:
+            char = next_char()
+            if char == "}":
+                return
+            if char == ",":
+                position += 1
+                continue
+            next_value()  # user address
+            expect(":")
+            expect("[")
+            while True:
+                char = next_char()
+                if char == "]":
+                    position += 1
+                    break
+                if char == ",":
+                    position += 1
+                    continue
+                yield next_value()
+
+
+def iter_json_chunks(json_path, chunk_rows, token_ids):
+    records = []
+    for record in iter_json_records(json_path):
+        records.append(record)
+        if len(records) == chunk_rows:
+            yield json_chunk(records, token_ids)
+            records = []
+    if records:
+        yield json_chunk(records, token_ids)
+
+
+def json_chunk(records, token_ids):
+    chunk = {
+        'user': np.array([tx['user_address'] for tx in records], dtype='S42'),
+        'timestamp': (pd.to_datetime([tx['timestamp'] for tx in records], format='ISO8601').values
+                      .astype('datetime64[s]').astype(np.int64)),
+        'token0': np.array([token_ids[tx['token0']] for tx in records], dtype=np.int16),
+        'token1': np.array([token_ids[tx['token1']] for tx in records], dtype=np.int16),
+    }
+    for column in ['amount0', 'amount1']:
+        chunk[f'{column}_hi'], chunk[f'{column}_lo'] = split_big_ints([tx[column] for tx in records])
+    return chunk
+
+
+def open_array(file):
+    """Read the header of a .npy stream and return its dtype and length, leaving file at the data."""
+    version = np.lib.format.read_magic(file)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, _, dtype = read_header(file)
+    return dtype, shape[0]
+
+
+def read_rows(file, dtype, count):
+    return np.frombuffer(file.read(count * dtype.itemsize), dtype=dtype)
+
+
+def iter_npz_chunks(npz_path, chunk_rows, token_ids):
+    """Read a columnar pool file chunk by chunk, every column member streamed in step."""
+    columns = ['user_address', 'timestamp', 'token0', 'token1',
+               'amount0_hi', 'amount0_lo', 'amount1_hi', 'amount1_lo']
+    with zipfile.ZipFile(npz_path) as archive:
+        # Small per-pool tables are read whole, the per-swap columns in chunks
+        with archive.open("tokens.npy") as file:
+            tokens = np.lib.format.read_array(file)
+        with archive.open("address_table.npy") as file:
+            address_table = np.lib.format.read_array(file)
+        with archive.open("address_strings.npy") as file:
+            address_strings = np.lib.format.read_array(file)
+        local_tokens = np.array([token_ids[token] for token in tokens.astype(str)], dtype=np.int16)
+
+        files = {column: archive.open(f"{column}.npy") for column in columns}
+        try:
+            headers = {column: open_array(file) for column, file in files.items()}
+            remaining = headers['timestamp'][1]
+            while remaining:
+                count = min(chunk_rows, remaining)
+                raw = {column: read_rows(files[column], headers[column][0], count) for column in columns}
+                remaining -= count
+                yield {
+                    'user': address_strings[np.searchsorted(address_table, raw['user_address'])],
+                    'timestamp': raw['timestamp'],
+                    'token0': local_tokens[raw['token0']],
+                    'token1': local_tokens[raw['token1']],
+                    'amount0_hi': raw['amount0_hi'], 'amount0_lo': raw['amount0_lo'],
+                    'amount1_hi': raw['amount1_hi'], 'amount1_lo': raw['amount1_lo'],
+                }
+        finally:
+            for file in files.values():
+                file.close()
+
+
+def iter_pool_chunks(json_path, chunk_rows, json_chunk_rows, token_ids):
+    # The columnar copy when it is up to date, like load_pool_frame, else the JSON itself
+    npz_path = columnar_path(json_path)
+    if os.path.exists(npz_path) and os.path.getmtime(npz_path) >= os.path.getmtime(json_path):
+        return iter_npz_chunks(npz_path, chunk_rows, token_ids)
+    return iter_json_chunks(json_path, json_chunk_rows, token_ids)
+
+
+def priced_chunk(chunk, decimals, first_row, pool_index, tokens, usdt_prices):
+    """Scale, filter and price one raw chunk into run rows, like load_pool_data and add_usdt_prices."""
+    amount0 = TokenAmounts.from_hi_lo(chunk['amount0_hi'], chunk['amount0_lo'], decimals[0])
+    amount1 = TokenAmounts.from_hi_lo(chunk['amount1_hi'], chunk['amount1_lo'], decimals[1])
+    # The zero filter is exact, the run files store float64 amounts like the compact swap table
+    keep = (amount0 != 0) & (amount1 != 0)
+
+    timestamps = pd.to_datetime(chunk['timestamp'][keep], unit='s')
+    symbols = np.asarray(tokens, dtype=object)
+    rows = {
+        'user': chunk['user'][keep],
+        'timestamp': chunk['timestamp'][keep],
+        'seq': (pool_index << SEQ_BITS) + first_row + np.flatnonzero(keep),
+        'token0': chunk['token0'][keep],
+        'token1': chunk['token1'][keep],
+        'amount0': amount0.to_float()[keep],
+        'amount1': amount1.to_float()[keep],
+        'price0': usdt_prices.lookup(symbols[chunk['token0'][keep]], timestamps),
+        'price1': usdt_prices.lookup(symbols[chunk['token1'][keep]], timestamps),
+        'day': usdt_prices.day_columns(timestamps),
+    }
+    return {column: np.asarray(rows[column], dtype=dtype) for column, dtype in RUN_DTYPES.items()}
+
+
+def user_partitions(users, partitions):
+    # Addresses are uniformly random, their last four hex digits spread users evenly
+    digits = HEX_VALUES[users.view(np.uint8).reshape(-1, 42)[:, -4:]]
+    return (digits @ np.array([4096, 256, 16, 1])) % partitions
+
+
+def spill_run(rows, run_dir, partitions):
+    """Sort buffered rows by (partition, user, timestamp, seq) and write them as one run."""
+    partition = user_partitions(rows['user'], partitions)
+    order = np.lexsort((rows['seq'], rows['timestamp'], rows['user'], partition))
+    path = os.path.join(run_dir, f"run_{len(os.listdir(run_dir)):05d}")
+    os.makedirs(path)
+    for column in RUN_DTYPES:
+        np.save(os.path.join(path, f"{column}.npy"), rows[column][order])
+    offsets = np.searchsorted(partition[order], np.arange(partitions + 1))
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    return path
+
+
+def concat_rows(parts):
+    return {column: np.concatenate([part[column] for part in parts]) for column in RUN_DTYPES}
+
+
+def spill_runs(pools, usdt_prices, tokens, run_dir, spill_rows, partitions, pools_dir=POOLS_DIR):
+    """Stream every pool in chunks and spill sorted runs of at most spill_rows rows to run_dir."""
+    token_ids = {token: i for i, token in enumerate(tokens)}
+    json_chunk_rows = max(MIN_BLOCK_ROWS, spill_rows * ROW_BYTES // JSON_RECORD_BYTES)
+    runs, buffered, buffered_rows = [], [], 0
+    for pool_index, pool in enumerate(pools):
+        first_row, decimals = 0, token_decimals(pool, pools_dir)
+        for chunk in iter_pool_chunks(pool_path(pool, pools_dir), spill_rows, json_chunk_rows, token_ids):
+            rows = priced_chunk(chunk, decimals, first_row, pool_index, tokens, usdt_prices)
+            first_row += len(chunk['timestamp'])
+            buffered.append(rows)
+            buffered_rows += len(rows['seq'])
+            if buffered_rows >= spill_rows:
+                runs.append(spill_run(concat_rows(buffered), run_dir, partitions))
+                buffered, buffered_rows = [], 0
+    if buffered_rows:
+        runs.append(spill_run(concat_rows(buffered), run_dir, partitions))
+    return runs
+
+
+def merge_partition(runs, partition, block_rows):
+    """Yield the rows of one partition from all runs in (user, timestamp, seq) order.
+
+    A block of every run is kept in memory. Everything up to the smallest last key among
+    the runs with rows left on disk is final and emitted, and the runs whose loaded rows
+    are all emitted read their next block. Memory stays at about two blocks per run.
+    """
+    files, remaining = [], []
+    for run in runs:
+        start, stop = np.load(os.path.join(run, "offsets.npy"))[[partition, partition + 1]]
+        run_files = {}
+        for column in RUN_DTYPES:
+            file = open(os.path.join(run, f"{column}.npy"), "rb")
+            dtype, _ = open_array(file)
+            file.seek(start * dtype.itemsize, os.SEEK_CUR)
+            run_files[column] = file
+        files.append(run_files)
+        remaining.append(int(stop - start))
+
+    try:
+        pending = {column: np.zeros(0, dtype=dtype) for column, dtype in RUN_DTYPES.items()}
+        last_seq = [None] * len(runs)
+        refill = list(range(len(runs)))
+        while True:
+            parts = [pending]
+            for run in refill:
+                if remaining[run]:
+                    count = min(block_rows, remaining[run])
+                    block = {column: read_rows(file, np.dtype(RUN_DTYPES[column]), count)
+                             for column, file in files[run].items()}
+                    remaining[run] -= count
+                    last_seq[run] = block['seq'][-1]
+                    parts.append(block)
+            rows = concat_rows(parts)
+            order = np.lexsort((rows['seq'], rows['timestamp'], rows['user']))
+            rows = {column: values[order] for column, values in rows.items()}
+
+            active = [run for run in range(len(runs)) if remaining[run]]
+            if not active:
+                if len(rows['seq']):
+                    yield rows
+                return
+
+            positions = {run: np.flatnonzero(rows['seq'] == last_seq[run])[0] for run in active}
+            bound = min(positions.values())
+            yield {column: values[:bound + 1] for column, values in rows.items()}
+            pending = {column: values[bound + 1:] for column, values in rows.items()}
+            refill = [run for run in active if positions[run] <= bound]
+    finally:
+        for run_files in files:
+            for file in run_files.values():
+                file.close()
+
+
+def stream_pnl(blocks, tokens, is_usd, price_rows, usdt_prices):
+    """Run pnl_pass over sorted blocks, carrying the running state of users split across blocks."""
+    users, profits, buys, sells, volumes = [], [], [], [], []
+    carry_user, carry_state = None, None
+    for rows in blocks:
+        block_users = rows['user']
+        starts = np.flatnonzero(np.r_[True, block_users[1:] != block_users[:-1]])
+        states = [None] * len(starts)
+        if block_users[0] == carry_user:
+            # The last user of the previous block goes on, drop its provisional result
+            states[0] = carry_state
+            for column in (users, profits, buys, sells, volumes):
+                column.pop()
+
+        columns = {'token0': rows['token0'].tolist(), 'token1': rows['token1'].tolist(),
+                   'amount0': rows['amount0'].tolist(), 'amount1': rows['amount1'].tolist(),
+                   'price0': rows['price0'].tolist(), 'price1': rows['price1'].tolist(),
+                   'day': rows['day'].tolist()}
+        block_profits, block_buys, block_sells, block_volumes = pnl_pass(
+            columns, np.r_[starts, len(block_users)].tolist(), tokens, is_usd, price_rows,
+            usdt_prices.prices, usdt_prices.fill, states)
+
+        users.extend(block_users[starts].tolist())
+        profits.extend(block_profits)
+        buys.extend(block_buys)
+        sells.extend(block_sells)
+        volumes.extend(block_volumes)
+        carry_user, carry_state = block_users[-1], states[-1]
+
+    return pd.DataFrame({
+        'user_address': pd.Series([user.decode() for user in users], dtype=object),
+        'profit_in_usdt': np.array(profits, dtype=np.float64),
+        'buys': np.array(buys, dtype=np.int64),
+        'sells': np.array(sells, dtype=np.int64),
+        'volume_traded': pd.Series(volumes, dtype=object),
+    })
+
+
+def out_of_core_user_pnl(pools, usdt_prices, memory_limit=DEFAULT_MEMORY_LIMIT, min_buys=None, min_sells=None,
+                         partitions=PARTITIONS, work_dir=None, pools_dir=POOLS_DIR):
+    """Per-user PnL table like compute_user_pnl, with the swaps never all in memory at once.
+
+    Pools are streamed in chunks into sorted runs of at most memory_limit worth of rows,
+    spilled to a temporary directory in work_dir. Each user partition is then k-way merged
+    from all runs and walked user by user, so memory is set by memory_limit and not by the
+    number of swaps. Only the result table, one row per user, grows with the input.
+    """
+    budget = parse_size(memory_limit)
+    spill_rows = max(MIN_BLOCK_ROWS, budget // (ROW_BYTES * MEMORY_OVERHEAD))
+    tokens = sorted({token for pool in pools for token in pool_tokens(pool)})
+    is_usd = [token in STABLECOINS for token in tokens]
+    price_rows = usdt_prices.token_rows(tokens).tolist()
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as run_dir:
+        runs = spill_runs(pools, usdt_prices, tokens, run_dir, spill_rows, partitions, pools_dir)
+        # Two blocks per run in memory during the merge
+        block_rows = max(MIN_BLOCK_ROWS, spill_rows // max(1, 2 * len(runs)))
+        results = [stream_pnl(merge_partition(runs, partition, block_rows), tokens, is_usd, price_rows, usdt_prices)
+                   for partition in range(partitions)]
+
+    results = pd.concat(results, ignore_index=True).sort_values('user_address').reset_index(drop=True)
+    if min_buys is not None or min_sells is not None:
+        results = results[is_active(results['buys'], results['sells'], min_buys, min_sells)].reset_index(drop=True)
+    return results
+
+
+def check_out_of_core(memory_limit="1M", partitions=4):
+    """Compare the out-of-core path with compute_user_pnl on every bundled pool."""
+    pools = available_pools()
+    usdt_prices = load_usdt_prices()
+
+    start = time.perf_counter()
+    streamed = out_of_core_user_pnl(pools, usdt_prices, memory_limit, partitions=partitions)
+    streamed_time = time.perf_counter() - start
+
+    swaps = load_swap_table(pools)
+    swaps = swaps[(swaps['amount0'] != 0) & (swaps['amount1'] != 0)]
+    for leg in ["0", "1"]:
+        for token in swaps[f'token{leg}'].unique():
+            swaps[f'amount{leg}_{token}'] = swaps[f'amount{leg}'].where(swaps[f'token{leg}'] == token)
+    in_memory = compute_user_pnl(swaps.reset_index(drop=True), usdt_prices)
+
+    identical = streamed.equals(in_memory)
+    print(f"{len(swaps)} swaps, {len(streamed)} users, out-of-core {streamed_time:.2f}s with {memory_limit}, "
+          f"identical to in-memory: {identical}")
+    return identical
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-user PnL over pools that don't fit in memory")
+    parser.add_argument("pools", nargs="*", help="pools such as WETH_USDT, every pool with known decimals by default")
+    parser.add_argument("--memory-limit", default=DEFAULT_MEMORY_LIMIT, help="memory for buffered swaps, e.g. 1G")
+    parser.add_argument("--partitions", type=int, default=PARTITIONS, help="user partitions merged one at a time")
+    parser.add_argument("--work-dir", help="directory for the spilled runs, the system temp dir by default")
+    parser.add_argument("--check", action="store_true",
+                        help="compare with the in-memory engine on the bundled pools with a tiny memory limit")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_out_of_core() else 1)
+
+    start = time.perf_counter()
+    results = out_of_core_user_pnl(args.pools or available_pools(), load_usdt_prices(), args.memory_limit,
+                                   partitions=args.partitions, work_dir=args.work_dir)
+    print(f"{len(results)} users in {time.perf_counter() - start:.2f}s, peak RSS {peak_rss_mb():.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,732 @@
+import argparse
+import heapq
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from price_index import STABLECOINS
+from profiling import count, is_profiling, stage
+
+# Per-swap arrays produced by prepare_swaps and walked by pnl_pass
+SWAP_COLUMNS = ['token0', 'token1', 'amount0', 'amount1', 'price0', 'price1', 'day']
+
+# Below this many swaps the serial pass beats a process pool: on one core the pool costs
+# about 0.15s to start plus 0.9x the serial time again to gather shards and pickle results,
+# so even 4 cores only win above roughly 150k swaps
+MIN_PARALLEL_SWAPS = 250000
+
+# Per-user running state kept between incremental runs, and its arrays besides the metadata
+PNL_STATE_PATH = "pnl_state.npz"
+STATE_COLUMNS = ['users', 'total', 'profit', 'buys', 'sells', 'last_timestamp',
+                 'holding_user', 'token', 'balance', 'bought_day', 'volume']
+
+
+def scaled_amounts(df, leg):
+    # load_pool_data keeps one amount0_<TOKEN> column per token, pick each row's own token
+    amounts = np.full(len(df), np.nan)
+    tokens = df[f'token{leg}'].to_numpy()
+    for token in pd.unique(tokens):
+        mask = tokens == token
+        amounts[mask] = df[f'amount{leg}_{token}'].to_numpy()[mask]
+    return amounts
+
+
+def prepare_swaps(df, usdt_prices):
+    """Turn the swap table into contiguous arrays sorted by (user, timestamp).
+
+    Returns a dict of plain lists and arrays: token ids, scaled amounts, USDT prices and
+    day columns per swap, the start offset of every user's run of swaps, and per token
+    its symbol, whether it is a stablecoin and its row in the price matrix.
+    """
+    df = df.sort_values(['user_address', 'timestamp'], kind='mergesort')
+
+    tokens, token_codes = np.unique(np.concatenate([df['token0'].to_numpy(), df['token1'].to_numpy()]),
+                                    return_inverse=True)
+    token0, token1 = np.split(token_codes.reshape(-1), 2)
+
+    if 'price0_usdt' in df:
+        price0, price1 = df['price0_usdt'].to_numpy(), df['price1_usdt'].to_numpy()
+    else:
+        price0 = usdt_prices.lookup(df['token0'], df['timestamp'])
+        price1 = usdt_prices.lookup(df['token1'], df['timestamp'])
+
+    users = df['user_address'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.array([], dtype=int)
+
+    return {
+        'users': users[starts],
+        'starts': np.r_[starts, len(users)],
+        'token0': token0,
+        'token1': token1,
+        'amount0': scaled_amounts(df, 0),
+        'amount1': scaled_amounts(df, 1),
+        'price0': price0,
+        'price1': price1,
+        'day': usdt_prices.day_columns(df['timestamp']),
+        'tokens': list(tokens),
+        'is_usd': [token in STABLECOINS for token in tokens],
+        'price_rows': usdt_prices.token_rows(tokens),
+    }
+
+
+def pnl_pass(columns, starts, tokens, is_usd, price_rows, prices, fill, states=None):
+    """Single pass over contiguous swap columns with the calculate_user_perfomance logic.
+
+    columns holds plain lists (token0, token1, amount0, amount1, price0, price1, day) and
+    starts the offset of every user's run of rows plus the end offset. Returns the realized
+    USDT profit, buy and sell counts and per-token volume of each user, before any
+    activity filter.
+
+    states, if given, holds per user the running state to resume from (or None) and is
+    updated in place with the state after the user's swaps, before the final valuation.
+    """
+    token0s, token1s = columns['token0'], columns['token1']
+    amount0s, amount1s = columns['amount0'], columns['amount1']
+    price0s, price1s = columns['price0'], columns['price1']
+    days = columns['day']
+    skip_missing = fill == "skip"
+    n_days = prices.shape[1]
+
+    profits, buys, sells, volumes = [], [], [], []
+    for user in range(len(starts) - 1):
+        state = states[user] if states is not None else None
+        if state is None:
+            total = 0
+            balances = {}
+            bought_day = {}
+            token_volumes = {}
+            n_buys = n_sells = 0
+        else:
+            total = state['total']
+            balances = dict(state['balances'])
+            bought_day = dict(state['bought_day'])
+            token_volumes = dict(state['token_volumes'])
+            n_buys, n_sells = state['buys'], state['sells']
+
+        for i in range(starts[user], starts[user + 1]):
+            p0, p1 = price0s[i], price1s[i]
+            if skip_missing and (p0 != p0 or p1 != p1):
+                continue  # Skip this transaction if either price is missing (NaN != NaN)
+
+            t0, t1 = token0s[i], token1s[i]
+            a0, a1 = amount0s[i], amount1s[i]
+            if t0 not in balances:
+                balances[t0] = 0
+                bought_day[t0] = None
+            if t1 not in balances:
+                balances[t1] = 0
+                bought_day[t1] = None
+            if t0 not in token_volumes:
+                token_volumes[t0] = 0
+            if t1 not in token_volumes:
+                token_volumes[t1] = 0
+            token_volumes[t0] += abs(a0)
+            token_volumes[t1] += abs(a1)
+
+            if a0 < 0:  # Bought token0 using token1
+                n_buys += 1
+                bought_day[t0] = days[i]
+                if is_usd[t0]:
+                    total += abs(a0)
+                else:
+                    balances[t0] += abs(a0)
+                if is_usd[t1]:
+                    total -= a1 * p1
+                else:
+                    sell_amount = min(a1, balances[t1])
+                    total += sell_amount * p1
+                    balances[t1] -= sell_amount
+                    total -= (a1 - sell_amount) * p1
+            else:  # Sold token0 to get token1
+                n_sells += 1
+                bought_day[t1] = days[i]
+                if is_usd[t1]:
+                    total += abs(a1)
+                else:
+                    balances[t1] += abs(a1)
+                if is_usd[t0]:
+                    total -= a0
+                else:
+                    sell_amount = min(a0, balances[t0])
+                    total += sell_amount * p0
+                    balances[t0] -= sell_amount
+                    total -= (a0 - sell_amount) * p0
+
+        if states is not None:
+            states[user] = {'total': total, 'balances': balances, 'bought_day': bought_day,
+                            'token_volumes': token_volumes, 'buys': n_buys, 'sells': n_sells}
+
+        # Value what is left at the price of the day it was last bought
+        for token, balance in balances.items():
+            if balance > 0:
+                row, day = price_rows[token], bought_day[token]
+                if fill == "previous":
+                    day = min(day, n_days - 1)
+                last_price = prices[row, day] if row >= 0 and 0 <= day < n_days else np.nan
+                total += balance * last_price
+
+        profits.append(total)
+        buys.append(n_buys)
+        sells.append(n_sells)
+        volumes.append({tokens[token]: volume for token, volume in token_volumes.items()})
+
+    return profits, buys, sells, volumes
+
+
+def gather_users(swaps, user_indices):
+    # Copy the rows of the given users into local lists with their own start offsets
+    starts = swaps['starts']
+    first, lengths = starts[user_indices], starts[user_indices + 1] - starts[user_indices]
+    local_starts = np.r_[0, np.cumsum(lengths)]
+    rows = np.repeat(first - local_starts[:-1], lengths) + np.arange(local_starts[-1])
+    columns = {key: swaps[key][rows].tolist() for key in SWAP_COLUMNS}
+    return columns, local_starts.tolist()
+
+
+def share_arrays(arrays):
+    """Copy arrays into named shared memory blocks, returning the blocks and attach specs."""
+    blocks, specs = [], {}
+    for key, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[key] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    blocks, arrays = [], {}
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return blocks, arrays
+
+
+def pnl_shard(specs, user_indices, tokens, is_usd, price_rows, fill):
+    # Runs in a worker process: the swap columns and the price matrix are read from shared memory
+    blocks, arrays = attach_arrays(specs)
+    try:
+        columns, starts = gather_users(arrays, user_indices)
+        return user_indices, pnl_pass(columns, starts, tokens, is_usd, price_rows, arrays['prices'], fill)
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+
+
+def shard_users(users, n_shards):
+    """Deterministically assign users to shards by a hash of their address."""
+    shard_ids = pd.util.hash_array(np.asarray(users, dtype=object)) % np.uint64(n_shards)
+    return [np.flatnonzero(shard_ids == shard) for shard in range(n_shards)]
+
+
+def run_pnl_parallel(swaps, usdt_prices, workers):
+    """Run pnl_pass over hash-sharded users in a process pool.
+
+    The swap columns and the price matrix are placed in shared memory once, workers
+    attach to them by name and receive only their shard's user indices. Shard results
+    are put back in user order, so the output is identical to the serial run.
+    """
+    n_users = len(swaps['users'])
+    arrays = {key: np.ascontiguousarray(swaps[key]) for key in SWAP_COLUMNS + ['starts']}
+    arrays['prices'] = usdt_prices.prices
+    blocks, specs = share_arrays(arrays)
+
+    profits, buys, sells, volumes = [None] * n_users, [0] * n_users, [0] * n_users, [None] * n_users
+    try:
+        # A few shards per worker evens out users with very different swap counts
+        shards = [shard for shard in shard_users(swaps['users'], workers * 4) if len(shard)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(pnl_shard, specs, shard, swaps['tokens'], swaps['is_usd'],
+                                swaps['price_rows'].tolist(), usdt_prices.fill)
+                for shard in shards
+            ]
+            for future in futures:
+                user_indices, (shard_profits, shard_buys, shard_sells, shard_volumes) = future.result()
+                for j, user in enumerate(user_indices.tolist()):
+                    profits[user], buys[user] = shard_profits[j], shard_buys[j]
+                    sells[user], volumes[user] = shard_sells[j], shard_volumes[j]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return profits, buys, sells, volumes
+
+
+def run_pnl(swaps, usdt_prices, workers=1):
+    """Per-user PnL table for prepared swaps, serially or over several worker processes."""
+    if workers > 1:
+        profits, buys, sells, volumes = run_pnl_parallel(swaps, usdt_prices, workers)
+    else:
+        # Plain Python lists are much faster to walk element by element than NumPy arrays
+        columns = {key: swaps[key].tolist() for key in SWAP_COLUMNS}
+        profits, buys, sells, volumes = pnl_pass(columns, swaps['starts'].tolist(), swaps['tokens'],
+                                                 swaps['is_usd'], swaps['price_rows'].tolist(),
+                                                 usdt_prices.prices, usdt_prices.fill)
+
+    return pd.DataFrame({
+        'user_address': swaps['users'],
+        'profit_in_usdt': np.array(profits, dtype=np.float64),
+        'buys': np.array(buys, dtype=np.int64),
+        'sells': np.array(sells, dtype=np.int64),
+        'volume_traded': pd.Series(volumes, dtype=object),
+    })
+
+
+def activity_counts(swaps, skip_missing=True):
+    """Buy and sell counts of every user in one vectorized pass, without pricing anything.
+
+    A swap is a buy when amount0 < 0 and a sell otherwise. Swaps that the PnL pass would
+    skip for a missing price are not counted, so the counts match the pass exactly.
+    """
+    counted = np.ones(len(swaps['amount0']), dtype=bool)
+    if skip_missing:
+        counted = ~(np.isnan(swaps['price0']) | np.isnan(swaps['price1']))
+    is_buy = (swaps['amount0'] < 0) & counted
+    is_sell = (swaps['amount0'] >= 0) & counted
+
+    offsets = swaps['starts'][:-1]
+    if not len(offsets):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.add.reduceat(is_buy, offsets).astype(np.int64), np.add.reduceat(is_sell, offsets).astype(np.int64)
+
+
+def select_users(swaps, user_indices):
+    """Prepared swaps restricted to the given users, keeping them contiguous and in order."""
+    starts = swaps['starts']
+    lengths = starts[user_indices + 1] - starts[user_indices]
+    new_starts = np.r_[0, np.cumsum(lengths)]
+    rows = np.repeat(starts[user_indices] - new_starts[:-1], lengths) + np.arange(new_starts[-1])
+
+    selected = dict(swaps)
+    selected.update({key: swaps[key][rows] for key in SWAP_COLUMNS})
+    selected['users'] = swaps['users'][user_indices]
+    selected['starts'] = new_starts
+    return selected
+
+
+def is_active(buys, sells, min_buys=None, min_sells=None):
+    return (buys > (min_buys if min_buys is not None else -1)) & (sells > (min_sells if min_sells is not None else -1))
+
+
+def parallel_workers(workers, n_swaps, min_swaps=MIN_PARALLEL_SWAPS):
+    # Worker processes worth starting: none below the size cutoff or on a single core
+    if n_swaps < min_swaps:
+        return 1
+    return max(1, min(workers, os.cpu_count() or 1))
+
+
+def compute_user_pnl(df, usdt_prices, workers=1, min_buys=None, min_sells=None):
+    """Per-user PnL table, optionally only for users with more than min_buys buys and min_sells sells.
+
+    The activity filter runs before any pricing, so inactive users are never walked.
+    workers is an upper bound, small inputs and single-core machines run serially.
+    """
+    with stage("prepare_swaps", rows_in=len(df)) as prepared:
+        swaps = prepare_swaps(df, usdt_prices)
+        prepared.rows_out = len(swaps['users'])
+    if usdt_prices.skip_missing and is_profiling():
+        count("skipped_swaps", (np.isnan(swaps['price0']) | np.isnan(swaps['price1'])).sum())
+    if min_buys is not None or min_sells is not None:
+        with stage("activity_filter", rows_in=len(swaps['users'])) as active:
+            buys, sells = activity_counts(swaps, usdt_prices.skip_missing)
+            swaps = select_users(swaps, np.flatnonzero(is_active(buys, sells, min_buys, min_sells)))
+            active.rows_out = len(swaps['users'])
+    with stage("pnl_pass", rows_in=len(swaps['amount0'])) as walked:
+        results = run_pnl(swaps, usdt_prices, parallel_workers(workers, len(swaps['amount0'])))
+        walked.rows_out = len(results)
+    return results
+
+
+def empty_pnl_state():
+    return {
+        'fill': None,
+        'watermarks': {},
+        'users': np.array([], dtype=str),
+        'total': np.array([], dtype=np.float64),
+        'profit': np.array([], dtype=np.float64),
+        'buys': np.array([], dtype=np.int64),
+        'sells': np.array([], dtype=np.int64),
+        'last_timestamp': np.array([], dtype='datetime64[ns]'),
+        'holding_user': np.array([], dtype=np.int64),
+        'token': np.array([], dtype=str),
+        'balance': np.array([], dtype=np.float64),
+        'bought_day': np.array([], dtype='datetime64[D]'),
+        'volume': np.array([], dtype=np.float64),
+    }
+
+
+def load_pnl_state(path=PNL_STATE_PATH):
+    """Saved running state: one row per user sorted by address, and one holding row per
+    (user, token) grouped by user, in the order the user first traded each token."""
+    state = empty_pnl_state()
+    if not os.path.exists(path):
+        return state
+    with np.load(path) as archive:
+        state.update(json.loads(str(archive['meta'])))
+        state.update({key: archive[key] for key in STATE_COLUMNS})
+    return state
+
+
+def save_pnl_state(state, path=PNL_STATE_PATH):
+    # Plain arrays are written without touching every user in Python. np.savez appends .npz
+    # to other names, so write to one ending in it and replace the state once it is complete
+    tmp_path = path + ".tmp.npz"
+    meta = json.dumps({'fill': state['fill'], 'watermarks': state['watermarks']})
+    np.savez(tmp_path, meta=np.array(meta), **{key: state[key] for key in STATE_COLUMNS})
+    os.replace(tmp_path, path)
+
+
+def swap_pools(df):
+    # Pool name of every swap such as WETH_USDT, built once per token pair instead of once per swap
+    codes0, tokens0 = pd.factorize(df['token0'])
+    codes1, tokens1 = pd.factorize(df['token1'])
+    codes, pairs = pd.factorize(codes0 * len(tokens1) + codes1)
+    names = [f"{tokens0[pair // len(tokens1)]}_{tokens1[pair % len(tokens1)]}" for pair in pairs]
+    return pd.Series(pd.Categorical.from_codes(codes, names), index=df.index)
+
+
+def holding_offsets(state):
+    # Start of every user's holding rows plus the end offset
+    return np.searchsorted(state['holding_user'], np.arange(len(state['users']) + 1))
+
+
+def states_to_pass(state, user_indices, token_ids, first_day):
+    """pnl_pass states of the given saved users, with token ids and day columns."""
+    offsets = holding_offsets(state)
+    states = []
+    for user in user_indices:
+        rows = slice(offsets[user], offsets[user + 1])
+        ids = [token_ids[token] for token in state['token'][rows].tolist()]
+        days = (state['bought_day'][rows] - np.datetime64(first_day, 'D')).astype(np.int64).tolist()
+        missing = np.isnat(state['bought_day'][rows]).tolist()
+        states.append({
+            'total': float(state['total'][user]),
+            'balances': dict(zip(ids, state['balance'][rows].tolist())),
+            'bought_day': {token: None if unknown else day for token, day, unknown in zip(ids, days, missing)},
+            'token_volumes': dict(zip(ids, state['volume'][rows].tolist())),
+            'buys': int(state['buys'][user]),
+            'sells': int(state['sells'][user]),
+        })
+    return states
+
+
+def merge_pass_states(state, users, states, profits, last_timestamps, tokens, first_day):
+    """Replace the saved rows of the given users with their states after a pass, in place.
+
+    Only these users go through Python, everyone else's rows are carried over as arrays.
+    """
+    rows = saved_users(state, users)
+    keep = np.ones(len(state['users']), dtype=bool)
+    keep[rows[rows >= 0]] = False
+    kept_holdings = keep[state['holding_user']]
+
+    holding_user, token, balance, bought_day, volume = [], [], [], [], []
+    for j, pass_state in enumerate(states):
+        for token_id, token_balance in pass_state['balances'].items():
+            day = pass_state['bought_day'][token_id]
+            holding_user.append(j)
+            token.append(tokens[token_id])
+            balance.append(token_balance)
+            bought_day.append(np.datetime64('NaT', 'D') if day is None else first_day + day)
+            volume.append(pass_state['token_volumes'][token_id])
+
+    # New positions of the kept users and of the updated ones, users sorted by address again
+    all_users = np.concatenate([state['users'][keep], np.asarray(users, dtype=str)])
+    order = np.argsort(all_users, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    old_rank = np.full(len(keep), -1, dtype=np.int64)
+    old_rank[keep] = rank[:keep.sum()]
+
+    merged_user = np.concatenate([old_rank[state['holding_user'][kept_holdings]],
+                                  rank[keep.sum() + np.array(holding_user, dtype=np.int64)]])
+    holdings = np.argsort(merged_user, kind='stable')
+    state['holding_user'] = merged_user[holdings]
+    for key, values in [('token', token), ('balance', balance), ('bought_day', bought_day), ('volume', volume)]:
+        values = np.array(values, dtype=state[key].dtype) if key != 'token' else np.array(values, dtype=str)
+        state[key] = np.concatenate([state[key][kept_holdings], values])[holdings]
+
+    user_values = {
+        'users': np.asarray(users, dtype=str),
+        'total': np.array([pass_state['total'] for pass_state in states], dtype=np.float64),
+        'profit': np.array(profits, dtype=np.float64),
+        'buys': np.array([pass_state['buys'] for pass_state in states], dtype=np.int64),
+        'sells': np.array([pass_state['sells'] for pass_state in states], dtype=np.int64),
+        'last_timestamp': np.asarray(last_timestamps, dtype='datetime64[ns]'),
+    }
+    for key, values in user_values.items():
+        state[key] = np.concatenate([state[key][keep], values])[order]
+
+
+def state_table(state, min_buys=None, min_sells=None):
+    """PnL table of every user in a saved state, in the same layout and order as run_pnl.
+
+    The activity filter runs first, so volume dicts are only built for the users kept.
+    """
+    users = np.arange(len(state['users']))
+    if min_buys is not None or min_sells is not None:
+        users = users[is_active(state['buys'], state['sells'], min_buys, min_sells)]
+    offsets = holding_offsets(state)
+    return pd.DataFrame({
+        'user_address': np.array(state['users'][users].tolist(), dtype=object),
+        'profit_in_usdt': state['profit'][users],
+        'buys': state['buys'][users],
+        'sells': state['sells'][users],
+        'volume_traded': pd.Series([dict(zip(state['token'][offsets[user]:offsets[user + 1]].tolist(),
+                                             state['volume'][offsets[user]:offsets[user + 1]].tolist()))
+                                    for user in users.tolist()], dtype=object),
+    })
+
+
+def incremental_user_pnl(df, usdt_prices, state_path=PNL_STATE_PATH, min_buys=None, min_sells=None):
+    """Per-user PnL table like compute_user_pnl, resuming from the state saved by the last run.
+
+    Every pool has a watermark, the time of its newest swap already walked. Only swaps past
+    their pool's watermark are walked, each user starting from their saved running state.
+    The state is kept as arrays, so only users with new swaps are converted to and from
+    Python objects and everyone else's rows are loaded and saved in bulk. Users whose new
+    swaps are not all later than their saved state (a pool that caught up late) are
+    replayed from their first swap. Swaps after the last day with prices wait for a run
+    that has them, since they would be skipped or priced differently until then.
+    """
+    state = load_pnl_state(state_path)
+    if len(state['users']) and state['fill'] != usdt_prices.fill:
+        raise ValueError(f"{state_path} was built with fill={state['fill']!r}, not {usdt_prices.fill!r}")
+    first_day = usdt_prices.first_day
+
+    pools = swap_pools(df)
+    # Parse each pool's watermark once and spread it over the swaps by pool code
+    watermarks = pd.to_datetime(pools.cat.categories.map(state['watermarks']).astype(object))
+    watermarks = watermarks.to_numpy(dtype='datetime64[ns]')[pools.cat.codes.to_numpy()]
+    priced = df['timestamp'] < pd.Timestamp(first_day + usdt_prices.prices.shape[1])
+    new = priced & ~(df['timestamp'] <= watermarks)
+
+    # Users with a new swap at or before the last swap in their state are replayed in full
+    first_new = df['timestamp'][new].groupby(df['user_address'][new]).min()
+    saved = saved_users(state, first_new.index)
+    seen = saved >= 0
+    replay = set(first_new.index[seen][first_new.to_numpy()[seen] <= state['last_timestamp'][saved[seen]]])
+    if replay:
+        new |= priced & df['user_address'].isin(replay)
+
+    new_df = df[new]
+    swaps = prepare_swaps(new_df, usdt_prices)
+    saved = saved_users(state, swaps['users'])
+    resumed = (saved >= 0) & ~pd.Index(swaps['users']).isin(replay)
+
+    # Tokens that only appear in saved states still need an id in this pass
+    offsets = holding_offsets(state)
+    rows = np.concatenate([np.arange(offsets[user], offsets[user + 1]) for user in saved[resumed]] or [[]])
+    extra = sorted(set(state['token'][rows.astype(np.int64)].tolist()) - set(swaps['tokens']))
+    if extra:
+        swaps['tokens'] = swaps['tokens'] + extra
+        swaps['is_usd'] = swaps['is_usd'] + [token in STABLECOINS for token in extra]
+        swaps['price_rows'] = np.r_[swaps['price_rows'], usdt_prices.token_rows(extra)]
+    token_ids = {token: i for i, token in enumerate(swaps['tokens'])}
+
+    states = [None] * len(swaps['users'])
+    for j, pass_state in zip(np.flatnonzero(resumed), states_to_pass(state, saved[resumed], token_ids, first_day)):
+        states[j] = pass_state
+    columns = {key: swaps[key].tolist() for key in SWAP_COLUMNS}
+    profits, _, _, _ = pnl_pass(columns, swaps['starts'].tolist(), swaps['tokens'], swaps['is_usd'],
+                                swaps['price_rows'].tolist(), usdt_prices.prices, usdt_prices.fill, states)
+
+    last_timestamps = new_df.groupby('user_address')['timestamp'].max()[swaps['users']].to_numpy()
+    merge_pass_states(state, swaps['users'], states, profits, last_timestamps, swaps['tokens'], first_day)
+
+    # Replayed swaps can be older than a watermark, never move one back
+    for pool, last in new_df['timestamp'].groupby(pools[new], observed=True).max().items():
+        if pool not in state['watermarks'] or last > pd.Timestamp(state['watermarks'][pool]):
+            state['watermarks'][pool] = str(last)
+    state['fill'] = usdt_prices.fill
+    save_pnl_state(state, state_path)
+
+    return state_table(state, min_buys, min_sells)
+
+
+def saved_users(state, users):
+    # Row of every user in the saved state, -1 for users it doesn't have
+    users = np.asarray(users, dtype=str)
+    rows = np.minimum(np.searchsorted(state['users'], users), max(len(state['users']) - 1, 0))
+    found = len(state['users']) > 0
+    return np.where(found & (state['users'][rows] == users) if found else False, rows, -1)
+
+
+class TopK:
+    """Collects the k items with the highest scores in a bounded min-heap.
+
+    Equal scores keep the item pushed first, like a stable descending sort, and NaN
+    scores rank below every number.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.nan_items = []
+        self.pushed = 0
+
+    def push(self, score, item):
+        self.pushed += 1
+        if score != score:
+            if len(self.nan_items) < self.k:
+                self.nan_items.append(item)
+            return
+        # Later pushes get a smaller tie-breaker so they are the first to be evicted
+        entry = (score, -self.pushed, item)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self):
+        ranked = [item for _, _, item in sorted(self.heap, key=lambda entry: entry[:2], reverse=True)]
+        return (ranked + self.nan_items)[:self.k]
+
+
+def select_top_performers(results, k=100, score='profit_in_usdt'):
+    """The k rows of a PnL table with the highest non-zero score, best first."""
+    top = TopK(k)
+    for i, value in enumerate(results[score].tolist()):
+        if value != 0:
+            top.push(value, i)
+    return results.iloc[top.items()]
+
+
+def load_bundled_swaps(target_pools=None):
+    """Load every bundled pool whose tokens have known decimals, priced like analyse_users does."""
+    import analyse_users
+    from swap_table import available_pools, load_usdt_prices
+
+    if target_pools is None:
+        target_pools = available_pools()
+
+    all_df = analyse_users.load_pool_data(target_pools)
+    usdt_prices = load_usdt_prices()
+    return analyse_users.add_usdt_prices(all_df, usdt_prices), usdt_prices
+
+
+def check_equivalence(target_pools=None):
+    """Compare the engine with calculate_user_perfomance on the bundled pools and time both."""
+    import analyse_users
+
+    all_df, usdt_prices = load_bundled_swaps(target_pools)
+
+    start = time.perf_counter()
+    engine = compute_user_pnl(all_df, usdt_prices).set_index('user_address')
+    engine_time = time.perf_counter() - start
+
+    # The reference sees every user's swaps in the same chronological order as the engine
+    start = time.perf_counter()
+    mismatches = 0
+    sorted_df = all_df.sort_values(['user_address', 'timestamp'], kind='mergesort')
+    for user, user_data in sorted_df.groupby('user_address'):
+        profit, volumes = analyse_users.calculate_user_perfomance(user_data, usdt_prices, min_buys=-1, min_sells=-1)
+        row = engine.loc[user]
+        if not (profit == row['profit_in_usdt'] or (np.isnan(profit) and np.isnan(row['profit_in_usdt']))) \
+                or volumes != row['volume_traded']:
+            mismatches += 1
+    reference_time = time.perf_counter() - start
+
+    print(f"{len(all_df)} swaps, {len(engine)} users, {mismatches} mismatches")
+    print(f"reference {reference_time:.2f}s, engine {engine_time:.3f}s, speedup {reference_time / engine_time:.0f}x")
+    return mismatches == 0
+
+
+def check_incremental(steps=5, seed=0):
+    """Feed the bundled swaps to incremental_user_pnl in steps and compare with a full recompute.
+
+    Each pool is cut at its own jittered times, so some pools catch up late and their users
+    get replayed. The last step only adds the newest 1% of swaps and has to beat the full
+    recompute, else the check fails even with identical results.
+    """
+    all_df, usdt_prices = load_bundled_swaps()
+    rng = np.random.default_rng(seed)
+    pools = swap_pools(all_df)
+    quantiles = np.r_[np.linspace(0.5, 0.99, steps - 1), 1.0]
+    cuts = all_df['timestamp'].quantile(quantiles).to_numpy()
+
+    identical = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_path = os.path.join(tmp_dir, os.path.basename(PNL_STATE_PATH))
+        for step, cut in enumerate(cuts):
+            if step < steps - 2:
+                shifts = {pool: pd.Timedelta(days=rng.uniform(-3, 3)) for pool in pools.unique()}
+                jitter = pd.to_timedelta(pools.map(shifts).astype(object))
+                step_df = all_df[all_df['timestamp'] <= cut + jitter]
+            else:
+                step_df = all_df[all_df['timestamp'] <= cut]
+
+            start = time.perf_counter()
+            incremental = incremental_user_pnl(step_df, usdt_prices, state_path)
+            incremental_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            priced = step_df['timestamp'] < pd.Timestamp(usdt_prices.first_day + usdt_prices.prices.shape[1])
+            full = compute_user_pnl(step_df[priced], usdt_prices)
+            full_time = time.perf_counter() - start
+
+            identical &= incremental.equals(full)
+            print(f"step {step + 1}: {len(step_df)} swaps, incremental {incremental_time:.3f}s, "
+                  f"full {full_time:.3f}s, identical: {incremental.equals(full)}")
+    faster = incremental_time < full_time
+    print(f"last update {full_time / incremental_time:.1f}x faster than a full recompute: {faster}")
+    return identical and faster
+
+
+def scaling_benchmark(worker_counts=(1, 2, 4, 8), copies=20):
+    """Time the engine for several worker counts on copies of the bundled swaps.
+
+    Each copy gets its own user addresses, so the work grows with copies. Every parallel
+    result is checked to be identical to the serial one. The pool is always used here,
+    compute_user_pnl only uses it from MIN_PARALLEL_SWAPS swaps on.
+    """
+    all_df, usdt_prices = load_bundled_swaps()
+    all_df = pd.concat([all_df.assign(user_address=all_df['user_address'] + f"_{copy}") for copy in range(copies)],
+                       ignore_index=True)
+    swaps = prepare_swaps(all_df, usdt_prices)
+    print(f"{len(all_df)} swaps, {len(swaps['users'])} users, {os.cpu_count()} CPUs, "
+          f"compute_user_pnl would use {parallel_workers(max(worker_counts), len(all_df))} workers")
+
+    serial = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        result = run_pnl(swaps, usdt_prices, workers)
+        elapsed = time.perf_counter() - start
+        if serial is None:
+            serial, serial_time = result, elapsed
+        identical = result.equals(serial)
+        print(f"workers={workers}: {elapsed:.2f}s, {serial_time / elapsed:.2f}x, identical to serial: {identical}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar PnL engine for analyse_users")
+    parser.add_argument("--check", action="store_true",
+                        help="compare against calculate_user_perfomance on the bundled pools")
+    parser.add_argument("--check-incremental", action="store_true",
+                        help="compare incremental runs over growing slices of the bundled pools with full recomputes")
+    parser.add_argument("--scaling", action="store_true",
+                        help="time 1, 2, 4 and 8 worker processes on copies of the bundled pools")
+    parser.add_argument("--copies", type=int, default=20, help="copies of the bundled swaps for --scaling")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_equivalence() else 1)
+    if args.check_incremental:
+        raise SystemExit(0 if check_incremental() else 1)
+    if args.scaling:
+        scaling_benchmark(copies=args.copies)
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from pool_store import read_json_records
+from token_registry import load_token_registry
+
+POOLS_DIR = "pools"
+CATALOG_NAME = "catalog.json"
+CHECKPOINTS_NAME = "checkpoints.json"
+CATALOG_VERSION = 2
+
+# Last-resort decimals of the tokens the scripts were first written for, used only when neither the
+# catalog nor the token registry knows a token. Don't add tokens here: fetch.py records every token
+# it meets in pools/tokens.json, and the tokens of the bundled pool files are in pools/tokens.seed.json
+DECIMALS_MAP = {
+    "WETH": 10 ** 18,
+    "DAI": 10 ** 18,
+    "USDC": 10 ** 6,
+    "USDT": 10 ** 6,
+    "WBTC": 10 ** 8,
+    "LINK": 10 ** 18,
+    "UNI": 10 ** 18,
+    "MKR": 10 ** 18,
+    "MATIC": 10 ** 18,
+    "SHIB": 10 ** 18,
+    "LDO": 10 ** 18,
+    "PEPE": 10 ** 18,
+    "SKL": 10 ** 18
+}
+
+# The catalog, pools/catalog.json, has one entry per pool file:
+#
+#   file, size, mtime_ns          the file the entry describes, offsets are only valid while
+#                                 its size and modification time are unchanged
+#   contract                      pool contract address, None if unknown
+#   token0, token1                {"symbol", "address", "decimals"}, address and decimals None if unknown
+#   rows, users                   number of swaps and of distinct users
+#   first_timestamp,              epoch seconds of the earliest and latest swap
+#   last_timestamp
+#   index                         the file's user index, data_<pool>.index.npz next to it
+#
+# The user index has one row per user with swaps, in file order:
+#
+#   hash                          address_hash of the user's address
+#   offset, length                byte range of the user's swaps in the file
+#   rows                          number of swaps
+#   first, last                   epoch seconds of the user's earliest and latest swap
+#   by_first                      the rows ordered by first, a filtered read finds the users who
+#                                 start before the end of its range with one binary search
+
+
+def catalog_path(pools_dir=POOLS_DIR):
+    return os.path.join(pools_dir, CATALOG_NAME)
+
+
+def pool_name(filename):
+    # data_WETH_USDT.json -> WETH_USDT
+    return os.path.basename(filename)[len("data_"):-len(".json")]
+
+
+def pool_tokens(pool):
+    # Files are named after the symbols, with _<k> appended for further pools of the same pair
+    token0, token1 = pool.split("_")[:2]
+    return token0, token1
+
+
+def empty_catalog():
+    return {"version": CATALOG_VERSION, "pools": {}}
+
+
+@lru_cache(maxsize=4)
+def read_catalog(path, mtime_ns):
+    with open(path) as file:
+        return json.load(file)
+
+
+def load_catalog(pools_dir=POOLS_DIR):
+    """The catalog of pools_dir, parsed once per version of the file."""
+    path = catalog_path(pools_dir)
+    if not os.path.exists(path):
+        return empty_catalog()
+    catalog = read_catalog(path, os.stat(path).st_mtime_ns)
+    return catalog if catalog.get("version") == CATALOG_VERSION else empty_catalog()
+
+
+def save_catalog(catalog, pools_dir=POOLS_DIR):
+    # Write to a temporary file first so a crash never leaves a truncated catalog
+    path = catalog_path(pools_dir)
+    with open(path + ".tmp", "w") as file:
+        file.write(json.dumps(catalog, indent=1))
+    os.replace(path + ".tmp", path)
+
+
+def update_catalog(entries, pools_dir=POOLS_DIR):
+    """Add or replace the entries of some pools, e.g. {"WETH_USDT": entry}, keeping the others."""
+    catalog = empty_catalog()
+    path = catalog_path(pools_dir)
+    if os.path.exists(path):
+        with open(path) as file:
+            catalog = json.load(file)
+        if catalog.get("version") != CATALOG_VERSION:
+            catalog = empty_catalog()
+    catalog["pools"].update(entries)
+    save_catalog(catalog, pools_dir)
+
+
+def fresh_entry(pool, pools_dir=POOLS_DIR):
+    """Catalog entry of a pool if it still describes the file on disk, else None."""
+    entry = load_catalog(pools_dir)["pools"].get(pool)
+    if entry is None:
+        return None
+    path = os.path.join(pools_dir, entry["file"])
+    if not os.path.exists(path) or not os.path.exists(os.path.join(pools_dir, entry["index"])):
+        return None
+    stat = os.stat(path)
+    return entry if (stat.st_size, stat.st_mtime_ns) == (entry["size"], entry["mtime_ns"]) else None
+
+
+def skip_blank(text, position):
+    while text[position] in " \t\r\n":
+        position += 1
+    return position
+
+
+def index_pool_file(path):
+    """Row count, users, time range and user index of a pool file, in one pass over its text.
+
+    The file maps every user to their swaps. Its bytes are decoded as latin-1 so that
+    string positions are byte offsets, which is safe since the structure is plain ASCII.
+    """
+    with open(path, "rb") as file:
+        text = file.read().decode("latin-1")
+    decoder = json.JSONDecoder()
+
+    users, starts, ends, counts, timestamps = [], [], [], [], []
+    position = skip_blank(text, skip_blank(text, 0) + 1)
+    while text[position] != "}":
+        start = position
+        user, position = decoder.raw_decode(text, position)
+        transactions, position = decoder.raw_decode(text, skip_blank(text, skip_blank(text, position) + 1))
+        users.append(user)
+        starts.append(start)
+        ends.append(position)
+        counts.append(len(transactions))
+        timestamps.extend(tx["timestamp"] for tx in transactions)
+        position = skip_blank(text, position)
+        if text[position] == ",":
+            position = skip_blank(text, position + 1)
+
+    seconds = pd.to_datetime(timestamps, format="ISO8601").values.astype("datetime64[s]").astype(np.int64)
+    return user_index(users, starts, ends, counts, seconds)
+
+
+def address_hash(address):
+    # 32 bits of the lower-cased address, the user index stores these instead of the addresses. A few
+    # users in a pool of millions share a hash with a wanted one, those are parsed and filtered out
+    return int.from_bytes(hashlib.blake2b(address.lower().encode(), digest_size=4).digest(), "little")
+
+
+def address_hashes(addresses):
+    return np.fromiter((address_hash(address) for address in addresses), dtype=np.uint32, count=len(addresses))
+
+
+def user_index(users, starts, ends, counts, seconds):
+    """Catalog statistics and user index of a pool file.
+
+    users, starts, ends and counts give the address, byte range and number of swaps of
+    every user in file order, seconds the epoch seconds of all swaps in the same order.
+    """
+    # Earliest and latest swap of every user, users without swaps don't count towards the range
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.r_[0, np.cumsum(counts)][:-1]
+    has_rows = counts > 0
+    first = np.full(len(users), np.iinfo(np.int64).max)
+    last = np.full(len(users), np.iinfo(np.int64).min)
+    if has_rows.any():
+        first[has_rows] = np.minimum.reduceat(seconds, offsets[has_rows])
+        last[has_rows] = np.maximum.reduceat(seconds, offsets[has_rows])
+
+    n_users = len(users)
+    users = np.asarray(users)[has_rows]
+    first, last = first[has_rows], last[has_rows]
+    return {
+        "rows": int(counts.sum()),
+        "users": n_users,
+        "first_timestamp": int(seconds.min()) if len(seconds) else None,
+        "last_timestamp": int(seconds.max()) if len(seconds) else None,
+        "user_index": {
+            "hash": address_hashes(users),
+            "offset": np.asarray(starts, dtype=np.int64)[has_rows],
+            "length": (np.asarray(ends) - np.asarray(starts))[has_rows].astype(np.int32),
+            "rows": counts[has_rows].astype(np.int32),
+            "first": first,
+            "last": last,
+            "by_first": np.argsort(first, kind="stable").astype(np.int32),
+        },
+    }
+
+
+def user_index_path(path):
+    # pools/data_WETH_USDT.json -> pools/data_WETH_USDT.index.npz
+    return path[:-len(".json")] + ".index.npz"
+
+
+def save_user_index(path, index):
+    # np.savez appends .npz on its own, so write to a temporary name that already ends in it
+    tmp_path = path[:-len(".npz")] + ".tmp.npz"
+    np.savez_compressed(tmp_path, **index)
+    os.replace(tmp_path, path)
+
+
+@lru_cache(maxsize=32)
+def read_user_index(path, mtime_ns):
+    with np.load(path) as archive:
+        return {name: archive[name] for name in archive.files}
+
+
+def token_entry(symbol, address=None, decimals=None):
+    # Without on-chain decimals fall back to the known ones, if any
+    if decimals is None and symbol in DECIMALS_MAP:
+        decimals = len(str(DECIMALS_MAP[symbol])) - 1
+    return {"symbol": symbol, "address": address, "decimals": decimals}
+
+
+def build_entry(path, contract=None, token0=None, token1=None, index=None):
+    """Catalog entry of a pool file, its user index is written next to it. token0 / token1
+    default to the symbols in its name.
+
+    index is the user_index of the file if the writer already knows it, else the file is indexed.
+    """
+    symbol0, symbol1 = pool_tokens(pool_name(path))
+    stat = os.stat(path)
+    entry = {
+        "file": os.path.basename(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "contract": contract,
+        "token0": token0 or token_entry(symbol0),
+        "token1": token1 or token_entry(symbol1),
+    }
+    entry.update(index if index is not None else index_pool_file(path))
+    save_user_index(user_index_path(path), entry.pop("user_index"))
+    entry["index"] = os.path.basename(user_index_path(path))
+    return entry
+
+
+def build_catalog(pools_dir=POOLS_DIR):
+    """Index every pool file in pools_dir, keeping the chain data of entries fetch.py wrote."""
+    old = load_catalog(pools_dir)["pools"]
+    # Contracts of files fetched before the catalog existed come from the fetch checkpoints
+    contracts = {}
+    checkpoints_path = os.path.join(pools_dir, CHECKPOINTS_NAME)
+    if os.path.exists(checkpoints_path):
+        with open(checkpoints_path) as file:
+            contracts = {checkpoint["file"]: contract for contract, checkpoint in json.load(file).items()}
+
+    entries = {}
+    for filename in sorted(os.listdir(pools_dir)):
+        if not re.fullmatch(r"data_.+\.json", filename):
+            continue
+        pool = pool_name(filename)
+        previous = old.get(pool, {})
+        contract = previous.get("contract", contracts.get(filename))
+        entries[pool] = build_entry(os.path.join(pools_dir, filename), contract, previous.get("token0"),
+                                    previous.get("token1"))
+    catalog = empty_catalog()
+    catalog["pools"] = entries
+    save_catalog(catalog, pools_dir)
+    return catalog
+
+
+def leg_decimals(token, symbol, registry):
+    # The catalog entry's decimals, else the registry's by address, then by symbol, then the legacy map
+    if token is not None and token["decimals"] is not None:
+        return token["decimals"]
+    known = registry.get(token["address"]) if token is not None and token["address"] else None
+    if known is not None and known["decimals"] is not None:
+        return known["decimals"]
+    decimals = registry.symbol_decimals(symbol)
+    if decimals is None and symbol in DECIMALS_MAP:
+        decimals = len(str(DECIMALS_MAP[symbol])) - 1
+    return decimals
+
+
+def token_decimals(pool, pools_dir=POOLS_DIR):
+    """Divisors of the pool's token0 and token1 amounts.
+
+    Decimals come from the catalog, then the token registry and only as a last resort from
+    DECIMALS_MAP. Raises ValueError naming the tokens with none of them.
+    """
+    entry = load_catalog(pools_dir)["pools"].get(pool)
+    registry = load_token_registry(pools_dir)
+    symbols = pool_tokens(pool)
+    decimals = [leg_decimals(entry[leg] if entry else None, symbol, registry)
+                for leg, symbol in zip(["token0", "token1"], symbols)]
+    unknown = [symbol for symbol, value in zip(symbols, decimals) if value is None]
+    if unknown:
+        raise ValueError(f"Decimals of {' and '.join(unknown)} in {pool} are unknown, "
+                         f"resolve them with python token_registry.py resolve")
+    return [10 ** value for value in decimals]
+
+
+def has_decimals(pool, pools_dir=POOLS_DIR):
+    try:
+        token_decimals(pool, pools_dir)
+    except ValueError:
+        return False
+    return True
+
+
+def find_pools(names, pools_dir=POOLS_DIR):
+    """Pool files for names such as WETH_USDT, including further pools of a pair such as WETH_USDT_0."""
+    pools = sorted(pool_name(filename) for filename in os.listdir(pools_dir)
+                   if re.fullmatch(r"data_.+\.json", filename))
+    patterns = [re.compile(re.escape(name) + r"(_\d+)?") for name in names]
+    return [pool for pool in pools if any(pattern.fullmatch(pool) for pattern in patterns)]
+
+
+def overlaps(entry, first, last):
+    # Whether [first_timestamp, last_timestamp] meets [first, last), None bounds are open
+    if entry["first_timestamp"] is None:
+        return False
+    return (first is None or entry["last_timestamp"] >= first) and (last is None or entry["first_timestamp"] < last)
+
+
+def pool_in_range(pool, first, last, pools_dir=POOLS_DIR):
+    """False only when the catalog shows the pool has no swaps in [first, last)."""
+    entry = fresh_entry(pool, pools_dir)
+    return entry is None or overlaps(entry, first, last)
+
+
+def load_user_index(entry, pools_dir=POOLS_DIR):
+    """User index of a catalog entry, read once per version of the file."""
+    path = os.path.join(pools_dir, entry["index"])
+    return read_user_index(path, os.stat(path).st_mtime_ns)
+
+
+def matching_users(index, first=None, last=None, users=None):
+    """Mask over a user index of the users who can have swaps in [first, last) by the given addresses.
+
+    Hashes can collide, so like the time bounds a match only means the user may be wanted.
+    """
+    keep = np.ones(len(index["hash"]), dtype=bool)
+    if last is not None:
+        by_first = index["by_first"]
+        keep[by_first[np.searchsorted(index["first"][by_first], last):]] = False
+    if first is not None:
+        keep &= index["last"] >= first
+    if users is not None:
+        keep &= np.isin(index["hash"], address_hashes(list(users)))
+    return keep
+
+
+def read_pool_records(pool, first=None, last=None, users=None, pools_dir=POOLS_DIR):
+    """Swap records of the users who can have swaps in [first, last) and are among the given addresses.
+
+    Their swaps are located by byte offsets and consecutive users are parsed as one run,
+    the other users are never read. Records are returned in file order and still need an
+    exact filter, the index only bounds them. Returns None when the catalog has no up to
+    date entry for the pool.
+    """
+    entry = fresh_entry(pool, pools_dir)
+    if entry is None:
+        return None
+    index = load_user_index(entry, pools_dir)
+    selected = np.flatnonzero(matching_users(index, first, last, users))
+    # Runs of users that are next to each other in the file
+    breaks = np.flatnonzero(np.diff(selected) != 1) + 1
+    run_starts = selected[np.r_[0, breaks]] if len(selected) else selected
+    run_ends = selected[np.r_[breaks - 1, len(selected) - 1]] if len(selected) else selected
+
+    records = []
+    with open(os.path.join(pools_dir, entry["file"]), "rb") as file:
+        for start, end in zip(run_starts, run_ends):
+            offset = index["offset"][start]
+            file.seek(offset)
+            text = file.read(index["offset"][end] + index["length"][end] - offset)
+            for transactions in json.loads(b"{" + text + b"}").values():
+                records.extend(transactions)
+    return records
+
+
+def check_catalog(pools_dir=POOLS_DIR):
+    """Compare filtered reads through the user index with filtering every record of each pool."""
+    identical = True
+    for pool, entry in load_catalog(pools_dir)["pools"].items():
+        records = read_json_records(os.path.join(pools_dir, entry["file"]))
+        if not records:
+            continue
+        seconds = pd.to_datetime([tx["timestamp"] for tx in records], format="ISO8601").values
+        seconds = seconds.astype("datetime64[s]").astype(np.int64)
+        first, last = np.quantile(seconds, [0.4, 0.6]).astype(np.int64)
+        users = {tx["user_address"] for tx in records[::50]}
+
+        start = time.perf_counter()
+        pushed = read_pool_records(pool, first, last, users, pools_dir)
+        pushed_time = time.perf_counter() - start
+        pushed_seconds = pd.to_datetime([tx["timestamp"] for tx in pushed], format="ISO8601").values
+        pushed_seconds = pushed_seconds.astype("datetime64[s]").astype(np.int64)
+        pushed = [tx for tx, second in zip(pushed, pushed_seconds)
+                  if first <= second < last and tx["user_address"] in users]
+        expected = [tx for tx, second in zip(records, seconds)
+                    if first <= second < last and tx["user_address"] in users]
+
+        index = load_user_index(entry, pools_dir)
+        in_range = int(index["rows"][matching_users(index, first, last)].sum())
+        read = int(index["rows"][matching_users(index, first, last, users)].sum())
+        print(f"{pool}: {len(expected)} of {len(records)} swaps, {in_range} by users active in the range, "
+              f"parsed {read} in {pushed_time:.3f}s, identical: {pushed == expected}")
+        identical &= pushed == expected
+    return identical
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect the catalog of the pool files")
+    parser.add_argument("command", choices=["build", "show", "check"])
+    parser.add_argument("--pools-dir", default=POOLS_DIR)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        catalog = build_catalog(args.pools_dir)
+        print(f"Indexed {len(catalog['pools'])} pools in {time.perf_counter() - start:.2f}s")
+    elif args.command == "check":
+        raise SystemExit(0 if check_catalog(args.pools_dir) else 1)
+
+    rows = []
+    for pool, entry in load_catalog(args.pools_dir)["pools"].items():
+        rows.append({
+            "pool": pool,
+            "contract": entry["contract"],
+            "decimals": f"{entry['token0']['decimals']}/{entry['token1']['decimals']}",
+            "rows": entry["rows"],
+            "users": entry["users"],
+            "first": pd.to_datetime(entry["first_timestamp"], unit="s"),
+            "last": pd.to_datetime(entry["last_timestamp"], unit="s"),
+        })
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import time
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+# Columnar pool files are plain uncompressed .npz archives next to the JSON they were made from.
+# Every array is stored separately, so reading a subset of columns only touches those arrays.
+#
+#   timestamp                 int64    epoch seconds
+#   tokens                    unicode  symbol table of the pool
+#   token0, token1            uint8    index into tokens
+#   user_address              S20      raw address bytes
+#   address_table             S20      sorted distinct user addresses
+#   address_strings           S42      the same addresses as written in the source, checksum case included
+#   tx_hash                   S32      raw hash bytes
+#   amount0, amount1,         int64 (_hi) + uint64 (_lo) pairs holding the exact value
+#   pool_liquidity            hi * 2**64 + lo, so anything within +-2**127 fits
+
+BIG_INT_COLUMNS = ["amount0", "amount1", "pool_liquidity"]
+COLUMNS = ["tx_hash", "user_address", "token0", "amount0", "token1", "amount1", "timestamp", "pool_liquidity"]
+
+MASK_64 = (1 << 64) - 1
+
+
+def split_big_ints(values):
+    """Split Python ints into (hi, lo) arrays with value == hi * 2**64 + lo."""
+    values = np.array([int(value) for value in values], dtype=object)
+    hi = (values >> 64).astype(np.int64)
+    lo = (values & MASK_64).astype(np.uint64)
+    return hi, lo
+
+
+def join_big_ints(hi, lo):
+    """Rebuild the exact Python ints from a (hi, lo) pair of arrays."""
+    return hi.astype(object) * (1 << 64) + lo.astype(object)
+
+
+def encode_hex(values, width):
+    return np.array([bytes.fromhex(value[2:]) for value in values], dtype=f"S{width}")
+
+
+def decode_hex(column, width):
+    # View the raw bytes, numpy would strip trailing zero bytes from S values otherwise
+    raw = np.ascontiguousarray(column).view(np.uint8).reshape(-1, width)
+    return np.array(["0x" + row.tobytes().hex() for row in raw], dtype=object)
+
+
+def decode_addresses(column, address_table, address_strings):
+    # Look the strings up instead of re-deriving the checksum case of every address
+    return address_strings.astype(str).astype(object)[np.searchsorted(address_table, column)]
+
+
+def columnar_path(json_path):
+    return os.path.splitext(json_path)[0] + ".npz"
+
+
+def read_json_records(json_path):
+    with open(json_path) as file:
+        data = json.load(file)
+
+    records = []
+    for _, transactions in data.items():
+        for tx in transactions:
+            records.append(tx)
+    return records
+
+
+def records_to_arrays(records):
+    """Typed columnar arrays of a list of JSON swap records, in the layout of the .npz files."""
+    tokens = sorted({tx["token0"] for tx in records} | {tx["token1"] for tx in records})
+    token_ids = {token: i for i, token in enumerate(tokens)}
+
+    arrays = {
+        "timestamp": (pd.to_datetime([tx["timestamp"] for tx in records]).values.astype("datetime64[s]")
+                      .astype(np.int64)),
+        "tokens": np.array(tokens, dtype=str),
+        "token0": np.array([token_ids[tx["token0"]] for tx in records], dtype=np.uint8),
+        "token1": np.array([token_ids[tx["token1"]] for tx in records], dtype=np.uint8),
+        "user_address": encode_hex([tx["user_address"] for tx in records], 20),
+        "tx_hash": encode_hex([tx["tx_hash"] for tx in records], 32),
+    }
+    arrays["address_table"], first_seen = np.unique(arrays["user_address"], return_index=True)
+    arrays["address_strings"] = np.array([records[i]["user_address"] for i in first_seen], dtype="S42")
+    for column in BIG_INT_COLUMNS:
+        arrays[f"{column}_hi"], arrays[f"{column}_lo"] = split_big_ints([tx[column] for tx in records])
+    return arrays
+
+
+def convert_json(json_path, npz_path=None):
+    """Convert a pools/data_*.json file into its columnar .npz counterpart and return its path."""
+    npz_path = npz_path or columnar_path(json_path)
+    arrays = records_to_arrays(read_json_records(json_path))
+
+    # np.savez appends .npz on its own, write to a temporary name and move it in place
+    tmp_path = npz_path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, npz_path)
+    return npz_path
+
+
+def load_columns(npz_path, columns=None):
+    """Read the raw typed arrays of a columnar pool file, optionally only the given columns."""
+    columns = columns or COLUMNS
+    arrays = {}
+    with np.load(npz_path) as archive:
+        for column in columns:
+            if column in BIG_INT_COLUMNS:
+                arrays[f"{column}_hi"] = archive[f"{column}_hi"]
+                arrays[f"{column}_lo"] = archive[f"{column}_lo"]
+            else:
+                arrays[column] = archive[column]
+        if "token0" in columns or "token1" in columns:
+            arrays["tokens"] = archive["tokens"]
+        if "user_address" in columns:
+            arrays["address_table"] = archive["address_table"]
+            arrays["address_strings"] = archive["address_strings"]
+    return arrays
+
+
+def load_pool_arrays(json_path):
+    """Raw typed arrays of one pool, from its .npz when it is fresh and from the JSON otherwise."""
+    npz_path = columnar_path(json_path)
+    if not os.path.exists(npz_path) or os.path.getmtime(npz_path) < os.path.getmtime(json_path):
+        return records_to_arrays(read_json_records(json_path))
+    return load_columns(npz_path)
+
+
+def load_pool_frame(json_path, columns=None, raw_amounts=False):
+    """Load one pool as a flat DataFrame with one row per swap.
+
+    Reads the columnar .npz next to json_path when it is at least as new as the JSON, and
+    falls back to parsing the JSON otherwise. Either way the frame has the same columns and
+    types: checksummed address and hash strings, token symbols, timestamps as datetime64
+    and amounts as exact Python ints. With raw_amounts the amounts are returned as their
+    <column>_hi / <column>_lo int64 and uint64 halves instead, ready for TokenAmounts.
+    """
+    columns = columns or COLUMNS
+    npz_path = columnar_path(json_path)
+
+    if not os.path.exists(npz_path) or os.path.getmtime(npz_path) < os.path.getmtime(json_path):
+        records = pd.DataFrame(read_json_records(json_path), columns=COLUMNS)
+        df = pd.DataFrame(index=records.index)
+        for column in columns:
+            if column in BIG_INT_COLUMNS and raw_amounts:
+                df[f"{column}_hi"], df[f"{column}_lo"] = split_big_ints(records[column])
+            elif column in BIG_INT_COLUMNS:
+                df[column] = records[column].astype(object)
+            elif column == "timestamp":
+                df[column] = pd.to_datetime(records[column])
+            else:
+                df[column] = records[column]
+        return df
+
+    arrays = load_columns(npz_path, columns)
+    df = pd.DataFrame(index=pd.RangeIndex(len(next(iter(arrays.values())))))
+    for column in columns:
+        if column in BIG_INT_COLUMNS and raw_amounts:
+            df[f"{column}_hi"], df[f"{column}_lo"] = arrays[f"{column}_hi"], arrays[f"{column}_lo"]
+        elif column in BIG_INT_COLUMNS:
+            df[column] = join_big_ints(arrays[f"{column}_hi"], arrays[f"{column}_lo"])
+        elif column in ("token0", "token1"):
+            df[column] = arrays["tokens"].astype(object)[arrays[column]]
+        elif column == "user_address":
+            df[column] = decode_addresses(arrays[column], arrays["address_table"], arrays["address_strings"])
+        elif column == "tx_hash":
+            df[column] = decode_hex(arrays[column], 32)
+        elif column == "timestamp":
+            df[column] = pd.to_datetime(arrays[column], unit="s")
+    return df
+
+
+def convert_all(pools_dir="pools"):
+    for json_path in sorted(glob(os.path.join(pools_dir, "data_*.json"))):
+        npz_path = convert_json(json_path)
+        print(f"{json_path} -> {npz_path}")
+
+
+def benchmark(pools_dir="pools", repeat=3):
+    """Compare load time and size of every pool in JSON and in the columnar format."""
+    rows = []
+    for json_path in sorted(glob(os.path.join(pools_dir, "data_*.json"))):
+        npz_path = columnar_path(json_path)
+        if not os.path.exists(npz_path):
+            convert_json(json_path)
+
+        def best_time(load):
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                load()
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        rows.append({
+            "pool": os.path.basename(json_path),
+            "swaps": len(np.load(npz_path)["timestamp"]),
+            "json_mb": os.path.getsize(json_path) / 2 ** 20,
+            "npz_mb": os.path.getsize(npz_path) / 2 ** 20,
+            "json_load_s": best_time(lambda: pd.DataFrame(read_json_records(json_path))),
+            "npz_load_s": best_time(lambda: load_pool_frame(json_path)),
+            "npz_raw_s": best_time(lambda: load_columns(npz_path)),
+        })
+
+    results = pd.DataFrame(rows).set_index("pool")
+    results.loc["total"] = results.sum()
+    results["size_ratio"] = results["json_mb"] / results["npz_mb"]
+    results["speedup"] = results["json_load_s"] / results["npz_load_s"]
+    print(results.round(4).to_string())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert pools/*.json into columnar .npz files")
+    parser.add_argument("command", choices=["convert", "benchmark"])
+    parser.add_argument("--pools-dir", default="pools")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_all(args.pools_dir)
+    else:
+        benchmark(args.pools_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from price_index import STABLECOINS, TOKEN_ALIASES, PriceIndex
+from swap_table import BASE_TOKEN, available_pools, load_swap_table, load_usdt_prices
+
+# Bar lengths in seconds, bars start at multiples of the length since the epoch
+INTERVALS = {"1m": 60, "1h": 60 * 60, "1d": 24 * 60 * 60}
+
+BAR_COLUMNS = ["pool", "token0", "token1", "time", "open", "high", "low", "close", "vwap",
+               "volume0", "volume1", "swaps", "realized_volatility"]
+
+
+def build_bars(swaps, interval="1h"):
+    """OHLC, VWAP and realized volatility bars of every pool in one pass over the swap table.
+
+    Every swap implies the price of token0 in token1 as |amount1 / amount0|. vwap is the
+    bar's total token1 amount over its total token0 amount, and realized_volatility the
+    square root of the summed squared log returns between consecutive swaps of the bar.
+    """
+    seconds = INTERVALS[interval]
+    swaps = swaps[(swaps['amount0'] != 0) & (swaps['amount1'] != 0)]
+    if not len(swaps):
+        return pd.DataFrame(columns=BAR_COLUMNS)
+    swaps = swaps.sort_values(['pool', 'timestamp'], kind='mergesort')
+
+    pools = swaps['pool'].to_numpy()
+    volume0, volume1 = np.abs(swaps['amount0'].to_numpy()), np.abs(swaps['amount1'].to_numpy())
+    price = volume1 / volume0
+    bar = swaps['timestamp'].values.astype('datetime64[s]').astype(np.int64) // seconds
+
+    # A bar starts wherever the pool or the bar number changes
+    starts = np.flatnonzero(np.r_[True, (pools[1:] != pools[:-1]) | (bar[1:] != bar[:-1])])
+    ends = np.r_[starts[1:], len(price)] - 1
+
+    # The first swap of a bar has no return within the bar
+    returns = np.r_[0.0, np.diff(np.log(price))]
+    returns[starts] = 0.0
+
+    return pd.DataFrame({
+        'pool': pools[starts],
+        'token0': swaps['token0'].to_numpy()[starts],
+        'token1': swaps['token1'].to_numpy()[starts],
+        'time': pd.to_datetime(bar[starts] * seconds, unit='s'),
+        'open': price[starts],
+        'high': np.maximum.reduceat(price, starts),
+        'low': np.minimum.reduceat(price, starts),
+        'close': price[ends],
+        'vwap': np.add.reduceat(volume1, starts) / np.add.reduceat(volume0, starts),
+        'volume0': np.add.reduceat(volume0, starts),
+        'volume1': np.add.reduceat(volume1, starts),
+        'swaps': ends - starts + 1,
+        'realized_volatility': np.sqrt(np.add.reduceat(returns ** 2, starts)),
+    })
+
+
+def best_quotes(quotes, hops):
+    # One price per token and bar, from the pool with the most swaps in it
+    quotes = quotes.sort_values('swaps', ascending=False, kind='mergesort').drop_duplicates(['time', 'token'])
+    return quotes[['time', 'token', 'price', 'pool']].assign(hops=hops)
+
+
+def usd_prices(bars, fallback=None, base=BASE_TOKEN):
+    """USD close of every token in every bar, chained through other pools where needed.
+
+    Tokens quoted against a stablecoin are priced by that pool directly. Other quotes are
+    converted with the USD close of their quote token in the same bar, following the pools
+    as deep as they connect, so 1INCH only traded against UNI is priced through UNI/WETH and
+    a WETH/stablecoin pool. Where no such pool exists, the base token's USD price comes from
+    the daily closes of the fallback PriceIndex. Stablecoins themselves are left out, they
+    are always 1 USD. Tokens that no path of pools connects to a USD price are reported.
+
+    Returns a frame with time, token, price, the pool the price came from and the number
+    of hops it took.
+    """
+    # Every bar quotes token0 in token1 and token1 in token0
+    quotes = pd.concat([
+        pd.DataFrame({'time': bars['time'], 'token': bars['token0'], 'quote': bars['token1'],
+                      'price': bars['close'], 'swaps': bars['swaps'], 'pool': bars['pool']}),
+        pd.DataFrame({'time': bars['time'], 'token': bars['token1'], 'quote': bars['token0'],
+                      'price': 1 / bars['close'], 'swaps': bars['swaps'], 'pool': bars['pool']}),
+    ], ignore_index=True)
+    quotes = quotes[~quotes['token'].isin(STABLECOINS)]
+
+    known = best_quotes(quotes[quotes['quote'].isin(STABLECOINS)], 0)
+    if fallback is not None:
+        times = quotes.loc[quotes['quote'] == base, 'time'].unique()
+        times = times[~pd.Index(times).isin(known.loc[known['token'] == base, 'time'])]
+        seeded = pd.DataFrame({'time': times, 'token': base, 'price': fallback.lookup([base] * len(times), times),
+                               'pool': 'fallback', 'hops': 0})
+        known = pd.concat([known, seeded.dropna(subset=['price'])], ignore_index=True)
+
+    # Every round prices the tokens one pool further away, until a round finds no new price
+    hops = 0
+    while True:
+        hops += 1
+        quote_prices = known[['time', 'token', 'price']].rename(columns={'token': 'quote', 'price': 'quote_price'})
+        chained = quotes.merge(quote_prices, on=['time', 'quote'])
+        chained['price'] = chained['price'] * chained['quote_price']
+        # Only tokens that have no price in that bar yet
+        chained = chained.merge(known[['time', 'token']], on=['time', 'token'], how='left', indicator=True)
+        chained = chained[chained['_merge'] == 'left_only']
+        if not len(chained):
+            break
+        known = pd.concat([known, best_quotes(chained, hops)], ignore_index=True)
+
+    unpriced = sorted(set(quotes['token']) - set(known['token']))
+    if unpriced:
+        print(f"Warning: no USD price for {', '.join(unpriced)}, no pool path leads to a stablecoin or {base}")
+    return known.sort_values(['token', 'time'], kind='mergesort').reset_index(drop=True)
+
+
+def daily_price_index(prices, fill="skip"):
+    """PriceIndex of the last USD price of every token and day, like the one from the price CSV."""
+    daily = prices.assign(Date=prices['time'].dt.normalize()).sort_values('time', kind='mergesort')
+    daily = daily.drop_duplicates(['Date', 'token'], keep='last')
+    # The CSV names wrapped tokens by their underlying asset, PriceIndex resolves them the same way
+    tokens = daily['token'].map(lambda token: TOKEN_ALIASES.get(token, token))
+    frame = pd.DataFrame({'Date': daily['Date'], 'token': tokens, 'Price': daily['price']})
+    return PriceIndex.from_frame(frame.drop_duplicates(['Date', 'token'], keep='last'), fill)
+
+
+def load_swap_prices(fill="skip", pools=None):
+    """Daily USD prices of every token traded in the pools, derived from the swaps themselves."""
+    bars = build_bars(load_swap_table(pools or available_pools()), "1d")
+    return daily_price_index(usd_prices(bars, fallback=load_usdt_prices()), fill)
+
+
+def load_intraday_volatility(pool):
+    """Daily close and intraday realized volatility (%) of a pool, in the layout of load_eth_data.
+
+    The volatility is the square root of the summed squared log returns between the day's
+    consecutive swaps. This is not the metric of load_eth_data, the absolute day-over-day
+    change of the close, so the two are on different scales and not interchangeable.
+    """
+    bars = build_bars(load_swap_table([pool]), "1d")
+    return pd.DataFrame({
+        'Date': bars['time'].dt.date,
+        'Price': bars['close'].to_numpy(),
+        'Volatility': bars['realized_volatility'].to_numpy() * 100,
+    })
+
+
+def check_bars(swaps, bars, interval):
+    # The same bars with a plain pandas groupby
+    swaps = swaps[(swaps['amount0'] != 0) & (swaps['amount1'] != 0)].copy()
+    swaps['price'] = (swaps['amount1'] / swaps['amount0']).abs()
+    swaps['time'] = swaps['timestamp'].dt.floor(pd.Timedelta(seconds=INTERVALS[interval]))
+    grouped = swaps.sort_values(['pool', 'timestamp'], kind='mergesort').groupby(['pool', 'time'])['price']
+    expected = pd.DataFrame({'open': grouped.first(), 'high': grouped.max(), 'low': grouped.min(),
+                             'close': grouped.last(), 'swaps': grouped.size()})
+    actual = bars.set_index(['pool', 'time'])[expected.columns]
+    return actual.equals(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build OHLC/VWAP bars and USD prices from the pool swaps")
+    parser.add_argument("pools", nargs="*", help="pools such as WETH_USDT, every pool with known decimals by default")
+    parser.add_argument("--interval", choices=list(INTERVALS), default="1h")
+    parser.add_argument("--output", help="write the bars to this CSV file")
+    parser.add_argument("--check", action="store_true", help="compare the bars with a pandas groupby")
+    args = parser.parse_args()
+
+    swaps = load_swap_table(args.pools or available_pools())
+    start = time.perf_counter()
+    bars = build_bars(swaps, args.interval)
+    bars_time = time.perf_counter() - start
+    start = time.perf_counter()
+    prices = usd_prices(bars, fallback=load_usdt_prices())
+    prices_time = time.perf_counter() - start
+    print(f"{len(bars)} {args.interval} bars from {len(swaps)} swaps in {bars_time:.3f}s, "
+          f"{len(prices)} USD prices in {prices_time:.3f}s")
+    print(prices.groupby('token').agg(bars=('price', 'size'), median_usd=('price', 'median'),
+                                      hops=('hops', 'max')).to_string())
+
+    if args.output:
+        bars.to_csv(args.output, index=False)
+    if args.check:
+        identical = check_bars(swaps, bars, args.interval)
+        print(f"identical to pandas groupby: {identical}")
+        raise SystemExit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
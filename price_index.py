@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+from profiling import count, is_profiling
+
+# Tokens priced at exactly 1 USDT
+STABLECOINS = {"USDT", "USDC", "DAI", "FRAX", "LDO"}
+
+# Wrapped tokens are priced with the underlying asset's series
+TOKEN_ALIASES = {"WETH": "ETH", "WBTC": "BTC"}
+
+# Row of the price matrix shared by all stablecoins
+USD = "USD"
+
+FILL_MODES = ("skip", "previous", "nan")
+
+
+class PriceIndex:
+    """Daily USDT prices as a dense (token, day) matrix.
+
+    Tokens map to small ints (rows) and days to ordinals relative to the first day
+    (columns), so pricing a whole column of swaps is a single fancy-indexing lookup
+    instead of one MultiIndex .loc per swap.
+
+    fill decides what missing days look like:
+        skip      gaps are NaN and callers skip the swaps that hit them (the old behaviour)
+        previous  gaps take the last known close of the token
+        nan       gaps are NaN and are left for the caller to propagate
+    """
+
+    def __init__(self, tokens, first_day, prices, fill="skip"):
+        if fill not in FILL_MODES:
+            raise ValueError(f"fill must be one of {FILL_MODES}, got {fill!r}")
+        self.token_ids = {token: i for i, token in enumerate(tokens)}
+        self.first_day = np.datetime64(first_day, "D")
+        self.fill = fill
+        self.skip_missing = fill == "skip"
+
+        prices = np.array(prices, dtype=np.float64)
+        if fill == "previous":
+            prices = pd.DataFrame(prices.T).ffill().to_numpy().T
+        self.prices = prices
+
+    @classmethod
+    def from_frame(cls, frame, fill="skip"):
+        """Build from a frame with 'Date', 'token' and numeric 'Price' columns."""
+        days = frame["Date"].values.astype("datetime64[D]")
+        first_day, last_day = days.min(), days.max()
+        tokens = [USD] + sorted(set(frame["token"]) - {USD})
+        token_ids = {token: i for i, token in enumerate(tokens)}
+
+        prices = np.full((len(tokens), (last_day - first_day).astype(int) + 1), np.nan)
+        prices[token_ids[USD]] = 1.0
+        prices[frame["token"].map(token_ids).to_numpy(), (days - first_day).astype(int)] = frame["Price"].to_numpy()
+        return cls(tokens, first_day, prices, fill)
+
+    @classmethod
+    def from_csv(cls, path="Combined_Historical_Price_Data.csv", fill="skip"):
+        # Parsed like swap_table's cached price table, imported here since swap_table imports this module
+        from swap_table import build_price_table
+        return cls.from_frame(build_price_table(path), fill)
+
+    def resolve(self, token):
+        """Row of a token symbol in the matrix, or -1 if it has no prices."""
+        if token in STABLECOINS:
+            token = USD
+        return self.token_ids.get(TOKEN_ALIASES.get(token, token), -1)
+
+    def token_rows(self, tokens):
+        tokens = pd.Series(tokens)
+        # Resolve each distinct symbol once, then broadcast to the column
+        rows = {token: self.resolve(token) for token in tokens.unique()}
+        return tokens.map(rows).to_numpy(dtype=np.int64)
+
+    def day_columns(self, dates):
+        days = pd.to_datetime(pd.Series(dates)).values.astype("datetime64[D]")
+        return (days - self.first_day).astype(np.int64)
+
+    def lookup(self, tokens, dates):
+        """USDT prices for whole columns of token symbols and dates, NaN where unknown.
+
+        Stablecoins are 1 on any date, other tokens only have prices within the index's days.
+        """
+        rows = self.token_rows(tokens)
+        columns = self.day_columns(dates)
+        n_days = self.prices.shape[1]
+
+        # Days after the last close are filled too when carrying the previous close
+        if self.fill == "previous":
+            columns = np.minimum(columns, n_days - 1)
+        valid = (rows >= 0) & (columns >= 0) & (columns < n_days)
+
+        prices = np.full(len(rows), np.nan)
+        prices[valid] = self.prices[rows[valid], columns[valid]]
+        # Stablecoins are worth 1 on every date, also outside the days of the price file
+        if USD in self.token_ids:
+            prices[rows == self.token_ids[USD]] = 1.0
+        if is_profiling():
+            # Misses per token show which series has the gaps
+            missing = np.isnan(prices)
+            count("price_misses", missing.sum())
+            for token, n in pd.Series(tokens)[missing].value_counts().items():
+                count(f"price_misses.{token}", n)
+        return prices
+
+    def get(self, token, date):
+        """Price of a single token on a single date, NaN where unknown."""
+        return self.lookup([token], [date])[0]
@@ -0,0 +1,174 @@
+import atexit
+import json
+import os
+import resource
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Profile any script by setting this to 1, or to the path of the trace,
+# e.g. SWAPS_PROFILE=trace.json python analyse_users.py
+PROFILE_ENV = "SWAPS_PROFILE"
+TRACE_PATH = "profile_trace.json"
+
+
+class Stage:
+    """One timed stage; code inside the stage sets rows_in / rows_out when it knows them."""
+
+    def __init__(self, name, depth=0, rows_in=None):
+        self.name = name
+        self.depth = depth
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.counters = Counter()
+
+
+# Handed out while profiling is off, whatever is set on it is never read
+NULL_STAGE = Stage(None)
+
+# Trace of the running process, None while profiling is off
+_trace = None
+
+
+def proc_status_mb(field):
+    # A memory field of /proc/self/status such as VmHWM in MB, None off Linux
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    # High-water mark of the resident set since the start or the last reset_peak_rss,
+    # ru_maxrss (KB on Linux) is never reset and only used without /proc
+    peak = proc_status_mb("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    return proc_status_mb("VmRSS")
+
+
+def reset_peak_rss():
+    """Restart the peak_rss_mb high-water mark from the current RSS, False where the kernel can't."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def cpu_seconds():
+    # User and system time of the process and its finished workers
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def enable(path=TRACE_PATH):
+    """Start collecting stages and counters, written to path with a summary when the process exits."""
+    global _trace
+    if _trace is None:
+        _trace = {"origin": time.perf_counter(), "stack": [], "stages": [], "counters": Counter()}
+        atexit.register(finish)
+    _trace["path"] = path
+
+
+def enable_from_env():
+    value = os.environ.get(PROFILE_ENV, "")
+    if value not in ("", "0"):
+        enable(TRACE_PATH if value == "1" else value)
+
+
+def is_profiling():
+    return _trace is not None
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Time the body as a named stage: wall and CPU time, rows, rows/s and peak RSS.
+
+    Stages nest, counters go to the innermost open one. Costs one generator when off.
+    """
+    if _trace is None:
+        yield NULL_STAGE
+        return
+    current = Stage(name, len(_trace["stack"]), rows_in)
+    _trace["stack"].append(current)
+    start, cpu = time.perf_counter(), cpu_seconds()
+    try:
+        yield current
+    finally:
+        wall, cpu = time.perf_counter() - start, cpu_seconds() - cpu
+        _trace["stack"].pop()
+        rows = current.rows_in if current.rows_in is not None else current.rows_out
+        _trace["stages"].append({
+            "stage": name,
+            "depth": current.depth,
+            "start_seconds": round(start - _trace["origin"], 4),
+            "wall_seconds": round(wall, 4),
+            "cpu_seconds": round(cpu, 4),
+            "rows_in": current.rows_in,
+            "rows_out": current.rows_out,
+            "rows_per_second": round(rows / wall) if rows is not None and wall else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "counters": dict(current.counters),
+        })
+
+
+def count(name, n=1):
+    """Add n to a counter of the trace and of the innermost open stage, e.g. count("price_misses", 3).
+
+    Dotted names such as price_misses.PEPE break a counter down and stay out of the stage lines.
+    """
+    if _trace is None or not n:
+        return
+    _trace["counters"][name] += int(n)
+    if _trace["stack"]:
+        _trace["stack"][-1].counters[name] += int(n)
+
+
+def format_counters(counters, detail=False):
+    # Counters such as price_misses.PEPE break a total down, they are only listed on request
+    return " ".join(f"{key}={value}" for key, value in sorted(counters.items()) if detail or "." not in key)
+
+
+def summary(trace):
+    # One line per stage, nested ones indented under their parent, then the totals of the counters
+    stages = [{key: "" if value is None else value for key, value in record.items()} for record in trace["stages"]]
+    table = pd.DataFrame(stages, columns=["stage", "depth", "wall_seconds", "cpu_seconds", "rows_in", "rows_out",
+                                          "rows_per_second", "peak_rss_mb", "counters"])
+    table["stage"] = ["  " * depth + name for depth, name in zip(table["depth"], table["stage"])]
+    table["counters"] = table["counters"].map(format_counters)
+    width = table["stage"].str.len().max()
+    lines = [table.drop(columns="depth").to_string(index=False, formatters={"stage": lambda name: name.ljust(width)})]
+    if trace["counters"]:
+        lines.append("counters: " + format_counters(trace["counters"], detail=True))
+    return "\n".join(lines)
+
+
+def finish():
+    # Stages are recorded as they end, write them in the order they started
+    trace = {
+        "argv": sys.argv,
+        "wall_seconds": round(time.perf_counter() - _trace["origin"], 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "counters": dict(_trace["counters"]),
+        "stages": sorted(_trace["stages"], key=lambda record: (record["start_seconds"], record["depth"])),
+    }
+    path = _trace["path"]
+    with open(path + ".tmp", "w") as file:
+        json.dump(trace, file, indent=4)
+    os.replace(path + ".tmp", path)
+    print(f"\nProfile written to {path}", file=sys.stderr)
+    print(summary(trace), file=sys.stderr)
+
+
+enable_from_env()
@@ -0,0 +1,126 @@
+import argparse
+import time
+
+import numpy as np
+
+N_RESAMPLES = 10000
+CONFIDENCE = 0.95
+# Resamples per batch, bounds the (batch, days) index and value matrices in memory
+BATCH_SIZE = 2000
+
+
+def paired_values(x, y):
+    # Days where both series have a value, like Series.corr
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    return x[valid], y[valid]
+
+
+def row_correlations(x, y):
+    """Pearson correlation of every row of x with the same row of y, NaN for constant rows."""
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.einsum('ij,ij->i', x, y) / np.sqrt(np.einsum('ij,ij->i', x, x) * np.einsum('ij,ij->i', y, y))
+
+
+def bootstrap_correlations(x, y, n_resamples=N_RESAMPLES, rng=None):
+    """Correlations of n_resamples bootstrap resamples of the (x, y) pairs, drawn a batch at a time."""
+    rng = rng if rng is not None else np.random.default_rng()
+    correlations = np.empty(n_resamples)
+    for start in range(0, n_resamples, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, n_resamples)
+        rows = rng.integers(0, len(x), size=(stop - start, len(x)))
+        correlations[start:stop] = row_correlations(x[rows], y[rows])
+    return correlations
+
+
+def permutation_correlations(x, y, n_permutations=N_RESAMPLES, rng=None):
+    """Correlations of x with n_permutations shuffles of y, drawn a batch at a time.
+
+    Shuffling keeps the mean and spread of y, so with both series centered once every
+    batch of correlations is a single matrix-vector product.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    x = x - x.mean()
+    y = y - y.mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = 1 / np.sqrt((x @ x) * (y @ y))
+
+    correlations = np.empty(n_permutations)
+    for start in range(0, n_permutations, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, n_permutations)
+        shuffled = rng.permuted(np.broadcast_to(y, (stop - start, len(y))), axis=1)
+        correlations[start:stop] = (shuffled @ x) * scale
+    return correlations
+
+
+def correlation_significance(x, y, n_resamples=N_RESAMPLES, confidence=CONFIDENCE, seed=0):
+    """Pearson correlation of x and y with a bootstrap confidence interval and a permutation p-value.
+
+    The interval is the percentile interval of the bootstrap correlations. The two-sided
+    p-value is the share of shuffles of y that correlate at least as strongly with x,
+    counting the observed order as one of them. Pairs with a missing value are dropped.
+    """
+    x, y = paired_values(x, y)
+    result = {'correlation': np.nan, 'n_days': len(x), 'ci_low': np.nan, 'ci_high': np.nan, 'p_value': np.nan,
+              'n_resamples': n_resamples}
+    if len(x) < 3:
+        return result
+
+    rng = np.random.default_rng(seed)
+    correlation = row_correlations(x[None, :], y[None, :])[0]
+    result['correlation'] = correlation
+    if np.isnan(correlation):
+        return result
+
+    bootstrap = bootstrap_correlations(x, y, n_resamples, rng)
+    tail = (1 - confidence) / 2
+    result['ci_low'], result['ci_high'] = np.nanquantile(bootstrap, [tail, 1 - tail])
+
+    permuted = permutation_correlations(x, y, n_resamples, rng)
+    # A small tolerance keeps shuffles equal to the observed order from rounding below it
+    extreme = np.abs(permuted) >= np.abs(correlation) - 1e-12
+    result['p_value'] = (1 + extreme.sum()) / (1 + n_resamples)
+    return result
+
+
+def format_p_value(p_value, n_resamples=N_RESAMPLES):
+    # With no shuffle as extreme as the data p only has the bound 1 / (n_resamples + 1), not 0
+    if p_value <= 1 / (n_resamples + 1):
+        return f"p<={1 / (n_resamples + 1):.2g}"
+    return f"p={p_value:.3f}" if p_value >= 0.001 else f"p={p_value:.2g}"
+
+
+def format_significance(result, confidence=CONFIDENCE):
+    return (f"{result['correlation']:.2f} ({confidence:.0%} CI {result['ci_low']:.2f} to {result['ci_high']:.2f}, "
+            f"{format_p_value(result['p_value'], result.get('n_resamples', N_RESAMPLES))}, {result['n_days']} days)")
+
+
+def benchmark(n_days=365, n_resamples=N_RESAMPLES, seed=0):
+    """Time the significance of two correlated random daily series and check the batched correlations."""
+    rng = np.random.default_rng(seed)
+    x = rng.lognormal(size=n_days)
+    y = 0.3 * x + rng.normal(size=n_days)
+
+    rows = rng.integers(0, n_days, size=(5, n_days))
+    expected = [np.corrcoef(x[row], y[row])[0, 1] for row in rows]
+    assert np.allclose(row_correlations(x[rows], y[rows]), expected)
+
+    start = time.perf_counter()
+    result = correlation_significance(x, y, n_resamples, seed=seed)
+    elapsed = time.perf_counter() - start
+    print(f"{n_days} days, {n_resamples} bootstrap resamples and permutations in {elapsed:.3f}s")
+    print(f"correlation {format_significance(result)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time bootstrap and permutation significance of a correlation")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--resamples", type=int, default=N_RESAMPLES)
+    args = parser.parse_args()
+    benchmark(args.days, args.resamples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from amounts import TokenAmounts
+from id_registry import IdRegistry
+from pool_catalog import has_decimals, pool_in_range, pool_tokens, read_pool_records, token_decimals
+from pool_store import decode_hex, load_pool_arrays, records_to_arrays
+from price_index import STABLECOINS, PriceIndex
+from profiling import count, stage
+
+POOLS_DIR = "pools"
+PRICES_PATH = "Combined_Historical_Price_Data.csv"
+ETH_PRICES_PATH = "Ethereum Historical Results Price Data.csv"
+
+# Token the other leg of a pool is quoted against when normalizing swaps
+BASE_TOKEN = "WETH"
+
+# Bump whenever the layout of a cached table changes, so old caches are rebuilt
+TABLE_VERSION = 2
+
+# Compact swap table, what the loaders build and cache, one row per swap:
+#
+#   pool                      category         TOKEN0_TOKEN1 as in the pool file name
+#   user                      int32            address id in the IdRegistry
+#   token0, token1            int32            token ids in the IdRegistry, in the pool's own order
+#   amount0, amount1          float64          signed amounts in token units, exactly scaled
+#   timestamp                 int64            epoch seconds
+#
+# Amounts are exact only up to here: build_pool_parts divides the raw integers by 10**decimals
+# exactly with TokenAmounts and then rounds each result once to float64 (a relative error below
+# 1e-16). Every consumer, pnl_pass included, multiplies them with float USD prices, so exact
+# amounts past this point would not make a profit exact. Exact sums of a pool's amounts need
+# TokenAmounts on the raw columns of the pool store, not this table.
+#
+# Tx hashes are kept as a separate S32 array aligned with the rows (load_tx_hashes), pandas
+# would turn fixed-width bytes into Python objects.
+COMPACT_DTYPES = {"user": np.int32, "token0": np.int32, "amount0": np.float64, "token1": np.int32,
+                  "amount1": np.float64, "timestamp": np.int64}
+COMPACT_COLUMNS = list(COMPACT_DTYPES)
+
+# Canonical swap table, the compact table with its ids decoded (expand_swaps):
+#
+#   pool                      str              TOKEN0_TOKEN1 as in the pool file name
+#   tx_hash, user_address     str              as written by fetch.py
+#   timestamp                 datetime64[ns]
+#   token0, token1            str              token symbols, in the pool's own order
+#   amount0, amount1          float64          signed amounts in token units, exactly scaled
+SWAP_COLUMNS = ["tx_hash", "user_address", "token0", "amount0", "token1", "amount1", "timestamp"]
+
+
+def source_key(paths, extra=None):
+    # A cache is valid while every source keeps its size and modification time
+    key = [(path, os.path.getsize(path), os.stat(path).st_mtime_ns) for path in paths]
+    return {"version": TABLE_VERSION, "sources": key, "extra": extra}
+
+
+def cached_frame(cache_path, sources, build, extra=None):
+    """Return build() through a pickle cache that is rebuilt when a source file changes."""
+    key = source_key(sources, extra)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as file:
+            cached = pickle.load(file)
+        if cached["key"] == key:
+            return cached["frame"]
+
+    frame = build()
+    # Write to a temporary file first so a crash never leaves a truncated cache
+    with open(cache_path + ".tmp", "wb") as file:
+        pickle.dump({"key": key, "frame": frame}, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + ".tmp", cache_path)
+    return frame
+
+
+def pool_path(pool, pools_dir=POOLS_DIR):
+    return os.path.join(pools_dir, f"data_{pool}.json")
+
+
+def build_pool_parts(arrays, decimals, registry):
+    # Compact table and tx hashes from the raw typed arrays of a pool
+    user_ids = registry.address_ids(arrays["address_table"], arrays["address_strings"])
+    token_ids = registry.token_ids(arrays["tokens"].tolist())
+    table = pd.DataFrame({
+        # Intern every distinct address of the pool once, then broadcast the ids to the swaps
+        "user": user_ids[np.searchsorted(arrays["address_table"], arrays["user_address"])],
+        "token0": token_ids[arrays["token0"]],
+        # Scale the raw amounts into token units exactly, without Python ints in object columns, then
+        # round once to float64, where the precision of the compact table ends (see its layout above)
+        "amount0": TokenAmounts.from_hi_lo(arrays["amount0_hi"], arrays["amount0_lo"], decimals[0]).to_float(),
+        "token1": token_ids[arrays["token1"]],
+        "amount1": TokenAmounts.from_hi_lo(arrays["amount1_hi"], arrays["amount1_lo"], decimals[1]).to_float(),
+        "timestamp": arrays["timestamp"],
+    }).astype(COMPACT_DTYPES)
+    # Tables refer to the new ids, so they have to be on disk before a table is cached
+    if registry.changed:
+        registry.save()
+    return {"table": table, "tx_hash": arrays["tx_hash"]}
+
+
+def pool_cache_path(pool, pools_dir=POOLS_DIR):
+    return os.path.splitext(pool_path(pool, pools_dir))[0] + ".swaps.pkl"
+
+
+def load_pool_cache(pool, pools_dir=POOLS_DIR, registry=None):
+    # Compact table and tx hashes of one pool, cached next to its JSON file
+    registry = IdRegistry.load() if registry is None else registry
+    json_path = pool_path(pool, pools_dir)
+    decimals = token_decimals(pool, pools_dir)
+
+    def build():
+        # Raw typed columns, read from the columnar copy of the pool when there is one
+        with stage(f"parse_pool {pool}") as parsed:
+            parts = build_pool_parts(load_pool_arrays(json_path), decimals, registry)
+            parsed.rows_out = len(parts["table"])
+        return parts
+
+    return cached_frame(pool_cache_path(pool, pools_dir), [json_path], build, extra=[decimals, registry.key])
+
+
+def time_bounds(start=None, end=None):
+    # Epoch seconds of a [start, end) range given as anything pd.Timestamp reads, None stays open
+    return tuple(None if bound is None else int(pd.Timestamp(bound).timestamp()) for bound in (start, end))
+
+
+def load_pool_slice(pool, pools_dir, registry, first=None, last=None, users=None):
+    """Compact table and tx hashes of a pool's swaps in [first, last) by the given addresses.
+
+    A cached pool is loaded whole and filtered, that is faster than parsing any part of
+    the JSON. Otherwise only the users the catalog's user index can't rule out are parsed,
+    or the pool is cached first when the catalog has no up to date entry for it.
+    """
+    cache_path = pool_cache_path(pool, pools_dir)
+    cached = os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(pool_path(pool, pools_dir))
+    parts = None
+    if not cached:
+        with stage(f"parse_indexed {pool}") as parsed:
+            records = read_pool_records(pool, first, last, users, pools_dir)
+            if records is not None:
+                parts = build_pool_parts(records_to_arrays(records), token_decimals(pool, pools_dir), registry)
+                parsed.rows_out = len(parts["table"])
+    if parts is None:
+        parts = load_pool_cache(pool, pools_dir, registry)
+
+    table = parts["table"]
+    keep = np.ones(len(table), dtype=bool)
+    if first is not None:
+        keep &= table["timestamp"].to_numpy() >= first
+    if last is not None:
+        keep &= table["timestamp"].to_numpy() < last
+    if users is not None:
+        keep &= np.isin(table["user"].to_numpy(), registry.user_ids(users))
+    return {"table": table[keep].reset_index(drop=True), "tx_hash": parts["tx_hash"][keep]}
+
+
+def load_pool_parts(pools, pools_dir=POOLS_DIR, registry=None, start=None, end=None, users=None):
+    # Pools that can have matching swaps and their parts, the whole cached pools without a filter
+    if start is None and end is None and users is None:
+        return pools, [load_pool_cache(pool, pools_dir, registry) for pool in pools]
+    first, last = time_bounds(start, end)
+    pools = [pool for pool in pools if pool_in_range(pool, first, last, pools_dir)]
+    return pools, [load_pool_slice(pool, pools_dir, registry, first, last, users) for pool in pools]
+
+
+def load_pool_table(pool, pools_dir=POOLS_DIR, registry=None):
+    """Compact swap table of one pool, e.g. "WETH_USDT", without the pool column."""
+    return load_pool_cache(pool, pools_dir, registry)["table"]
+
+
+def available_pools(pools_dir=POOLS_DIR):
+    """Every pool in pools_dir whose tokens have known decimals, e.g. ["DAI_FRAX", ...]."""
+    pools = sorted(name[len("data_"):-len(".json")] for name in os.listdir(pools_dir)
+                   if name.startswith("data_") and name.endswith(".json"))
+    return [pool for pool in pools if has_decimals(pool, pools_dir)]
+
+
+def compact_table(pools, parts):
+    tables = [part["table"] for part in parts]
+    if not tables:
+        tables = [pd.DataFrame({column: np.zeros(0, dtype=dtype) for column, dtype in COMPACT_DTYPES.items()})]
+    table = pd.concat(tables, ignore_index=True)
+    codes = np.repeat(np.arange(len(pools)), [len(part["table"]) for part in parts])
+    table.insert(0, "pool", pd.Categorical.from_codes(codes, categories=pools))
+    return table
+
+
+def tx_hashes(parts):
+    return np.concatenate([part["tx_hash"] for part in parts] or [np.zeros(0, dtype="S32")])
+
+
+def load_compact_table(pools, pools_dir=POOLS_DIR, registry=None, start=None, end=None, users=None):
+    """Compact swap table of several pools, in the given pool order.
+
+    With start / end only swaps with start <= timestamp < end are loaded, and with users
+    only the swaps of those addresses. Pools and users the catalog rules out are
+    skipped without being read.
+    """
+    registry = IdRegistry.load() if registry is None else registry
+    return compact_table(*load_pool_parts(pools, pools_dir, registry, start, end, users))
+
+
+def load_tx_hashes(pools, pools_dir=POOLS_DIR, registry=None, start=None, end=None, users=None):
+    """Raw S32 tx hashes of several pools, row for row with load_compact_table."""
+    registry = IdRegistry.load() if registry is None else registry
+    return tx_hashes(load_pool_parts(pools, pools_dir, registry, start, end, users)[1])
+
+
+def expand_swaps(table, registry=None, tx_hashes=None):
+    """Canonical swap table with strings and datetimes from a compact one."""
+    registry = IdRegistry.load() if registry is None else registry
+    swaps = pd.DataFrame({"pool": table["pool"].astype(str).astype(object)})
+    if tx_hashes is not None:
+        swaps["tx_hash"] = decode_hex(tx_hashes, 32)
+    swaps["user_address"] = registry.decode_addresses(table["user"].to_numpy())
+    for column in ["token0", "amount0", "token1", "amount1"]:
+        values = table[column].to_numpy()
+        swaps[column] = registry.decode_tokens(values) if column.startswith("token") else values
+    swaps["timestamp"] = pd.to_datetime(table["timestamp"].to_numpy(), unit="s")
+    return swaps
+
+
+def load_swap_table(pools, pools_dir=POOLS_DIR, start=None, end=None, users=None):
+    """Canonical swap table of several pools, in the given pool order, filtered like load_compact_table."""
+    registry = IdRegistry.load()
+    pools, parts = load_pool_parts(pools, pools_dir, registry, start, end, users)
+    return expand_swaps(compact_table(pools, parts), registry, tx_hashes(parts))
+
+
+def user_ids(addresses, registry=None):
+    # Ids of address strings to filter the compact table with, -1 for unknown addresses
+    registry = IdRegistry.load() if registry is None else registry
+    return registry.user_ids(addresses)
+
+
+def memory_report(pools, pools_dir=POOLS_DIR):
+    """Bytes per swap of the canonical string table and of the compact table."""
+    registry = IdRegistry.load()
+    compact = load_compact_table(pools, pools_dir, registry)
+    tx_hashes = load_tx_hashes(pools, pools_dir, registry)
+    swaps = expand_swaps(compact, registry, tx_hashes)
+    sizes = pd.DataFrame({
+        "canonical": swaps.memory_usage(index=False, deep=True),
+        "compact": compact.memory_usage(index=False, deep=True),
+    })
+    sizes.loc["tx_hash", "compact"] = tx_hashes.nbytes
+    sizes.loc["total"] = sizes.sum()
+    sizes = sizes / max(len(swaps), 1)
+    print(f"bytes per swap over {len(swaps)} swaps, {len(registry.addresses)} addresses and "
+          f"{len(registry.tokens)} tokens in the registry")
+    print(sizes.round(1).to_string())
+    return sizes
+
+
+def quote_leg(token0, token1, base=BASE_TOKEN):
+    # The leg opposite the base token, else a stablecoin leg, else token0
+    if token1 == base:
+        return 0
+    if token0 == base:
+        return 1
+    if token1 in STABLECOINS and token0 not in STABLECOINS:
+        return 1
+    return 0
+
+
+def normalize_swaps(swaps, usdt_prices, base=BASE_TOKEN, registry=None):
+    """Orient compact swaps of any pools to a common quote leg and value that leg in USDT.
+
+    Pools are flipped where needed so token0 / amount0 is always the quote leg, then
+    amount0_usdt is the quote amount times its token's USDT close on the swap's day,
+    priced for all rows in one vectorized lookup. Stablecoins count as exactly 1 USDT.
+    Swaps whose quote token has no price on their day are dropped.
+    """
+    registry = IdRegistry.load() if registry is None else registry
+    pools = swaps["pool"].astype("category").cat
+    legs = np.array([quote_leg(*pool_tokens(pool), base) for pool in pools.categories], dtype=np.int64)
+    flip = legs[pools.codes] == 1
+
+    normalized = swaps.copy()
+    for first, second in [("token0", "token1"), ("amount0", "amount1")]:
+        normalized[first] = np.where(flip, swaps[second], swaps[first])
+        normalized[second] = np.where(flip, swaps[first], swaps[second])
+
+    symbols = registry.decode_tokens(normalized["token0"].to_numpy())
+    dates = normalized["timestamp"].to_numpy().astype("datetime64[s]")
+    rates = np.where(np.isin(symbols, list(STABLECOINS)), 1.0, usdt_prices.lookup(symbols, dates))
+    normalized["amount0_usdt"] = normalized["amount0"] * rates
+    priced = ~np.isnan(rates)
+    count("skipped_swaps", len(priced) - priced.sum())
+    return normalized[priced].reset_index(drop=True)
+
+
+def build_price_table(path):
+    prices = pd.read_csv(path)
+    # Dates in the price files are always day first, e.g. 26/10/2024
+    prices["Date"] = pd.to_datetime(prices["Date"], format="%d/%m/%Y")
+    prices["Price"] = prices["Price"].str.replace(",", "").astype(float)
+    return prices
+
+
+def load_price_table(path=PRICES_PATH):
+    """Daily USDT close of every token as a frame with Date, token and numeric Price columns."""
+    return cached_frame(os.path.splitext(path)[0] + ".pkl", [path], lambda: build_price_table(path))
+
+
+def load_usdt_prices(fill="skip", path=PRICES_PATH):
+    # Load historical USDT prices for each token into a dense (token, day) matrix
+    return PriceIndex.from_frame(load_price_table(path), fill)
+
+
+def load_eth_data(path=ETH_PRICES_PATH):
+    # Load the ETH price data and calculate volatility
+    eth_price_data = build_price_table(path)
+    eth_price_data['Date'] = eth_price_data['Date'].dt.date
+    eth_price_data = eth_price_data[['Date', 'Price']].iloc[::-1]
+    eth_price_data['Volatility'] = eth_price_data['Price'].pct_change().abs() * 100
+    return eth_price_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and time the cached compact swap tables")
+    parser.add_argument("pools", nargs="*", help="pools such as WETH_USDT, every pool with known decimals by default")
+    parser.add_argument("--pools-dir", default=POOLS_DIR)
+    parser.add_argument("--start", help="only swaps at or after this time, e.g. 2024-08-01")
+    parser.add_argument("--end", help="only swaps before this time")
+    args = parser.parse_args()
+
+    pools = args.pools or available_pools(args.pools_dir)
+    for attempt in ["first", "second"]:
+        start = time.perf_counter()
+        swaps = load_compact_table(pools, args.pools_dir, start=args.start, end=args.end)
+        usdt_prices = load_usdt_prices()
+        print(f"{attempt}: {len(swaps)} swaps from {len(pools)} pools in {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    normalized = normalize_swaps(swaps, usdt_prices)
+    print(f"normalized {len(normalized)} swaps to USDT in {time.perf_counter() - start:.3f}s")
+    memory_report(pools, args.pools_dir)
+
+
+if __name__ == "__main__":
+    main()
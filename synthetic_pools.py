@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from pool_catalog import DECIMALS_MAP, build_entry, pool_tokens, token_entry, update_catalog, user_index
+from price_index import STABLECOINS
+from swap_table import ETH_PRICES_PATH, PRICES_PATH, load_usdt_prices
+
+# Pools of analyse_users and the correlation scripts, with their share of all swaps
+POOL_SHARES = {"WETH_USDT": 0.35, "USDC_WETH": 0.35, "DAI_WETH": 0.1, "UNI_WETH": 0.1, "MATIC_WETH": 0.1}
+
+# Days on which every token of the price CSV has a close
+START = "2024-01-01"
+END = "2024-10-17"
+
+# Swaps per user follow a Zipf law with this exponent over users ranked by activity,
+# a few bots trade constantly while most users trade once or twice
+USER_SKEW = 0.9
+# Swap sizes in USD are lognormal, times a lognormal size of their user so whales stay whales
+SWAP_USD_MEDIAN = 500
+SWAP_USD_SIGMA = 1.5
+USER_SIZE_SIGMA = 1.0
+LIQUIDITY_MEDIAN = 1e22
+FEE = 0.003
+
+MANIFEST_NAME = "synthetic.json"
+WRITE_CHUNK = 100000
+
+
+def user_addresses(n_users, rng):
+    raw = rng.integers(0, 256, size=(n_users, 20), dtype=np.uint8)
+    return np.array(["0x" + row.tobytes().hex() for row in raw], dtype=object)
+
+
+def user_weights(n_users, skew=USER_SKEW):
+    weights = np.arange(1, n_users + 1, dtype=np.float64) ** -skew
+    return weights / weights.sum()
+
+
+def usd_prices(symbols, seconds, usdt_prices):
+    # Daily close of every swap's token, stablecoins at exactly 1
+    symbols = np.asarray(symbols, dtype=object)
+    prices = usdt_prices.lookup(symbols, seconds.astype("datetime64[s]"))
+    return np.where(np.isin(symbols, list(STABLECOINS)), 1.0, prices)
+
+
+def generate_pool(pool, n_swaps, weights, sizes, usdt_prices, first, last, rng):
+    """Swaps of one pool in file order: grouped by user in order of first swap, each user's swaps by time."""
+    token0, token1 = pool_tokens(pool)
+    users = rng.choice(len(weights), size=n_swaps, p=weights)
+    seconds = rng.integers(first, last, size=n_swaps)
+    usd = rng.lognormal(np.log(SWAP_USD_MEDIAN), SWAP_USD_SIGMA, size=n_swaps) * sizes[users]
+
+    # The user pays token0 (positive amount0) or token1 into the pool and gets the other out, less the fee
+    sells0 = rng.random(n_swaps) < 0.5
+    value0 = usd / usd_prices([token0] * n_swaps, seconds, usdt_prices)
+    value1 = usd / usd_prices([token1] * n_swaps, seconds, usdt_prices)
+    amount0 = np.where(sells0, value0, -value0 * (1 - FEE)) * DECIMALS_MAP[token0]
+    amount1 = np.where(sells0, -value1 * (1 - FEE), value1) * DECIMALS_MAP[token1]
+    liquidity = rng.lognormal(np.log(LIQUIDITY_MEDIAN), 1.0, size=n_swaps)
+    hashes = rng.bytes(32 * n_swaps)
+
+    # Chronological, then stably grouped by each user's first swap like the files fetch.py writes
+    order = np.argsort(seconds, kind="stable")
+    unique, first_index = np.unique(users[order], return_index=True)
+    order = order[np.argsort(first_index[np.searchsorted(unique, users[order])], kind="stable")]
+    return {
+        "user": users[order],
+        "seconds": seconds[order],
+        "amount0": np.rint(amount0[order]),
+        "amount1": np.rint(amount1[order]),
+        "liquidity": np.rint(liquidity[order]),
+        "hashes": [hashes[32 * i:32 * (i + 1)].hex() for i in order],
+    }
+
+
+def write_pool(path, pool, swaps, addresses):
+    """Write the swaps in the layout json.dump(..., indent=4) gives fetch.py and return their user_index."""
+    token0, token1 = pool_tokens(pool)
+    users = swaps["user"]
+    user_starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.zeros(0, dtype=np.int64)
+    is_start = np.zeros(len(users), dtype=bool)
+    is_start[user_starts] = True
+
+    # The text is ASCII, so offsets in characters are byte offsets
+    starts, ends, offset = [], [], 1
+    with open(path + ".tmp", "w") as file:
+        pieces = ["{"]
+        for chunk in range(0, len(users), WRITE_CHUNK):
+            rows = range(chunk, min(chunk + WRITE_CHUNK, len(users)))
+            seconds = swaps["seconds"][chunk:rows.stop].astype("datetime64[s]")
+            timestamps = np.char.replace(np.datetime_as_string(seconds), "T", " ")
+            amounts0 = np.char.mod("%.0f", swaps["amount0"][chunk:rows.stop])
+            amounts1 = np.char.mod("%.0f", swaps["amount1"][chunk:rows.stop])
+            liquidities = np.char.mod("%.0f", swaps["liquidity"][chunk:rows.stop])
+            for i, row in enumerate(rows):
+                address = addresses[users[row]]
+                if is_start[row]:
+                    if row:
+                        ends.append(offset + 6)
+                        pieces.append("\n    ],")
+                        offset += 7
+                    starts.append(offset + 5)
+                    key = f'\n    "{address}": [\n'
+                else:
+                    key = ",\n"
+                record = (
+                    "        {\n"
+                    f'            "tx_hash": "0x{swaps["hashes"][row]}",\n'
+                    f'            "user_address": "{address}",\n'
+                    f'            "token0": "{token0}",\n'
+                    f'            "amount0": {amounts0[i]},\n'
+                    f'            "token1": "{token1}",\n'
+                    f'            "amount1": {amounts1[i]},\n'
+                    f'            "timestamp": "{timestamps[i]}",\n'
+                    f'            "pool_liquidity": {liquidities[i]}\n'
+                    "        }"
+                )
+                pieces.append(key)
+                pieces.append(record)
+                offset += len(key) + len(record)
+            file.write("".join(pieces))
+            pieces = []
+        if len(users):
+            ends.append(offset + 6)
+            pieces.append("\n    ]\n")
+        pieces.append("}")
+        file.write("".join(pieces))
+    os.replace(path + ".tmp", path)
+
+    counts = np.diff(np.r_[user_starts, len(users)])
+    return user_index(addresses[users[user_starts]], starts, ends, counts, swaps["seconds"])
+
+
+def generate_dataset(out_dir, n_swaps, n_users, seed=0, pool_shares=POOL_SHARES, start=START, end=END):
+    """Write a seeded synthetic dataset into out_dir: pool files, their catalog and links to the price CSVs.
+
+    The pools are the ones the analysis scripts read, priced with the real daily closes,
+    so every script runs on out_dir as it does on the fetched data.
+    """
+    rng = np.random.default_rng(seed)
+    pools_dir = os.path.join(out_dir, "pools")
+    os.makedirs(pools_dir, exist_ok=True)
+    for name in [PRICES_PATH, ETH_PRICES_PATH]:
+        link = os.path.join(out_dir, name)
+        if not os.path.exists(link):
+            os.symlink(os.path.abspath(name), link)
+
+    usdt_prices = load_usdt_prices(fill="previous")
+    first = int(pd.Timestamp(start).timestamp())
+    last = int((pd.Timestamp(end) + pd.Timedelta(days=1)).timestamp())
+    addresses = user_addresses(n_users, rng)
+    weights = user_weights(n_users)
+    sizes = rng.lognormal(0, USER_SIZE_SIGMA, size=n_users)
+
+    pools = list(pool_shares)
+    counts = rng.multinomial(n_swaps, np.array([pool_shares[pool] for pool in pools]) / sum(pool_shares.values()))
+    entries, users = {}, set()
+    for pool, count in zip(pools, counts):
+        swaps = generate_pool(pool, int(count), weights, sizes, usdt_prices, first, last, rng)
+        path = os.path.join(pools_dir, f"data_{pool}.json")
+        index = write_pool(path, pool, swaps, addresses)
+        token0, token1 = pool_tokens(pool)
+        entries[pool] = build_entry(path, None, token_entry(token0), token_entry(token1), index=index)
+        users.update(np.unique(swaps["user"]).tolist())
+    update_catalog(entries, pools_dir)
+
+    manifest = {"seed": seed, "swaps": int(n_swaps), "users": len(users), "user_pool": n_users,
+                "pools": {pool: int(count) for pool, count in zip(pools, counts)}, "start": start, "end": end}
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w") as file:
+        json.dump(manifest, file, indent=4)
+    return manifest
+
+
+def load_manifest(data_dir):
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic swap dataset in the layout of fetch.py")
+    parser.add_argument("--out", default="synthetic", help="dataset directory, pool files go to <out>/pools")
+    parser.add_argument("--swaps", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=100000, help="users that may trade, the skew leaves some idle")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    manifest = generate_dataset(args.out, args.swaps, args.users, args.seed)
+    print(f"{manifest['swaps']} swaps by {manifest['users']} users in {len(manifest['pools'])} pools "
+          f"written to {args.out} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+# The scripts are top-level modules of the repository and read pools/ and the price CSVs from the cwd
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Imported once the repository is on the path
+import fetch
+from fake_chain import FakeNode, make_chain
+
+
+@pytest.fixture
+def repo_dir(monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    return REPO_DIR
+
+
+@pytest.fixture
+def chain():
+    return make_chain()
+
+
+@pytest.fixture
+def node(chain):
+    node = FakeNode(chain)
+    yield node
+    node.close()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # fetch.py writes pools/, its checkpoints, catalog and token registry relative to the cwd
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "pools").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    # Retries record their backoff instead of waiting it out
+    delays = []
+    monkeypatch.setattr(fetch.time, "sleep", lambda seconds: delays.append(seconds))
+    return delays
@@ -0,0 +1,173 @@
+"""A small chain, its hackathon events table and a JSON-RPC node serving it, for the fetch.py tests."""
+import json
+import random
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_abi import decode, encode
+from sqlalchemy import create_engine
+
+import fetch
+from chain_cache import ChainCache
+
+TOKENS = {"WETH": 18, "USDT": 6, "UNI": 18}
+
+# Two pools of the same pair, so their files are only named the same way when stored in read order
+POOLS = [("WETH", "USDT"), ("UNI", "WETH"), ("WETH", "USDT")]
+
+FIRST_BLOCK = 19000000
+
+
+def address(n):
+    return f"0x{n:040x}"
+
+
+def tx_hash(contract, n):
+    return f"0x{int(contract, 16):032x}{n:032x}"
+
+
+def make_chain(swaps_per_pool=40, n_blocks=30, n_users=6, seed=0):
+    """Pools, tokens and swaps of a small chain. Every swap is (contract, block, tx_hash, sender, event).
+
+    Blocks are shared by the pools, so some hold a single swap of each of several pools.
+    """
+    rng = random.Random(seed)
+    tokens = {address(0x100 + i): {"symbol": symbol, "name": f"{symbol} token", "decimals": decimals}
+              for i, (symbol, decimals) in enumerate(TOKENS.items())}
+    by_symbol = {token["symbol"]: token_address for token_address, token in tokens.items()}
+    pools = {address(0x200 + i): {"token0": by_symbol[token0], "token1": by_symbol[token1]}
+             for i, (token0, token1) in enumerate(POOLS)}
+
+    swaps = []
+    for contract in pools:
+        for n in range(swaps_per_pool):
+            amount0 = rng.randint(10 ** 15, 10 ** 19) * rng.choice([-1, 1])
+            swaps.append({
+                "contract": contract,
+                "block": FIRST_BLOCK + rng.randrange(n_blocks),
+                "tx_hash": tx_hash(contract, n),
+                "sender": address(0x300 + rng.randrange(n_users)),
+                "event": {"amount0": amount0, "amount1": -amount0 // 3, "liquidity": 10 ** 21},
+            })
+    return {"tokens": tokens, "pools": pools, "swaps": swaps}
+
+
+def write_events(path, swaps):
+    # The hackathon table with event_data as JSON text, plus an event that isn't a swap
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS hackathon_ethereum_events (contract TEXT, block INTEGER, "
+                   "event_name TEXT, event_data TEXT, block_timestamp TEXT, transaction_hash TEXT)")
+        db.executemany("INSERT INTO hackathon_ethereum_events VALUES (?, ?, ?, ?, ?, ?)", [
+            (swap["contract"], swap["block"], "Swap", json.dumps(swap["event"]),
+             f"2024-05-01 {(swap['block'] - FIRST_BLOCK) // 60:02d}:{(swap['block'] - FIRST_BLOCK) % 60:02d}:00",
+             swap["tx_hash"])
+            for swap in swaps
+        ])
+        db.execute("INSERT INTO hackathon_ethereum_events VALUES (?, ?, ?, ?, ?, ?)",
+                   (swaps[0]["contract"], FIRST_BLOCK, "Mint", "{}", "2024-05-01 00:00:00", tx_hash("0x1", 0)))
+
+
+class FakeNode:
+    """JSON-RPC node on a local port answering from a make_chain chain.
+
+    It answers Multicall3 aggregate3 eth_calls for the pool and token metadata,
+    eth_getBlockByNumber and eth_getTransactionByHash, batches in reverse order as a node
+    may. statuses are HTTP error codes returned to the next requests instead of an answer,
+    delay(call) the seconds to wait before answering a call. Every request's status and
+    (method, params) calls are recorded in requests.
+    """
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.senders = {swap["tx_hash"]: swap["sender"] for swap in chain["swaps"]}
+        self.blocks = {}
+        for swap in chain["swaps"]:
+            self.blocks.setdefault(swap["block"], []).append({"hash": swap["tx_hash"], "from": swap["sender"]})
+        self.functions = {fetch.selector(f"{function}()"): function
+                          for function in fetch.POOL_CALLS + fetch.TOKEN_CALLS}
+        self.statuses = []
+        self.delay = None
+        self.requests = []
+        self.lock = threading.Lock()
+
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                calls = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with node.lock:
+                    status = node.statuses.pop(0) if node.statuses else 200
+                    node.requests.append((status, [(call["method"], call["params"]) for call in calls]))
+                if status != 200:
+                    self.send_response(status)
+                    self.end_headers()
+                    return
+                if node.delay is not None:
+                    time.sleep(max(node.delay(call) for call in calls))
+                body = json.dumps([{"jsonrpc": "2.0", "id": call["id"], "result": node.answer(call)}
+                                   for call in reversed(calls)]).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def call_contract(self, target, function):
+        if function in fetch.POOL_CALLS:
+            return encode(["address"], [self.chain["pools"][target][function]])
+        token = self.chain["tokens"][target]
+        if function == "decimals":
+            return encode(["uint8"], [token["decimals"]])
+        return encode(["string"], [token[function]])
+
+    def answer(self, call):
+        method, params = call["method"], call["params"]
+        if method == "eth_call":
+            (calls,) = decode(["(address,bool,bytes)[]"], bytes.fromhex(params[0]["data"][10:]))
+            returned = [(True, self.call_contract(target.lower(), self.functions[data[:4]]))
+                        for target, _, data in calls]
+            return "0x" + encode(["(bool,bytes)[]"], [returned]).hex()
+        if method == "eth_getBlockByNumber":
+            return {"transactions": self.blocks[int(params[0], 16)]}
+        if method == "eth_getTransactionByHash":
+            return {"hash": params[0], "from": self.senders[params[0]]}
+        raise KeyError(method)
+
+    def params(self, method):
+        # Params of every answered call of a method
+        return [params for status, calls in self.requests if status == 200 for name, params in calls if name == method]
+
+
+def run_fetch(workdir, node, stream, incremental=False, **options):
+    engine = create_engine(f"sqlite:///{workdir / 'events.db'}")
+    checkpoints = fetch.load_checkpoints()
+    contracts = fetch.read_contracts(engine, stream, 7, checkpoints if incremental else None)
+    with ChainCache(str(workdir / "chain_cache.sqlite")) as cache:
+        return fetch.run_pipeline(contracts, cache, checkpoints, incremental, node.url, rate_limit=0, **options)
+
+
+def stored_swaps(workdir):
+    # tx_hash -> sender of every swap in every pool file, and the file of every contract
+    checkpoints = fetch.load_checkpoints()
+    files = {contract: checkpoint["file"] for contract, checkpoint in checkpoints.items()}
+    stored = {}
+    for contract, filename in files.items():
+        with open(workdir / "pools" / filename) as file:
+            for sender, transactions in json.load(file).items():
+                for tx in transactions:
+                    stored.setdefault(tx["tx_hash"], []).append((contract, sender))
+    return files, stored
@@ -0,0 +1,21 @@
+import fetch
+from chain_cache import ChainCache
+from fake_chain import address
+
+
+def test_resolved_senders_are_cached_across_runs(node, chain, tmp_path):
+    swaps = [swap for swap in chain["swaps"] if swap["contract"] == address(0x200)]
+    blocks, hashes = [swap["block"] for swap in swaps], [swap["tx_hash"] for swap in swaps]
+
+    with ChainCache(str(tmp_path / "cache.sqlite")) as cache:
+        senders = fetch.resolve_senders(node.url, blocks, hashes, cache=cache, verbose=False)
+        sent = len(node.requests)
+        assert sent
+        # Everything is cached now, a second run sends nothing
+        assert fetch.resolve_senders(node.url, blocks, hashes, cache=cache, verbose=False) == senders
+        assert len(node.requests) == sent
+
+    # The cache is on disk, a new process finds the senders too
+    with ChainCache(str(tmp_path / "cache.sqlite")) as cache:
+        assert fetch.resolve_senders(node.url, blocks, hashes, cache=cache, verbose=False) == senders
+    assert len(node.requests) == sent
@@ -0,0 +1,29 @@
+import fetch
+from chain_cache import ChainCache
+from fake_chain import address
+
+
+def test_rpc_batch_matches_answers_by_id(node, chain):
+    swaps = chain["swaps"][:5]
+    calls = [("eth_getTransactionByHash", [swap["tx_hash"]]) for swap in swaps]
+    results = fetch.rpc_batch(node.url, calls)
+    assert [result["from"] for result in results] == [swap["sender"] for swap in swaps]
+
+
+def test_resolve_senders_batches_calls_by_block(node, chain, tmp_path):
+    swaps = [swap for swap in chain["swaps"] if swap["contract"] == address(0x200)]
+    blocks, hashes = [swap["block"] for swap in swaps], [swap["tx_hash"] for swap in swaps]
+
+    with ChainCache(str(tmp_path / "cache.sqlite")) as cache:
+        senders = fetch.resolve_senders(node.url, blocks, hashes, batch_size=4, cache=cache, verbose=False)
+        assert senders == {swap["tx_hash"]: fetch.Web3.to_checksum_address(swap["sender"]) for swap in swaps}
+
+        by_block = {}
+        for swap in swaps:
+            by_block.setdefault(swap["block"], []).append(swap)
+        shared = [block for block, block_swaps in by_block.items() if len(block_swaps) > 1]
+        assert shared and len(shared) < len(by_block)
+        n_calls = len(shared) + sum(len(block_swaps) for block_swaps in by_block.values() if len(block_swaps) == 1)
+        assert len(node.params("eth_getBlockByNumber")) == len(shared)
+        assert len(node.requests) == -(-n_calls // 4)
+        assert all(len(calls) <= 4 for _, calls in node.requests)
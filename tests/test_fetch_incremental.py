@@ -0,0 +1,35 @@
+import pytest
+
+import fetch
+from fake_chain import FIRST_BLOCK, FakeNode, run_fetch, stored_swaps, write_events
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_incremental_run_appends_new_swaps_without_duplicates(workdir, chain, stream):
+    old = [swap for swap in chain["swaps"] if swap["block"] < FIRST_BLOCK + 20]
+    new = [swap for swap in chain["swaps"] if swap["block"] >= FIRST_BLOCK + 20]
+    write_events(workdir / "events.db", old)
+    node = FakeNode(chain)
+    try:
+        run_fetch(workdir, node, stream, incremental=True)
+        files, stored = stored_swaps(workdir)
+        assert sorted(stored) == sorted(swap["tx_hash"] for swap in old)
+        checkpoints = fetch.load_checkpoints()
+        assert all(checkpoint["block"] < FIRST_BLOCK + 20 for checkpoint in checkpoints.values())
+
+        # Only blocks after each checkpoint are read, so nothing already stored is fetched again
+        write_events(workdir / "events.db", new)
+        node.requests.clear()
+        progress = run_fetch(workdir, node, stream, incremental=True)
+        assert progress.swaps == len(new)
+        assert len(node.params("eth_getBlockByNumber")) + len(node.params("eth_getTransactionByHash")) <= len(new)
+
+        new_files, stored = stored_swaps(workdir)
+        assert new_files == files
+        assert stored == {swap["tx_hash"]: [(swap["contract"], fetch.Web3.to_checksum_address(swap["sender"]))]
+                          for swap in chain["swaps"]}
+
+        # A run without new swaps stores nothing
+        assert run_fetch(workdir, node, stream, incremental=True).swaps == 0
+    finally:
+        node.close()
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+import fetch
+from chain_cache import ChainCache
+from fake_chain import address, run_fetch, stored_swaps, write_events
+
+
+def test_enrich_contracts_groups_blocks_across_contracts(workdir, node, chain):
+    contracts = {}
+    for swap in chain["swaps"]:
+        data = contracts.setdefault(swap["contract"], ([], [], [], []))
+        for column, value in zip(data, [swap["block"], json.dumps(swap["event"]), "2024-05-01 00:00:00",
+                                        swap["tx_hash"]]):
+            column.append(value)
+
+    with ChainCache(str(workdir / "cache.sqlite")) as cache:
+        enriched = fetch.enrich_contracts(list(contracts.items()), cache, node.url, fetch.RateLimiter(0))
+
+    # One call per block of the whole window, a block with one swap of each of two pools is fetched once
+    by_block = {}
+    for swap in chain["swaps"]:
+        by_block.setdefault(swap["block"], set()).add(swap["contract"])
+    per_contract = {}
+    for swap in chain["swaps"]:
+        per_contract.setdefault((swap["contract"], swap["block"]), []).append(swap)
+    grouped_blocks = [params[0] for params in node.params("eth_getBlockByNumber")]
+    lone = node.params("eth_getTransactionByHash")
+    assert len(grouped_blocks) == len(set(grouped_blocks)) == len(by_block) - len(lone)
+    assert len(lone) < sum(len(swaps) == 1 for swaps in per_contract.values())
+
+    for (pool_data, address_data), (contract, pool) in zip(enriched, chain["pools"].items()):
+        assert (pool_data["token0_address"].lower(), pool_data["token1_address"].lower()) == \
+            (pool["token0"], pool["token1"])
+        expected = {}
+        for swap in chain["swaps"]:
+            if swap["contract"] == contract:
+                expected.setdefault(fetch.Web3.to_checksum_address(swap["sender"]), []).append(swap["tx_hash"])
+        assert {sender: [tx["tx_hash"] for tx in txs] for sender, txs in address_data.items()} == expected
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503])
+def test_with_retries_backs_off_on_http_errors(node, chain, no_sleep, status):
+    node.statuses = [status, status, status]
+    limiter = fetch.RateLimiter(0)
+    call = [("eth_getTransactionByHash", [chain["swaps"][0]["tx_hash"]])]
+    results = fetch.with_retries(lambda: fetch.rpc_batch(node.url, call), limiter, retries=5, backoff=0.5)
+
+    assert results[0]["from"] == chain["swaps"][0]["sender"]
+    assert [status for status, _ in node.requests] == [status, status, status, 200]
+    assert limiter.requests == 4
+    # Exponential backoff with +-50% jitter, the limiter without a rate waits 0s
+    backoffs = [delay for delay in no_sleep if delay]
+    assert len(backoffs) == 3
+    for attempt, delay in enumerate(backoffs):
+        assert 0.5 * 2 ** attempt * 0.5 <= delay <= 0.5 * 2 ** attempt * 1.5
+
+
+def test_with_retries_gives_up(node, chain, no_sleep):
+    node.statuses = [429] * 3
+    call = [("eth_getTransactionByHash", [chain["swaps"][0]["tx_hash"]])]
+    with pytest.raises(requests.HTTPError):
+        fetch.with_retries(lambda: fetch.rpc_batch(node.url, call), retries=2, backoff=0.1)
+    assert len(node.requests) == 3 and len(no_sleep) == 2
+
+
+def test_with_retries_raises_other_errors_at_once(no_sleep):
+    attempts = []
+
+    def reverted():
+        attempts.append(1)
+        raise ValueError("execution reverted")
+
+    with pytest.raises(ValueError):
+        fetch.with_retries(reverted)
+    assert len(attempts) == 1 and not no_sleep
+
+
+def test_rate_limiter_spaces_requests_of_all_threads():
+    limiter = fetch.RateLimiter(50)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [limiter.wait() for _ in range(5)]) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert limiter.requests == 10
+    assert time.monotonic() - start >= 9 / 50
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_pipeline_stores_every_swap_once(workdir, node, chain, stream):
+    write_events(workdir / "events.db", chain["swaps"])
+    progress = run_fetch(workdir, node, stream, window_swaps=50)
+    assert (progress.contracts, progress.swaps) == (len(chain["pools"]), len(chain["swaps"]))
+
+    files, stored = stored_swaps(workdir)
+    assert files == {address(0x200): "data_WETH_USDT.json", address(0x201): "data_UNI_WETH.json",
+                     address(0x202): "data_WETH_USDT_0.json"}
+    assert stored == {swap["tx_hash"]: [(swap["contract"], fetch.Web3.to_checksum_address(swap["sender"]))]
+                      for swap in chain["swaps"]}
+    catalog = json.loads((workdir / "pools" / "catalog.json").read_text())
+    assert {pool: entry["rows"] for pool, entry in catalog["pools"].items()} == \
+        {"WETH_USDT": 40, "UNI_WETH": 40, "WETH_USDT_0": 40}
+
+
+def test_pipeline_stores_contracts_in_read_order(workdir, node, chain, monkeypatch):
+    # The first contract's senders come back last, it must still be stored first
+    write_events(workdir / "events.db", chain["swaps"])
+    first = {swap["tx_hash"] for swap in chain["swaps"] if swap["contract"] == address(0x200)}
+    node.delay = lambda call: 0.3 if call["method"] == "eth_getTransactionByHash" and call["params"][0] in first \
+        else 0
+    stored = []
+    store_contract = fetch.store_contract
+    monkeypatch.setattr(fetch, "store_contract",
+                        lambda contract, *args: stored.append(contract) or store_contract(contract, *args))
+
+    run_fetch(workdir, node, stream=True, rpc_workers=3, window_swaps=1)
+    assert stored == sorted(chain["pools"])
+    assert fetch.load_checkpoints()[address(0x200)]["file"] == "data_WETH_USDT.json"
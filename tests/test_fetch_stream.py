@@ -0,0 +1,14 @@
+from sqlalchemy import create_engine
+
+import fetch
+from fake_chain import write_events
+
+
+def test_fetch_swaps_matches_stream(workdir, chain):
+    write_events(workdir / "events.db", chain["swaps"])
+    engine = create_engine(f"sqlite:///{workdir / 'events.db'}")
+    fetched = list(fetch.read_contracts(engine, stream=False))
+    streamed = list(fetch.read_contracts(engine, stream=True, batch_size=7))
+    assert fetched == streamed
+    assert [contract for contract, _ in fetched] == sorted(chain["pools"])
+    assert sum(len(data[0]) for _, data in fetched) == len(chain["swaps"])
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import analyse_users
+from pnl_engine import compute_user_pnl, load_bundled_swaps
+from price_index import PriceIndex
+
+# Closes of the fixture, a day without a row has no price
+CLOSES = {
+    "ETH": [3000, 3050, None, 2980, 3100, 3120, None, None, 3010, 2990],
+    "PEPE": [1e-5, 1.2e-5, 1.1e-5, None, 0.9e-5, 1e-5, 1.3e-5, 1.2e-5, None, 1.1e-5],
+}
+FIRST_DAY = pd.Timestamp("2024-01-01")
+
+# token0, token1 and the typical token0 amount of every fixture pool, XYZ has no prices
+POOLS = [("WETH", "USDT", 2.0), ("PEPE", "WETH", 5e6), ("USDC", "WETH", 4000.0), ("XYZ", "WETH", 100.0)]
+
+
+def fixture_prices(fill):
+    rows = [{"Date": FIRST_DAY + pd.Timedelta(days=day), "token": token, "Price": price}
+            for token, closes in CLOSES.items() for day, price in enumerate(closes) if price is not None]
+    return PriceIndex.from_frame(pd.DataFrame(rows), fill)
+
+
+def fixture_swaps(usdt_prices, n_swaps=400, n_users=15, seed=0):
+    """Swaps in the layout load_pool_data returns, some of them after the last close."""
+    rng = np.random.default_rng(seed)
+    users = rng.integers(n_users, size=n_swaps)
+    # Only the first two users trade the unpriced pool, without skipping its swaps their profit is NaN
+    pools = np.where(users < 2, rng.integers(len(POOLS), size=n_swaps), rng.integers(len(POOLS) - 1, size=n_swaps))
+    token0 = np.array([POOLS[pool][0] for pool in pools])
+    token1 = np.array([POOLS[pool][1] for pool in pools])
+    size = np.array([POOLS[pool][2] for pool in pools]) * rng.lognormal(0, 1, size=n_swaps)
+    # A negative amount0 buys token0, the other leg moves the opposite way at a rough rate
+    amount0 = size * rng.choice([-1, 1], size=n_swaps)
+    amount1 = -amount0 * rng.uniform(0.5, 2, size=n_swaps) * np.where(token1 == "USDT", 3000, 1e-3)
+    df = pd.DataFrame({
+        "user_address": [f"0x{user:040x}" for user in users],
+        "token0": token0,
+        "token1": token1,
+        "amount0": amount0,
+        "amount1": amount1,
+        "timestamp": FIRST_DAY + pd.to_timedelta(rng.uniform(0, 12 * 86400, size=n_swaps).astype(int), unit="s"),
+    })
+    for leg in ["0", "1"]:
+        for token in df[f"token{leg}"].unique():
+            df[f"amount{leg}_{token}"] = df[f"amount{leg}"].where(df[f"token{leg}"] == token)
+    return analyse_users.add_usdt_prices(df, usdt_prices)
+
+
+def assert_matches_reference(df, usdt_prices):
+    # Every user's profit and volumes as calculate_user_perfomance finds them on the user's swaps in time order
+    engine = compute_user_pnl(df, usdt_prices).set_index("user_address")
+    sorted_df = df.sort_values(["user_address", "timestamp"], kind="mergesort")
+    users = sorted_df["user_address"].unique()
+    assert sorted(engine.index) == sorted(users)
+    for user, user_data in sorted_df.groupby("user_address"):
+        profit, volumes = analyse_users.calculate_user_perfomance(user_data, usdt_prices, min_buys=-1, min_sells=-1)
+        row = engine.loc[user]
+        if np.isnan(profit):
+            assert np.isnan(row["profit_in_usdt"]), user
+        else:
+            assert row["profit_in_usdt"] == profit, user
+        assert row["volume_traded"] == volumes, user
+
+
+@pytest.mark.parametrize("fill", ["skip", "previous", "nan"])
+def test_fixture_matches_reference(fill):
+    usdt_prices = fixture_prices(fill)
+    assert_matches_reference(fixture_swaps(usdt_prices), usdt_prices)
+
+
+def test_activity_filter_matches_reference():
+    usdt_prices = fixture_prices("skip")
+    df = fixture_swaps(usdt_prices)
+    engine = compute_user_pnl(df, usdt_prices, min_buys=4, min_sells=4).set_index("user_address")
+    expected = {}
+    for user, user_data in df.sort_values(["user_address", "timestamp"], kind="mergesort").groupby("user_address"):
+        profit, volumes = analyse_users.calculate_user_perfomance(user_data, usdt_prices, min_buys=4, min_sells=4)
+        if volumes is not None:
+            expected[user] = (profit, volumes)
+    assert 0 < len(expected) < df["user_address"].nunique()
+    assert sorted(engine.index) == sorted(expected)
+    for user, (profit, volumes) in expected.items():
+        assert engine.loc[user, "profit_in_usdt"] == profit
+        assert engine.loc[user, "volume_traded"] == volumes
+
+
+def test_bundled_pools_match_reference(repo_dir):
+    df, usdt_prices = load_bundled_swaps()
+    assert len(df)
+    assert_matches_reference(df, usdt_prices)
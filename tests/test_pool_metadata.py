@@ -0,0 +1,27 @@
+import fetch
+from chain_cache import ChainCache
+from token_registry import load_token_registry
+
+
+def test_resolve_pool_metadata_in_two_round_trips(workdir, node, chain):
+    contracts = list(chain["pools"])
+    with ChainCache(str(workdir / "cache.sqlite")) as cache:
+        metadata = fetch.resolve_pool_metadata(node.url, contracts, cache)
+        # One multicall for token0 / token1 of every pool, one for the metadata of every token
+        assert [calls[0][0] for _, calls in node.requests] == ["eth_call", "eth_call"]
+        for contract, pool in chain["pools"].items():
+            token0, token1 = chain["tokens"][pool["token0"]], chain["tokens"][pool["token1"]]
+            assert (metadata[contract]["token0"], metadata[contract]["token1"]) == (token0["symbol"], token1["symbol"])
+            assert (metadata[contract]["decimals0"], metadata[contract]["decimals1"]) == \
+                (token0["decimals"], token1["decimals"])
+
+        # Cached pools are not asked again
+        assert fetch.resolve_pool_metadata(node.url, contracts, cache) == metadata
+        assert len(node.requests) == 2
+
+    # The tokens are in pools/tokens.json now, without the pool cache only the pools are asked
+    registry = load_token_registry()
+    assert {address: token["decimals"] for address, token in registry.tokens.items()} == \
+        {address: token["decimals"] for address, token in chain["tokens"].items()}
+    assert fetch.resolve_pool_metadata(node.url, contracts, registry=registry) == metadata
+    assert len(node.requests) == 3
@@ -0,0 +1,20 @@
+import pandas as pd
+
+from price_bars import build_bars, usd_prices
+
+
+def swap(pool, amount0, amount1, minute=0):
+    token0, token1 = pool.split("_")
+    return {"pool": pool, "token0": token0, "token1": token1, "amount0": amount0, "amount1": amount1,
+            "timestamp": pd.Timestamp("2024-01-01") + pd.Timedelta(minutes=minute)}
+
+
+def test_tokens_are_priced_through_any_number_of_pools(capsys):
+    # LINK is four pools away from USDT, XYZ/ABC has no path to a stablecoin
+    swaps = pd.DataFrame([swap("WETH_USDT", 1, -3000), swap("UNI_WETH", 300, -1), swap("1INCH_UNI", 40, -1),
+                          swap("LINK_1INCH", 1, -60), swap("XYZ_ABC", 5, -1)])
+    prices = usd_prices(build_bars(swaps, "1d")).set_index("token")
+    assert prices.loc["1INCH", "price"] == 0.25 and prices.loc["LINK", "price"] == 15
+    assert prices.loc["LINK", "hops"] == 3
+    assert "XYZ" not in prices.index and "ABC" not in prices.index
+    assert "no USD price for ABC, XYZ" in capsys.readouterr().out
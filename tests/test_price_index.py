@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from price_index import PriceIndex, STABLECOINS
+from swap_table import load_usdt_prices
+
+
+def small_index(fill):
+    frame = pd.DataFrame({"Date": pd.to_datetime(["2024-01-01", "2024-01-03", "2024-01-01"]),
+                          "token": ["ETH", "ETH", "PEPE"], "Price": [3000.0, 3100.0, 1e-5]})
+    return PriceIndex.from_frame(frame, fill)
+
+
+def test_stablecoins_are_one_on_every_date():
+    prices = small_index("skip")
+    dates = ["2023-06-01", "2024-01-02", "2025-01-01"]
+    for token in STABLECOINS:
+        assert prices.lookup([token] * 3, dates).tolist() == [1.0, 1.0, 1.0]
+    # Other tokens only have the closes of the index's days
+    assert np.isnan(prices.lookup(["WETH"] * 3, dates)).all()
+
+
+def test_fill_modes():
+    dates = ["2024-01-01", "2024-01-02", "2024-01-04"]
+    assert np.isnan(small_index("skip").lookup(["WETH"] * 3, dates)[1:]).all()
+    assert small_index("previous").lookup(["WETH"] * 3, dates).tolist() == [3000.0, 3000.0, 3100.0]
+    assert np.isnan(small_index("previous").get("XYZ", "2024-01-01"))
+
+
+def test_from_csv_matches_the_cached_price_table(repo_dir):
+    from_csv, cached = PriceIndex.from_csv(), load_usdt_prices()
+    assert from_csv.token_ids == cached.token_ids and from_csv.first_day == cached.first_day
+    assert np.array_equal(from_csv.prices, cached.prices, equal_nan=True)
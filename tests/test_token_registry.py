@@ -0,0 +1,36 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from pool_catalog import token_decimals
+from token_registry import SEED_NAME, TokenRegistry, load_token_registry, tokens_path
+
+
+@pytest.fixture
+def pools_dir(tmp_path, repo_dir):
+    # A pools directory with one bundled pool whose tokens are not in DECIMALS_MAP
+    shutil.copy(os.path.join(repo_dir, "pools", "data_PRO_WETH.json"), tmp_path)
+    return str(tmp_path)
+
+
+def test_bundled_tokens_come_from_the_seed(pools_dir, repo_dir):
+    with pytest.raises(ValueError, match="PRO"):
+        token_decimals("PRO_WETH", pools_dir)
+    shutil.copy(os.path.join(repo_dir, "pools", SEED_NAME), pools_dir)
+    assert token_decimals("PRO_WETH", pools_dir) == [10 ** 8, 10 ** 18]
+
+
+def test_tokens_json_replaces_the_seed(pools_dir, repo_dir):
+    shutil.copy(os.path.join(repo_dir, "pools", SEED_NAME), pools_dir)
+    registry = TokenRegistry.load(pools_dir)
+    assert registry.symbol_decimals("PRO") == 8
+    # Saving writes tokens.json and never the seed
+    registry.put("0x" + "11" * 20, "XYZ", "Xyz", 6)
+    registry.save()
+    with open(tokens_path(pools_dir)) as file:
+        assert len(json.load(file)["tokens"]) == len(registry)
+    assert load_token_registry(pools_dir).symbol_decimals("XYZ") == 6
+    with open(os.path.join(pools_dir, SEED_NAME)) as file:
+        assert "0x" + "11" * 20 not in json.load(file)["tokens"]
@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+from functools import lru_cache
+
+import pandas as pd
+
+POOLS_DIR = "pools"
+TOKENS_NAME = "tokens.json"
+SEED_NAME = "tokens.seed.json"
+TOKENS_VERSION = 1
+
+# pools/tokens.json maps lowercase token addresses to {"symbol", "name", "decimals"} as the
+# token contracts return them. fetch.py adds every token it meets, decimals is None for a
+# token without a working decimals(), a missing name is "" and a missing symbol the start
+# of the address.
+#
+# pools/tokens.seed.json, in the same layout, holds the tokens of the pool files shipped with the
+# repository, which were fetched with symbols only. A pools_dir without tokens.json starts from
+# it, so their decimals are known without a node. tokens.json is local and not committed.
+
+
+def tokens_path(pools_dir=POOLS_DIR):
+    return os.path.join(pools_dir, TOKENS_NAME)
+
+
+def source_path(pools_dir=POOLS_DIR):
+    # The file the registry is read from, the seed until fetch.py writes tokens.json
+    path = tokens_path(pools_dir)
+    return path if os.path.exists(path) else os.path.join(pools_dir, SEED_NAME)
+
+
+class TokenRegistry:
+    """On-chain metadata of every token fetch.py has seen, kept in pools/tokens.json.
+
+    The loaders scale amounts with its decimals, looked up by the token addresses in the
+    catalog or, for pool files that only carry symbols, by symbol when every known token
+    with that symbol has the same decimals.
+    """
+
+    def __init__(self, tokens=None, path=None):
+        self.tokens = dict(tokens or {})
+        self.path = path or tokens_path()
+        self.changed = False
+
+    @classmethod
+    def load(cls, pools_dir=POOLS_DIR):
+        path, source = tokens_path(pools_dir), source_path(pools_dir)
+        if not os.path.exists(source):
+            return cls(path=path)
+        with open(source) as file:
+            data = json.load(file)
+        return cls(data["tokens"] if data.get("version") == TOKENS_VERSION else {}, path)
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a truncated registry
+        with open(self.path + ".tmp", "w") as file:
+            json.dump({"version": TOKENS_VERSION, "tokens": self.tokens}, file, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+        self.changed = False
+
+    def get(self, address):
+        return self.tokens.get(address.lower())
+
+    def put(self, address, symbol, name, decimals):
+        self.tokens[address.lower()] = {"symbol": symbol, "name": name, "decimals": decimals}
+        self.changed = True
+
+    def missing(self, addresses):
+        """The addresses not in the registry yet, each once and in order."""
+        return [address for address in dict.fromkeys(address.lower() for address in addresses)
+                if address not in self.tokens]
+
+    def symbol_decimals(self, symbol):
+        # Decimals of a symbol, None if no token has it or tokens sharing it disagree
+        decimals = {token["decimals"] for token in self.tokens.values()
+                    if token["symbol"] == symbol and token["decimals"] is not None}
+        return decimals.pop() if len(decimals) == 1 else None
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+@lru_cache(maxsize=4)
+def read_registry(path, mtime_ns):
+    return TokenRegistry.load(os.path.dirname(path))
+
+
+def load_token_registry(pools_dir=POOLS_DIR):
+    """The registry of pools_dir, parsed once per version of the file. Treat it as read-only."""
+    source = source_path(pools_dir)
+    if not os.path.exists(source):
+        return TokenRegistry(path=tokens_path(pools_dir))
+    return read_registry(source, os.stat(source).st_mtime_ns)
+
+
+def resolve_catalog_tokens(rpc_url, pools_dir=POOLS_DIR):
+    """Fill in token addresses and decimals of catalog pools that were indexed with symbols only.
+
+    Pools need a known contract, e.g. from the fetch checkpoints. Their metadata is
+    resolved on chain in a few batched requests and added to the registry too.
+    """
+    from fetch import resolve_pool_metadata
+    from pool_catalog import load_catalog, token_entry, update_catalog
+
+    pools = {pool: entry for pool, entry in load_catalog(pools_dir)["pools"].items()
+             if entry["contract"] and (entry["token0"]["address"] is None or entry["token1"]["address"] is None)}
+    registry = TokenRegistry.load(pools_dir)
+    metadata = resolve_pool_metadata(rpc_url, [entry["contract"] for entry in pools.values()], registry=registry)
+
+    entries = {}
+    for pool, entry in pools.items():
+        pool_data = metadata.get(entry["contract"])
+        if pool_data is None:
+            continue
+        entries[pool] = dict(entry, token0=token_entry(pool_data["token0"], pool_data["token0_address"],
+                                                       pool_data["decimals0"]),
+                         token1=token_entry(pool_data["token1"], pool_data["token1_address"], pool_data["decimals1"]))
+    update_catalog(entries, pools_dir)
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the token registry or resolve the tokens of catalog pools")
+    parser.add_argument("command", choices=["show", "resolve"])
+    parser.add_argument("--pools-dir", default=POOLS_DIR)
+    parser.add_argument("--rpc-url", help="JSON-RPC endpoint for resolve instead of the default node")
+    args = parser.parse_args()
+
+    if args.command == "resolve":
+        from fetch import RPC_URL
+        entries = resolve_catalog_tokens(args.rpc_url or RPC_URL, args.pools_dir)
+        print(f"Resolved the tokens of {len(entries)} pools")
+
+    registry = TokenRegistry.load(args.pools_dir)
+    rows = [dict(token, address=address) for address, token in registry.tokens.items()]
+    table = pd.DataFrame(rows, columns=["symbol", "name", "decimals", "address"])
+    print(table.astype({"decimals": "Int64"}).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
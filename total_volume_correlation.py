@@ -1,87 +1,31 @@
-import json
+import argparse
 import pandas as pd
 import plotly.graph_objects as go
-from datetime import datetime
-
-# Define decimals map for tokens
-DECIMALS_MAP = {
-    "WETH": 10 ** 18,
-    "DAI": 10 ** 18,
-    "USDC": 10 ** 6,
-    "USDT": 10 ** 6,
-    "WBTC": 10 ** 8,
-    "LINK": 10 ** 18,
-    "UNI": 10 ** 18,
-    "MKR": 10 ** 18,
-    "MATIC": 10 ** 18,
-    "SHIB": 10 ** 18,
-    "LDO": 10 ** 18,
-    "PEPE": 10 ** 18,
-}
-
-# Load USDC_WETH and USDT_WETH data, and combine
-TOKEN_PAIRS = [("USDC", "WETH"), ("WETH", "USDT"), ("MATIC", "WETH"), ("UNI", "WETH"), ("DAI", "WETH")]
-
-def load_pool_data():
-    all_dataframes = []
-    for token0, token1 in TOKEN_PAIRS:
-        with open(f"pools/data_{token0}_{token1}.json") as file:
-            data = json.load(file)
-        
-        # Convert JSON data into a DataFrame
-        records = []
-        for _, transactions in data.items():
-            for tx in transactions:
-                records.append(tx)
-        dataframe = pd.DataFrame(records)
-        all_dataframes.append(dataframe)
-    return all_dataframes
-
-def load_usdt_prices():
-    usdt_prices = pd.read_csv('Combined_Historical_Price_Data.csv')
-    usdt_prices['Date'] = pd.to_datetime(usdt_prices['Date'])
-    usdt_prices = usdt_prices.set_index(['Date', 'token'])
-    usdt_prices['Price'] = usdt_prices['Price'].str.replace(',', '').astype(float)
-    return usdt_prices
-
-def get_price(row, usdt_prices):
-    date_str = datetime.strftime(pd.to_datetime(row['timestamp']), "%d/%m/%Y")
-    try:
-        return usdt_prices.loc[(date_str, row['token0']), 'Price']
-    except KeyError:
-        return None  # or use np.nan to indicate missing data
-
-def transform_df(df, token, usdt_prices):
-    df['rate'] = df.apply(lambda row: get_price(row, usdt_prices), axis=1)
-    df.dropna(subset=['rate'], inplace=True)  # Drop rows where rate is missing
-    df['amount0'] = (df['amount0'] / DECIMALS_MAP[token] * df['rate'] * 10 ** 6)
-    df['token0'] = 'USDT'
-    return df
+from significance import correlation_significance, format_significance
+from price_bars import load_swap_prices, load_intraday_volatility
+from swap_table import available_pools, load_compact_table, load_eth_data, load_usdt_prices, normalize_swaps, user_ids
+
+# Pools to combine, every swap is valued by its non-WETH leg in USDT
+POOLS = ["USDC_WETH", "WETH_USDT", "MATIC_WETH", "UNI_WETH", "DAI_WETH"]
 
-def load_eth_data():
-    # Load the ETH price data and calculate volatility
-    eth_price_data = pd.read_csv('Ethereum Historical Results Price Data.csv')
-    eth_price_data['Date'] = pd.to_datetime(eth_price_data['Date'], format='%d/%m/%Y').dt.date
-    eth_price_data['Price'] = eth_price_data['Price'].str.replace(',', '').astype(float)
-    eth_price_data = eth_price_data[['Date', 'Price']].iloc[::-1]
-    eth_price_data['Volatility'] = eth_price_data['Price'].pct_change().abs() * 100
-    return eth_price_data
+def load_pool_data(pools=POOLS, usdt_prices=None):
+    # Swaps of all pools oriented to their quote leg and priced in one vectorized join
+    return normalize_swaps(load_compact_table(pools), load_usdt_prices() if usdt_prices is None else usdt_prices)
 
 def clean_the_df(df, positive_addresses):
-    # Assuming 'df' is the DataFrame with transaction data, filter it
-    df = df[df['user_address'].isin(positive_addresses)]
+    # Assuming 'df' is the DataFrame with transaction data, filter it by interned user ids
+    df = df[df['user'].isin(user_ids(positive_addresses))]
 
-    # Convert timestamps and amounts to numeric
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df['amount0'] = df.apply(lambda row: row['amount0'] / DECIMALS_MAP[row['token0']], axis=1)
+    # Amounts are already valued in USDT in load_pool_data
+    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
 
     # Calculate volume
-    df['volume'] = abs(df['amount0'])
+    df['volume'] = abs(df['amount0_usdt'])
     df['date'] = df['timestamp'].dt.date
     
     return df
 
-def plot(daily_total_volume, filtered_volatility_data, hover_text, correlation):
+def plot(daily_total_volume, filtered_volatility_data, hover_text, significance):
     # Plotting daily total volume and ETH volatility on the same chart
     fig = go.Figure()
 
@@ -106,7 +50,7 @@ def plot(daily_total_volume, filtered_volatility_data, hover_text, correlation):
 
     # Update layout to accommodate dual y-axes and ensure sorted dates are displayed
     fig.update_layout(
-        title=f"Daily Total Volume for Combined Pools and ETH Volatility. Correlation: {correlation:.2f}",
+        title=f"Daily Total Volume for Combined Pools and ETH Volatility. Correlation: {format_significance(significance)}",
         xaxis_title="Date",
         yaxis=dict(title="Total Volume", side="left"),
         yaxis2=dict(
@@ -122,15 +66,17 @@ def plot(daily_total_volume, filtered_volatility_data, hover_text, correlation):
     
 
 def main():
-    usdt_prices = load_usdt_prices()
-    all_dataframes = load_pool_data()
-    
-    all_dataframes[2] = transform_df(all_dataframes[2], "MATIC", usdt_prices)
-    all_dataframes[3] = transform_df(all_dataframes[3], "UNI", usdt_prices)
-   
-    all_dataframes[1].rename(columns={"token0": "token1", "token1": "token0", "amount0": "amount1", "amount1": "amount0"}, inplace=True)
-
-    df = pd.concat(all_dataframes, ignore_index=True)
+    parser = argparse.ArgumentParser(description="Correlate the daily total volume of top performers with ETH volatility")
+    parser.add_argument("--pools", nargs="+", default=POOLS,
+                        help="pools to combine such as WETH_USDT, or 'all' for every pool in pools/")
+    parser.add_argument("--prices", choices=["csv", "swaps"], default="csv",
+                        help="daily USD prices from the price CSV or derived from the swaps")
+    parser.add_argument("--volatility-pool",
+                        help="intraday realized volatility of a pool's swaps, e.g. WETH_USDT, instead of the ETH CSV")
+    args = parser.parse_args()
+
+    usdt_prices = load_swap_prices() if args.prices == "swaps" else load_usdt_prices()
+    df = load_pool_data(available_pools() if args.pools == ["all"] else args.pools, usdt_prices)
 
     with open("top_performers_weth_usdt.txt", "r") as file:
         positive_addresses = file.read().splitlines()
@@ -143,7 +89,7 @@ def main():
     # Sort the daily total volume by date
     daily_total_volume = daily_total_volume.sort_index()
 
-    eth_price_data = load_eth_data()
+    eth_price_data = load_intraday_volatility(args.volatility_pool) if args.volatility_pool else load_eth_data()
     
     # Filter ETH volatility data for dates where transactions occurred and sort by date
     filtered_volatility_data = eth_price_data[eth_price_data['Date'].isin(daily_total_volume.index)]
@@ -165,10 +111,11 @@ def main():
         on='date'
     )
 
-    # Calculate correlation between total volume and ETH volatility
-    correlation = merged_data['total_volume'].corr(merged_data['Volatility'])
+    # Calculate correlation between total volume and ETH volatility, with a bootstrap CI and permutation p-value
+    significance = correlation_significance(merged_data['total_volume'], merged_data['Volatility'])
+    print(f"Correlation: {format_significance(significance)}")
     
-    plot(daily_total_volume, filtered_volatility_data, hover_text, correlation)
+    plot(daily_total_volume, filtered_volatility_data, hover_text, significance)
 
 if __name__ == "__main__":
     main()
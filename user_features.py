@@ -0,0 +1,216 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from id_registry import IdRegistry
+from price_index import STABLECOINS
+from profiling import stage
+from swap_table import available_pools, load_compact_table, load_usdt_prices
+
+FEATURES_PATH = "user_features.npz"
+
+# What the top performers traded, one row per (user, token), written by analyse_users.py
+TOKEN_VOLUMES_PATH = "top_performers_token_volumes.csv"
+
+SECONDS_PER_DAY = 86400
+
+# Per-user columns in the order they are saved, usd_<TOKEN> volumes follow them
+FEATURE_COLUMNS = ["trades", "buys", "sells", "priced_trades", "usd_volume", "median_usd", "max_usd",
+                   "active_days", "first_timestamp", "last_timestamp", "mean_gap", "median_gap", "min_gap", "pools"]
+
+
+def swap_usd(swaps, registry, usdt_prices):
+    """USD value of every swap: its stablecoin leg, else whichever leg has a price, NaN if neither has."""
+    values = []
+    stable = []
+    for leg in ["0", "1"]:
+        symbols = registry.decode_tokens(swaps[f"token{leg}"].to_numpy())
+        dates = swaps["timestamp"].to_numpy().astype("datetime64[s]")
+        values.append(np.abs(swaps[f"amount{leg}"].to_numpy()) * usdt_prices.lookup(symbols, dates))
+        stable.append(np.isin(symbols, list(STABLECOINS)))
+    use1 = np.isnan(values[0]) | (stable[1] & ~stable[0] & ~np.isnan(values[1]))
+    return np.where(use1, values[1], values[0])
+
+
+def group_median(groups, values, n_groups):
+    # Median of every group ignoring NaN, one sort of (group, value) instead of a median per group
+    order = np.lexsort((values, groups))
+    ordered = values[order]
+    valid = np.bincount(groups, weights=~np.isnan(values), minlength=n_groups).astype(np.int64)
+    starts = np.r_[0, np.cumsum(np.bincount(groups, minlength=n_groups))[:-1]]
+    low = np.minimum(starts + (valid - 1) // 2, len(ordered) - 1)
+    high = np.minimum(starts + valid // 2, len(ordered) - 1)
+    return np.where(valid > 0, (ordered[low] + ordered[high]) / 2, np.nan)
+
+
+def build_features(swaps, usdt_prices, registry=None):
+    """Feature matrix of every user in a compact swap table, one row per interned user id.
+
+    One lexsort by (user, timestamp) puts every user's swaps in a contiguous run, then
+    each feature is a reduceat or bincount over the runs:
+
+        trades, buys, sells       swaps, those receiving token0 (amount0 < 0) and the others
+        priced_trades             swaps with a USD value, see swap_usd
+        usd_volume, median_usd,   total, median and largest USD value of the priced swaps
+        max_usd
+        active_days               distinct UTC days with a swap
+        first_timestamp,          epoch seconds of the first and last swap
+        last_timestamp
+        mean_gap, median_gap,     seconds between consecutive swaps, NaN with a single swap
+        min_gap
+        pools                     distinct pools traded in
+        usd_<TOKEN>               USD value of the swaps with the token on either leg
+
+    Returns a frame indexed by user id, sorted by it.
+    """
+    registry = IdRegistry.load() if registry is None else registry
+    token_ids = np.union1d(swaps["token0"].to_numpy(), swaps["token1"].to_numpy())
+    columns = FEATURE_COLUMNS + [f"usd_{symbol}" for symbol in registry.decode_tokens(token_ids)]
+    if not len(swaps):
+        return pd.DataFrame(columns=columns, index=pd.Index([], dtype=np.int32, name="user"))
+
+    order = np.lexsort((swaps["timestamp"].to_numpy(), swaps["user"].to_numpy()))
+    swaps = swaps.iloc[order]
+    user = swaps["user"].to_numpy()
+    seconds = swaps["timestamp"].to_numpy()
+    usd = swap_usd(swaps, registry, usdt_prices)
+    priced = ~np.isnan(usd)
+
+    starts = np.flatnonzero(np.r_[True, user[1:] != user[:-1]])
+    ends = np.r_[starts[1:], len(user)]
+    n_users = len(starts)
+    groups = np.repeat(np.arange(n_users), ends - starts)
+
+    def total(values):
+        return np.bincount(groups, weights=values, minlength=n_users)
+
+    trades = ends - starts
+    buys = total(swaps["amount0"].to_numpy() < 0).astype(np.int64)
+
+    # Gaps to the previous swap of the same user, NaN on every user's first swap
+    gaps = np.diff(seconds, prepend=0).astype(np.float64)
+    gaps[starts] = np.nan
+    days = seconds // SECONDS_PER_DAY
+    new_day = np.r_[True, (days[1:] != days[:-1]) | (user[1:] != user[:-1])]
+
+    # Distinct (user, pool) pairs, counted per user
+    n_pools = len(swaps["pool"].cat.categories)
+    user_pools = np.unique(groups * n_pools + swaps["pool"].cat.codes.to_numpy())
+
+    features = {
+        "trades": trades,
+        "buys": buys,
+        "sells": trades - buys,
+        "priced_trades": total(priced).astype(np.int64),
+        "usd_volume": total(np.where(priced, usd, 0)),
+        "median_usd": group_median(groups, usd, n_users),
+        "max_usd": np.fmax.reduceat(usd, starts),
+        "active_days": total(new_day).astype(np.int64),
+        "first_timestamp": seconds[starts],
+        "last_timestamp": seconds[ends - 1],
+        "mean_gap": np.where(trades > 1, (seconds[ends - 1] - seconds[starts]) / np.maximum(trades - 1, 1), np.nan),
+        "median_gap": group_median(groups, gaps, n_users),
+        "min_gap": np.fmin.reduceat(gaps, starts),
+        "pools": np.bincount(user_pools // n_pools, minlength=n_users),
+    }
+
+    # Dense users x tokens volumes, every swap counts for both of its tokens
+    volume = np.where(priced, usd, 0)
+    by_token = np.zeros(n_users * len(token_ids))
+    for leg in ["0", "1"]:
+        cells = groups * len(token_ids) + np.searchsorted(token_ids, swaps[f"token{leg}"].to_numpy())
+        by_token += np.bincount(cells, weights=volume, minlength=len(by_token))
+    features.update(zip(columns[len(FEATURE_COLUMNS):], by_token.reshape(n_users, len(token_ids)).T))
+    return pd.DataFrame(features, index=pd.Index(user[starts], name="user"))[columns]
+
+
+def token_volumes(swaps, usdt_prices, registry=None):
+    """Long table of what every user traded per token: user_address, token, volume, usd_volume.
+
+    volume sums |amount| of both legs in token units like volume_traded of the PnL pass,
+    usd_volume values every leg at its token's USDT close on the swap's own day. Swaps
+    the pass skips for a missing price are left out, so the volumes match it.
+    Users come in the order of their first swap, tokens by symbol within a user.
+    """
+    registry = IdRegistry.load() if registry is None else registry
+    swaps = swaps[(swaps["amount0"] != 0) & (swaps["amount1"] != 0)]
+    dates = swaps["timestamp"].to_numpy().astype("datetime64[s]")
+    prices = [usdt_prices.lookup(registry.decode_tokens(swaps[f"token{leg}"].to_numpy()), dates) for leg in "01"]
+    if usdt_prices.skip_missing:
+        priced = ~(np.isnan(prices[0]) | np.isnan(prices[1]))
+        swaps, prices = swaps[priced], [leg_prices[priced] for leg_prices in prices]
+
+    # Both legs stacked, one (user, token) cell per distinct pair
+    users, user_order = pd.factorize(np.tile(swaps["user"].to_numpy(), 2))
+    tokens = np.concatenate([swaps["token0"].to_numpy(), swaps["token1"].to_numpy()])
+    tokens, symbols = pd.factorize(registry.decode_tokens(tokens), sort=True)
+    amounts = np.abs(np.concatenate([swaps["amount0"].to_numpy(), swaps["amount1"].to_numpy()]))
+    usd = amounts * np.concatenate(prices)
+    cells, cell_codes = np.unique(users * len(symbols) + tokens, return_inverse=True)
+
+    return pd.DataFrame({
+        "user_address": registry.decode_addresses(user_order[cells // max(len(symbols), 1)]),
+        "token": np.asarray(symbols, dtype=object)[cells % max(len(symbols), 1)],
+        "volume": np.bincount(cell_codes, weights=amounts, minlength=len(cells)),
+        "usd_volume": np.bincount(cell_codes, weights=np.where(np.isnan(usd), 0, usd), minlength=len(cells)),
+    })
+
+
+def save_features(features, path=FEATURES_PATH):
+    # One array per column, np.savez appends .npz on its own so write to a temporary name
+    tmp_path = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_path, user=features.index.to_numpy(), columns=np.array(features.columns, dtype=str),
+             **{f"column_{i}": features[column].to_numpy() for i, column in enumerate(features.columns)})
+    os.replace(tmp_path, path)
+
+
+def load_features(path=FEATURES_PATH):
+    """The saved feature matrix as a frame indexed by interned user id."""
+    with np.load(path) as archive:
+        columns = archive["columns"].tolist()
+        return pd.DataFrame({column: archive[f"column_{i}"] for i, column in enumerate(columns)},
+                            index=pd.Index(archive["user"], name="user"))
+
+
+def top_users(features, feature, k=10):
+    """The k users with the highest value of a feature, best first, in one partial sort."""
+    values = features[feature].to_numpy(dtype=np.float64)
+    values = np.where(np.isnan(values), -np.inf, values)
+    if k < len(values):
+        candidates = np.argpartition(-values, k)[:k]
+    else:
+        candidates = np.arange(len(values))
+    return features.iloc[candidates[np.argsort(-values[candidates], kind="stable")]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the per-user feature matrix of all pools")
+    parser.add_argument("--pools", nargs="+", help="pools such as WETH_USDT, every pool with known decimals by default")
+    parser.add_argument("--output", default=FEATURES_PATH)
+    parser.add_argument("--top", help="print the users with the highest value of this feature, e.g. usd_volume")
+    parser.add_argument("-k", type=int, default=20)
+    args = parser.parse_args()
+
+    registry = IdRegistry.load()
+    pools = args.pools or available_pools()
+    start = time.perf_counter()
+    with stage("user_features") as built:
+        swaps = load_compact_table(pools, registry=registry)
+        features = build_features(swaps, load_usdt_prices(), registry)
+        built.rows_in, built.rows_out = len(swaps), len(features)
+    save_features(features, args.output)
+    print(f"{len(features)} users x {features.shape[1]} features from {len(swaps)} swaps in {len(pools)} pools "
+          f"in {time.perf_counter() - start:.2f}s, saved to {args.output}")
+
+    if args.top:
+        top = top_users(features, args.top, args.k)
+        top.insert(0, "user_address", registry.decode_addresses(top.index.to_numpy()))
+        columns = list(dict.fromkeys(["user_address", args.top, "trades", "usd_volume", "active_days", "pools"]))
+        print(top[columns].to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,52 @@
+import argparse
+import os
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import json
 import plotly.graph_objects as go
-
-# Load the data from CSV or define a sample dataset here
-data = pd.read_csv("top_performers_with_profits_and_volumes.csv")
-
-# Convert the JSON string of volumes to a dictionary
-data['volume_traded'] = data['volume_traded'].apply(lambda x: json.loads(x.replace("'", '"')))
-
-# Load the USDT price data for each token for standardization
-usdt_prices = {
-    'WETH': 2525.04,  # example price in USDT
-    'MATIC': 0.33,  # example price in USDT
-    'UNI': 7.54    # example price in USDT
-}
-
-usdt_equivalent_volumes = []
-user_addresses = []
-
-# Convert all non-USDT/USDC volumes to their equivalent USDT values
-for index, row in data.iterrows():
-    volumes = {}
-    for token, volume in row['volume_traded'].items():
-        if token in {"USDT", "USDC"}:
-            volumes[token] = volume
-        elif token in usdt_prices:
-            volumes[token] = volume * usdt_prices[token]
-    usdt_equivalent_volumes.append(volumes)
-    user_addresses.append(row['user_address'])  
-
-# Convert usdt_equivalent_volumes list to a DataFrame
-volume_df = pd.DataFrame(usdt_equivalent_volumes)
-volume_df['user_address'] = user_addresses
-
-volume_df.set_index('user_address', inplace=True)
-
-# Create the stacked bar chart with Plotly
-fig = go.Figure()
-
-# Add a trace for each cryptocurrency
-for token in volume_df.columns:
-    fig.add_trace(go.Bar(
-        x=volume_df.index,
-        y=volume_df[token],
-        name=token
-    ))
-
-# Customize layout
-fig.update_layout(
-    title="User Traded Volume in USDT Equivalent",
-    xaxis_title="User Address",
-    yaxis_title="Volume in USDT",
-    barmode='stack',
-    legend_title="Token",
-)
-
-# Show the plot
-fig.show()
\ No newline at end of file
+from user_features import TOKEN_VOLUMES_PATH
+
+def volume_matrix(volumes, column="usd_volume"):
+    # Dense users x tokens matrix from the long table, users in the order of the file
+    users, user_addresses = pd.factorize(volumes['user_address'])
+    tokens, token_names = pd.factorize(volumes['token'], sort=True)
+    matrix = np.zeros((len(user_addresses), len(token_names)))
+    matrix[users, tokens] = volumes[column].to_numpy()
+    return user_addresses, token_names, matrix
+
+def plot(user_addresses, token_names, matrix, usd=True):
+    # Create the stacked bar chart with Plotly, one trace per token
+    fig = go.Figure()
+    for token, token_volumes in zip(token_names, matrix.T):
+        fig.add_trace(go.Bar(
+            x=user_addresses,
+            y=token_volumes,
+            name=token
+        ))
+
+    # Customize layout
+    fig.update_layout(
+        title="User Traded Volume in USDT Equivalent" if usd else "User Traded Volume in Token Units",
+        xaxis_title="User Address",
+        yaxis_title="Volume in USDT" if usd else "Volume",
+        barmode='stack',
+        legend_title="Token",
+    )
+    return fig
+
+def main():
+    parser = argparse.ArgumentParser(description="Stacked per-token traded volume of the top performers")
+    parser.add_argument("--input", default=TOKEN_VOLUMES_PATH, help="token volumes written by analyse_users.py")
+    parser.add_argument("--raw", action="store_true", help="plot volumes in token units instead of USDT")
+    args = parser.parse_args()
+
+    # Every volume was valued at its token's price on the day of the swap by analyse_users.py
+    if not os.path.exists(args.input):
+        raise SystemExit(f"{args.input} does not exist, write it with python analyse_users.py")
+    volumes = pd.read_csv(args.input) if os.path.getsize(args.input) else pd.DataFrame()
+    if volumes.empty:
+        raise SystemExit(f"{args.input} has no volumes, the pools analyse_users.py read had no top performers")
+    user_addresses, token_names, matrix = volume_matrix(volumes, "volume" if args.raw else "usd_volume")
+    plot(user_addresses, token_names, matrix, usd=not args.raw).show()
+
+if __name__ == "__main__":
+    main()